@@ -136,10 +136,12 @@ void load_firmware(void)
   // Get signed hash.
   unsigned char signed_hash[256];
   uart_write_str(UART2, "entering loop");
+  nl(UART2);
   for(int i = 0; i < 256; i++){
     signed_hash[i] = uart_read(UART1, BLOCKING, &read);
   }
   uart_write_str(UART2, "loop passed");
+  nl(UART2);
   uart_write(UART1, OK);
   
   // Get version.
@@ -271,10 +273,13 @@ void load_firmware(void)
     SysCtlReset();
     return;
   }
+  uart_write_str(UART2, "passed verification");
+  nl(UART2);
   // decrypt data with aes CBC mode
   char aes_key[16] = AES_KEY;
   aes_decrypt(aes_key, data + 6, data + 22, encrypted_size);
   uart_write_str(UART2, "passed decryption");
+  nl(UART2);
   int page = 0;
   
   while(encrypted_size - page * FLASH_PAGESIZE > FLASH_PAGESIZE){ // finally writes to flash memory
@@ -285,6 +290,8 @@ void load_firmware(void)
     page++;
   }
   program_flash(FW_BASE + page * FLASH_PAGESIZE, data + 22 + page * FLASH_PAGESIZE, encrypted_size - page * FLASH_PAGESIZE);
+  uart_write_str(UART2, "update complete");
+  nl(UART2);
 }
 
 
@@ -4,22 +4,27 @@ Bootloader Build Tool
 
 This tool is responsible for building the bootloader from source and copying
 the build outputs into the host tools directory for programming.
+
+With --devices (or --device-file) it provisions a batch of devices instead, each with its own AES
+key and signing key, recorded in a device key database (see key_db.py); with --images it also
+builds each device's bootloader:
+
+    python bl_build.py --devices dev-001,dev-002 --key-db device_keys.db --images images
 """
 import argparse
+import concurrent.futures
+import itertools
 import os
 import pathlib
+import re
 import shutil
+import struct
 import subprocess
 
-from Crypto.Cipher import AES
-from Crypto.PublicKey import RSA
-from Crypto.Hash import SHA256
-from Crypto.Util import Padding
-from Crypto.Signature import pkcs1_15
-from Crypto.Util.Padding import unpad
-import struct
+from rsa_montgomery import write_header
 
 FILE_DIR = pathlib.Path(__file__).parent.absolute() # defines the path to the file directory
+BOOTLOADER_IMAGE = FILE_DIR / '..' / 'bootloader' / 'gcc' / 'main.bin' # what compile_bootloader builds
 
 
 def copy_initial_firmware(binary_path):
@@ -43,62 +48,232 @@ def to_c_array(binary_string):
 	return "{" + ",".join([hex(c) for c in binary_string]) + "}"
 
 
-def make_bootloader():
+SIGNATURES = ('rsa', 'ed25519', 'p256') # signing schemes fw_protect can use (see fw_blob.py)
+
+
+def key_files(signature):
+    """
+    Returns: (secrets file, public key file) that make_bootloader writes the {signature} keys to.
+    The RSA keys are the ones the bootloader is built with, so the elliptic-curve keys go to files
+    of their own (secret_build_output_ed25519.txt, say) and never replace them.
+    """
+    if signature == 'rsa':
+        return 'secret_build_output.txt', 'public_key.pem'
+    return 'secret_build_output_{}.txt'.format(signature), 'public_key_{}.pem'.format(signature)
+
+
+def make_signing_key(signature):
+    """
+    Returns: a new private key for the {signature} scheme ('ed25519' or 'p256')
+    """
+    from Crypto.PublicKey import ECC
+    return ECC.generate(curve='ed25519' if signature == 'ed25519' else 'P-256')
+
+
+def generate_keys(signature='rsa'):
+    """
+    Returns: (aes_key, signing_key), a new 16 byte AES key and a new private key for the
+    {signature} scheme (a 2048-bit RSA key unless it is 'ed25519' or 'p256')
+    """
+    # PyCryptodome is only loaded for a build, so --help and the other tools stay quick to start
+    from Crypto.Cipher import AES
+    from Crypto.PublicKey import RSA
+
+    aes_key = AES.get_random_bytes(16) # generates a random 16 byte AES key
+    if signature != 'rsa':
+        return aes_key, make_signing_key(signature)
+    return aes_key, RSA.generate(2048)
+
+
+def pem(key):
+    """
+    Returns: {key} (RSA or elliptic-curve, private or public) as PEM bytes
+    """
+    exported = key.export_key(format='PEM')
+    return exported.encode() if isinstance(exported, str) else exported
+
+
+def compile_bootloader(aes_key, rsa_key, clean=True):
+    """
+    Compiles the bootloader with {aes_key} and the public half of {rsa_key} built in, and writes
+    the Montgomery constants of the RSA public key (R^2 mod n, -n^-1 mod 2^32) to
+    bootloader/src/rsa_constants.h. The header is generated for a future Montgomery-form verifier;
+    nothing in the bootloader includes it yet, and the bootloader still verifies with snakessl.
+    
+    The keys reach bootloader.c as -D defines, which make does not track, so with {clean} False
+    only bootloader.c is recompiled and the image relinked; the other objects do not depend on the
+    keys.
+    
+    Return:
+        True if make succeeded (the image is bootloader/gcc/main.bin), False otherwise.
+    """
+    bootloader = FILE_DIR / '..' / 'bootloader'
+    public_key = rsa_key.publickey()
+    write_header(bootloader / 'src' / 'rsa_constants.h', public_key)
+    
+    if clean:
+        subprocess.call('make clean', shell=True, cwd=bootloader) #allows us to pass in arguments to the make file
+    else:
+        for output in ('bootloader.o', 'main.axf', 'main.bin'):
+            (bootloader / 'gcc' / output).unlink(missing_ok=True)
+    #sets all variables in makefile according to the keys (the aes symmetric key, modulus, exponent, and exponent size)
+    status = subprocess.call(f'make KEY={to_c_array(aes_key)} MOD={to_c_array((public_key.n).to_bytes(256, "big"))} EXP={to_c_array(struct.pack(">Q", public_key.e))} E_SIZE=8', shell=True, cwd=bootloader)
+
+    # Return True if make returned 0, otherwise return False.
+    return (status == 0)
+
+
+def make_bootloader(signature='rsa'):
     """
     Build the bootloader from source.
     
-    This also loads all keys (symmetric and non-symmetric) into secret_build_output.txt
+    This also loads all keys (symmetric and non-symmetric) into secret_build_output.txt (see
+    compile_bootloader for the RSA constants header).
+
+    With {signature} 'ed25519' or 'p256' an elliptic-curve signing key and an AES key are written
+    to files of their own instead (see key_files), for fw_protect --secrets to make blobs with
+    64 byte signatures. bootloader.c only verifies RSA signatures, so no bootloader is built for
+    them and the RSA keys of the bootloader already built are left alone; the keys are for the host
+    tools and the bootloader model (bl_model.py).
 
     Return:
-        True if successful, False otherwise.
+        True if the bootloader was built, False otherwise.
     """
-    # Change into directory containing bootloader.
-    rsa_key = RSA.generate(2048) # generates a private RSA key object so that a public exponent and modulus can be created
-    #need to provision: RSA modulus, exponent, exponent size
-    
-    # public RSA modulus
-    modulus = rsa_key.publickey().n
-    # public RSA exponent
-    exponent = rsa_key.publickey().e
-    # size of exponent, for later use in authentication
-    exponent_size = 8
+    aes_key, signing_key = generate_keys(signature)
+    secrets_file, public_key_file = key_files(signature)
 
+    with open(secrets_file, 'wb+') as fh: # writes the AES and private key in the {secret_build_output.txt} file
+        fh.write(aes_key)                 # this allows the fw_protect tool to import these keys and encrypt/sign data
+        fh.write(pem(signing_key))
     
-    aes_key = AES.get_random_bytes(16) # generates a random 16 byte AES key
+    with open(public_key_file, 'wb') as fh: # the public key alone, for host tools that only check signatures
+        fh.write(pem(signing_key.public_key()))
 
+    if signature != 'rsa':
+        print("Wrote the {} signing key to {}; bootloader.c only verifies RSA, so the bootloader was not built".format(
+            signature, secrets_file))
+        return False
+    return compile_bootloader(aes_key, signing_key)
 
-    with open('secret_build_output.txt', 'wb+') as fh: # writes the AES and RSA private key in the {secret_build_output.txt} file
-        print("test")
-        fh.write(aes_key)                              # this allows the fw_protect tool to import these keys and encrypt/sign data
-        fh.write(rsa_key.export_key())
-        
-    bootloader = FILE_DIR / '..' / 'bootloader'
-    os.chdir(bootloader)
+
+DEVICE_ID = re.compile(r'[A-Za-z0-9_.-]+') # device IDs name image files, so they are kept to these
+
+
+def _device_keys(device_id, signature):
+    from fw_blob import key_fingerprint
+    from key_db import Device
+    aes_key, signing_key = generate_keys(signature)
+    public_key = signing_key.public_key()
+    return Device(device_id, signature, key_fingerprint(public_key), aes_key, pem(signing_key), pem(public_key),
+                  None, None)
+
+
+def provision(device_ids, db, image_dir=None, signature='rsa', workers=None):
+    """
+    Provisions every device in {device_ids} with its own AES key and signing key, and records them
+    in the key database {db} (a key_db.KeyDatabase).
     
+    Key generation (a 2048-bit RSA key above all) is the slow part, so the keys are generated in a
+    pool of {workers} processes (one per core if None). With an {image_dir}, each device's
+    bootloader is built as soon as its keys arrive, while the pool works on the rest, and copied to
+    {image_dir}/<device_id>.bin, readable by this user alone since it holds the device's keys. Only
+    the first build is a clean one; after it, only bootloader.c is recompiled (see
+    compile_bootloader). No images are built for elliptic-curve keys, which bootloader.c cannot
+    check.
     
-    subprocess.call('make clean', shell=True) #allows us to pass in arguments to the make file
-    #sets all variables in makefile according to ones above (the aes symmetric key, modulus, exponent, and exponent size)
-    status = subprocess.call(f'make KEY={to_c_array(aes_key)} MOD={to_c_array((rsa_key.publickey().n).to_bytes(256, "big"))} EXP={to_c_array(struct.pack(">Q", rsa_key.publickey().e))} E_SIZE=8', shell=True)
+    Throws a ValueError if a device ID is not made of letters, digits, '_', '.' and '-', or is
+    given twice.
+    
+    Return:
+        True if every image was built (or none was asked for), False if a build failed; the keys
+        generated until then are kept.
+    """
+    from Crypto.PublicKey import RSA
+    from key_db import private_file
 
-    # Return True if make returned 0, otherwise return False.
-    return (status == 0)
+    device_ids = list(device_ids)
+    for device_id in device_ids:
+        if not DEVICE_ID.fullmatch(device_id):
+            raise ValueError("Device ID {!r} may only hold letters, digits, '_', '.' and '-'".format(device_id))
+    if len(set(device_ids)) != len(device_ids):
+        raise ValueError("Device IDs must be unique")
+    build = image_dir is not None and signature == 'rsa'
+    if build:
+        image_dir = pathlib.Path(image_dir)
+        image_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        os.chmod(image_dir, 0o700) # mkdir leaves an existing directory as it was
+
+    chunksize = max(1, len(device_ids) // (4 * (workers or os.cpu_count() or 1)))
+    built = 0
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        devices = pool.map(_device_keys, device_ids, itertools.repeat(signature), chunksize=chunksize)
+        if not build:
+            db.put(list(devices)) # one transaction for the lot
+            return True
+        for device in devices:
+            db.put([device]) # the keys are kept even if the build fails
+            if not compile_bootloader(device.aes_key, RSA.import_key(device.private_key), clean=built == 0):
+                pool.shutdown(cancel_futures=True)
+                print("Building the bootloader for {} failed after {} images".format(device.device_id, built))
+                return False
+            image = image_dir / '{}.bin'.format(device.device_id)
+            with open(BOOTLOADER_IMAGE, 'rb') as src, open(private_file(image, truncate=True), 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            db.set_image(device.device_id, image)
+            built += 1
+    return True
+
+
+def read_device_ids(path):
+    """
+    Returns: the device IDs listed in the file at {path}, one per line; blank lines and lines
+    starting with '#' are skipped
+    """
+    with open(path) as fh:
+        return [line.strip() for line in fh if line.strip() and not line.lstrip().startswith('#')]
 
 
 if __name__ == '__main__':
     # some stuff for building the bootloader
     parser = argparse.ArgumentParser(description='Bootloader Build Tool')
     parser.add_argument("--initial-firmware", help="Path to the the firmware binary.", default=None)
+    parser.add_argument("--signature", help="Signing scheme for firmware blobs.", choices=SIGNATURES, default='rsa')
+    parser.add_argument("--devices", help="Comma-separated IDs of devices to provision with their own keys.",
+                        default=None)
+    parser.add_argument("--device-file", help="File of IDs of devices to provision, one per line.", default=None)
+    parser.add_argument("--key-db", help="Key database to record provisioned devices in.", default='device_keys.db')
+    parser.add_argument("--images", help="Directory for the per-device bootloader images (default: keys only).",
+                        default=None)
+    parser.add_argument("--workers", help="Processes to generate keys with (default: one per core).", type=int,
+                        default=None)
     args = parser.parse_args()
-    if args.initial_firmware is None:
-        binary_path = FILE_DIR / '..' / 'firmware' / 'firmware' / 'gcc' / 'main.bin'
-    else:
-        binary_path = os.path.abspath(pathlib.Path(args.initial_firmware))
+    device_ids = []
+    if args.devices is not None:
+        device_ids += [device_id.strip() for device_id in args.devices.split(',') if device_id.strip()]
+    if args.device_file is not None:
+        device_ids += read_device_ids(args.device_file)
+    provisioning = args.devices is not None or args.device_file is not None
+    # copy_initial_firmware changes directory, so paths given relative to this one are resolved first
+    key_db = os.path.abspath(args.key_db)
+    images = os.path.abspath(args.images) if args.images is not None else None
+
+    if not provisioning or images is not None:
+        if args.initial_firmware is None:
+            binary_path = FILE_DIR / '..' / 'firmware' / 'firmware' / 'gcc' / 'main.bin'
+        else:
+            binary_path = os.path.abspath(pathlib.Path(args.initial_firmware))
 
-    if not os.path.isfile(binary_path):
-        raise FileNotFoundError(
-            "ERROR: {} does not exist or is not a file. You may have to call \"make\" in the firmware directory.".format(
-                binary_path))
+        if not os.path.isfile(binary_path):
+            raise FileNotFoundError(
+                "ERROR: {} does not exist or is not a file. You may have to call \"make\" in the firmware directory.".format(
+                    binary_path))
 
-    copy_initial_firmware(binary_path)
-    make_bootloader()
-    
\ No newline at end of file
+        copy_initial_firmware(binary_path)
+    if provisioning:
+        from key_db import KeyDatabase
+        with KeyDatabase(key_db) as db:
+            ok = provision(device_ids, db, image_dir=images, signature=args.signature, workers=args.workers)
+        if ok:
+            print("Provisioned {} devices in {}".format(len(device_ids), args.key_db))
+        raise SystemExit(0 if ok else 1)
+    raise SystemExit(0 if make_bootloader(args.signature) else 1)
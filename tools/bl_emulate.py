@@ -2,12 +2,20 @@ import argparse
 import pathlib
 import os
 import pty
+import select
+import socket
 import subprocess
 import fcntl
 import threading
 import time
 
-from core.pseudo_serial import SocketSerial
+from uart_capture import BOOTLOADER_READY, CONSOLE_UARTS, ConsoleCapture, format_breakdown, phase_breakdown
+
+MONITOR_PATH = '/embsec/qemu-monitor' # unix socket of the QEMU monitor
+SNAPSHOT_DISK = '/embsec/snapshots.qcow2' # the board has no storage, so snapshots go on a scratch drive
+SNAPSHOT_NAME = 'ready' # VM snapshot taken while the bootloader waits for an instruction
+READY_TIMEOUT = 10 # seconds to wait for the bootloader to come up before taking the snapshot
+UART_PORTS = (13337, 13338, 13339) # TCP ports of QEMU's serial chardevs, UART0-2
 
 
 def set_nonblocking(fd):
@@ -26,36 +34,160 @@ def disable_local_echo(fd):
     termios.tcsetattr(fd, termios.TCSADRAIN, new)
 
 
-def connect_socks(ser, fd):
+def connect_qemu(port, timeout=READY_TIMEOUT):
+    """
+    Returns: a socket connected to the QEMU serial chardev listening on TCP {port}, once QEMU has
+    started listening (it waits for the connection before it runs the board)
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            sock = socket.create_connection(('127.0.0.1', port))
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise RuntimeError("QEMU did not open its serial port {} within {} seconds".format(port, timeout))
+            time.sleep(.05)
+            continue
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+
+def connect_socks(sock, fd, capture=None, uart=None):
+    """
+    Copies data between the QEMU socket {sock} and the PTY {fd}, and into {capture} (a
+    uart_capture.ConsoleCapture) as UART {uart} if one is given.
+
+    Both ends are waited on with select(), so bytes are passed on, and stamped for the capture, as
+    soon as they arrive rather than on the next turn of a polling loop.
+    """
     def _connect_socks():
         set_nonblocking(fd)
         disable_local_echo(fd)
-        while ser.isOpen():
-            if ser.isOpen():
-                data0 = ser.read(100, timeout=.1)
-                if len(data0):
-                    os.write(fd, data0)
-
-            try:
-                # return 1-n bytes or exception if no bytes
-                time.sleep(.1)
-                data1 = os.read(fd, 1024)
-                if len(data1):
-                    ser.write(data1)
-            except BlockingIOError:
-                pass
+        while True:
+            ready, _, _ = select.select([sock, fd], [], [])
+            at = time.monotonic()
+            if sock in ready:
+                data0 = sock.recv(4096)
+                if not data0: # QEMU has exited
+                    break
+                os.write(fd, data0)
+                if capture is not None:
+                    capture.feed(uart, 'rx', data0, at=at)
+            if fd in ready:
+                try:
+                    data1 = os.read(fd, 1024)
+                except BlockingIOError:
+                    continue
+                sock.sendall(data1)
+                if capture is not None:
+                    capture.feed(uart, 'tx', data1, at=at)
+        sock.close()
 
     t = threading.Thread(target=_connect_socks, daemon=True)
     t.start()
     return t
 
 
-def emulate(binary_path, debug=False):
+class QemuMonitor:
+    """
+    A connection to the human monitor interface of a running QEMU.
+
+    Arguments:
+    {path}: the monitor's unix socket
+    {timeout}: seconds to wait for QEMU to finish a command
+    """
+
+    PROMPT = b'(qemu) '
+
+    def __init__(self, path=MONITOR_PATH, timeout=READY_TIMEOUT):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self._read_prompt() # banner
+
+    def _read_prompt(self):
+        output = b''
+        while not output.endswith(self.PROMPT):
+            data = self.sock.recv(4096)
+            if not data:
+                raise ConnectionError("QEMU monitor closed the connection")
+            output += data
+        return output[:-len(self.PROMPT)].decode(errors='replace')
+
+    def command(self, cmd):
+        """
+        Returns: what QEMU printed in reply to {cmd} (without the echoed command)
+        """
+        self.sock.sendall(cmd.encode() + b'\n')
+        output = self._read_prompt()
+        # The monitor echoes the command line (with terminal escapes) before its reply
+        return output.split('\n', 1)[1] if '\n' in output else ''
+
+    def savevm(self, name):
+        """Saves the VM as snapshot {name}. Throws a RuntimeError if QEMU cannot."""
+        self._quiet_command(f'savevm {name}')
+
+    def loadvm(self, name):
+        """Restores the VM from snapshot {name}. Throws a RuntimeError if QEMU cannot."""
+        self._quiet_command(f'loadvm {name}')
+
+    def _quiet_command(self, cmd):
+        reply = self.command(cmd).strip()
+        if reply: # savevm and loadvm only print when something went wrong
+            raise RuntimeError(f'QEMU monitor: {cmd}: {reply}')
+
+    def close(self):
+        self.sock.close()
+
+
+def reset(monitor_path=MONITOR_PATH, name=SNAPSHOT_NAME):
+    """
+    Puts an emulator started with snapshot=True back to the moment the bootloader was ready for an
+    instruction, which takes milliseconds instead of starting QEMU again.
+    """
+    monitor = QemuMonitor(monitor_path)
+    try:
+        monitor.loadvm(name)
+    finally:
+        monitor.close()
+
+
+def wait_for_ready(console, timeout=READY_TIMEOUT):
+    """Waits until the bootloader has printed its welcome message on UART2."""
+    deadline = time.monotonic() + timeout
+    while not any(BOOTLOADER_READY in record.text for record in list(console.records) if record.uart == 2):
+        if time.monotonic() > deadline:
+            raise RuntimeError("Bootloader did not start within {} seconds".format(timeout))
+        time.sleep(.05)
+
+
+def emulate(binary_path, debug=False, capture=None, snapshot=False):
+    """
+    Runs the bootloader in QEMU with its UARTs on /embsec/UART0-2. With {capture} (a log path),
+    console lines from UART0 and UART2 are recorded with timestamps, and the time each update spent
+    in each phase is printed when the emulator is stopped.
+
+    With {snapshot}, QEMU gets a monitor on MONITOR_PATH and a scratch drive for VM snapshots, and
+    once the bootloader is waiting for an instruction the VM is saved as SNAPSHOT_NAME. Call reset()
+    to go back to that point instead of restarting the emulator.
+    """
+    if debug and snapshot:
+        raise ValueError("Cannot take a snapshot while the emulator waits for GDB")
     cmd = ['qemu-system-arm', '-M', 'lm3s6965evb', '-nographic', '-kernel', binary_path]
     if debug:
         cmd.extend(['-s', '-S'])
+    if snapshot:
+        if not os.path.exists(SNAPSHOT_DISK):
+            subprocess.check_call(['qemu-img', 'create', '-f', 'qcow2', SNAPSHOT_DISK, '1M'],
+                                  stdout=subprocess.DEVNULL)
+        try:
+            os.unlink(MONITOR_PATH)
+        except FileNotFoundError:
+            pass
+        cmd.extend(['-drive', f'if=none,format=qcow2,file={SNAPSHOT_DISK}',
+                    '-monitor', f'unix:{MONITOR_PATH},server,nowait'])
     ports = []
-    for idx, port in enumerate([13337, 13338, 13339]):
+    for idx, port in enumerate(UART_PORTS):
         cmd.extend(['-serial', f'tcp:0.0.0.0:{port},server'])
         name = f'/embsec/UART{idx}'
         ports.append((port, name))
@@ -63,8 +195,9 @@ def emulate(binary_path, debug=False):
     subprocess.call(['pkill', 'qemu'])
     subprocess.Popen(cmd)
 
+    console = ConsoleCapture(capture) if capture is not None or snapshot else None
     ts = []
-    for port, name in ports:
+    for idx, (port, name) in enumerate(ports):
         master, slave = pty.openpty()
         s_name = os.ttyname(slave)
         try:
@@ -73,20 +206,42 @@ def emulate(binary_path, debug=False):
             pass
         os.symlink(s_name, name)
 
-        ts.append(connect_socks(SocketSerial(name, port, log=False), master))
+        ts.append(connect_socks(connect_qemu(port), master,
+                                capture=console if idx in CONSOLE_UARTS else None, uart=idx))
         print(f'{name} is open')
 
-    [t.join() for t in ts]
+    if snapshot:
+        wait_for_ready(console)
+        monitor = QemuMonitor()
+        monitor.savevm(SNAPSHOT_NAME)
+        monitor.close()
+        print(f'Saved snapshot {SNAPSHOT_NAME}; reset with bl_emulate.py --reset')
+
+    try:
+        [t.join() for t in ts]
+    finally:
+        if console is not None:
+            console.close()
+            for update in phase_breakdown(console.records):
+                print(format_breakdown(update))
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Stellaris Emulator')
     parser.add_argument("--boot-path", help="Path to the the bootloader binary.", default=None)
     parser.add_argument("--debug", help="Start GDB server and break on first instruction", action='store_true')
+    parser.add_argument("--capture", help="Log UART0 and UART2 console lines with timestamps to this file",
+                        default=None)
+    parser.add_argument("--snapshot", help="Snapshot the VM once the bootloader is ready, for fast resets",
+                        action='store_true')
+    parser.add_argument("--reset", help="Restore the snapshot in the running emulator and exit", action='store_true')
     args = parser.parse_args()
+    if args.reset:
+        reset()
+        raise SystemExit(0)
     if args.boot_path is None:
         binary_path = pathlib.Path(__file__).parent / '..' / 'bootloader' / 'gcc' / 'main.axf'
     else:
         binary_path = pathlib.Path(args.boot_path)
 
-    emulate(binary_path.resolve(), debug=args.debug)
+    emulate(binary_path.resolve(), debug=args.debug, capture=args.capture, snapshot=args.snapshot)
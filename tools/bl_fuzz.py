@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+"""
+Bootloader Protocol Fuzzer
+
+Feeds mutated updates to bl_model.BootloaderModel, the host-side copy of load_firmware(), to find
+inputs that get past its bounds checks: frame lengths of zero or past 22 + size(F), data after
+the last frame, and size(F) fields that are not a multiple of 16 or larger than
+MAX_ENCRYPTED_DATA_SIZE. The model runs in-process, so a worker gets through thousands of
+updates a second where QEMU manages a handful.
+
+Each input is a case, a list of the units the host writes, one write() per unit:
+
+    raw     bytes as they are (the instruction, the signature, metadata and IV of a 'U' update)
+    frame   a 'U' frame: its length field and data
+    seq     a sequenced frame: its length field, sequence number, data and CRC
+
+A unit's 'length' is None when the length field matches the data. Its 'crc' is XORed into the
+correct CRC. 'gap' is the number of seconds the line is idle before the unit is written. 'meta'
+is the offset of the metadata in the unit's data, if the unit holds it. The seed cases are the
+updates fw_update would send for valid blobs from fw_protect. Mutations change frame lengths,
+header fields, sequence numbers, CRCs and idle gaps, and drop, repeat, reorder, split, merge,
+truncate and corrupt units.
+
+A run fails if the model throws an exception, or if it installs firmware that none of the seed
+blobs carries (when a public key is given), or firmware whose size(F) breaks the bootloader's
+rules. Inputs that end the update in a way no input has before (status and last console line) are
+kept to mutate further. Each failure is minimised, by dropping units and shrinking and resetting
+fields while the failure still reproduces, and written out with the digests of the seed firmware so
+that --replay can run it again under the same checks.
+"""
+import argparse
+import collections
+import hashlib
+import json
+import os
+import random
+import re
+import struct
+import time
+import traceback
+
+import bl_model
+from bl_model import BootloaderModel, MAX_ENCRYPTED_DATA_SIZE, MAX_FRAME_LENGTH, crc16
+from flash_model import FlashModel
+from fw_blob import import_key, load_public_key, parse_blob
+
+FRAME_SIZE = 64 # bytes of F per frame in the seed cases, as fw_update sends them
+GAP = 0.001 # seconds between units, well inside bl_model.FRAME_GAP
+IDLE_GAP = 2 * bl_model.FRAME_GAP # long enough for the model to drop a partial frame
+SESSION_GAP = bl_model.SESSION_TIMEOUT + 1 # long enough for the model to put a transfer aside
+MAX_MUTATIONS = 4 # mutations stacked on one input
+MAX_CORPUS = 512 # inputs a worker keeps to mutate
+MINIMISE_BUDGET = 2000 # runs spent minimising one failure
+
+INSTRUCTIONS = b'UBSRD'
+
+
+def unit(kind, data=b'', gap=GAP, length=None, sequence=0, crc=0, meta=None):
+    """Returns: a unit of a case (see the module docstring)"""
+    return {'kind': kind, 'data': bytes(data), 'gap': gap, 'length': length, 'sequence': sequence, 'crc': crc,
+            'meta': meta}
+
+
+def encode(item):
+    """Returns: the bytes the host writes for the unit {item}"""
+    data = item['data']
+    length = len(data) if item['length'] is None else item['length']
+    if item['kind'] == 'frame':
+        return struct.pack('>H', length) + data
+    if item['kind'] == 'seq':
+        header = struct.pack('>HH', length, item['sequence'] & 0xFFFF)
+        return header + data + struct.pack('>H', crc16(header + data) ^ item['crc'])
+    return data
+
+
+def seed_cases(firmware_blob, frame_size=FRAME_SIZE):
+    """
+    Returns: the cases fw_update would send for {firmware_blob}: a 'U' update (only if the blob has
+    no typed prefix, as for bootloader.c) and a sequenced one
+    """
+    blob = parse_blob(firmware_blob)
+    firmware = bytes(blob.firmware)
+    chunks = [firmware[i: i + frame_size] for i in range(0, len(firmware), frame_size)]
+    cases = []
+    if not blob.prefix and not blob.segment_map:
+        cases.append([unit('raw', b'U'), unit('raw', blob.signature), unit('raw', blob.metadata, meta=0),
+                      unit('raw', blob.iv)] + [unit('frame', chunk) for chunk in chunks] + [unit('frame')])
+    header = bytes(firmware_blob[:blob.header_length])
+    seq = [unit('seq', header, sequence=0, meta=len(blob.prefix) + len(blob.signature))]
+    seq += [unit('seq', chunk, sequence=i) for i, chunk in enumerate(chunks, 1)]
+    seq.append(unit('seq', sequence=len(chunks) + 1))
+    cases.append([unit('raw', b'S')] + seq)
+    return cases
+
+
+def fit_size(case):
+    """
+    Returns: a copy of {case} with the size(F) field of its header set to the number of bytes of F
+    its frames carry, so that a mutated case gets past the length checks to what lies behind them
+    """
+    case = [dict(item) for item in case]
+    size = sum(len(item['data']) for item in case if item['kind'] != 'raw' and item['meta'] is None) & 0xFFFF
+    for item in case:
+        if item['meta'] is not None and len(item['data']) >= item['meta'] + 6:
+            data = bytearray(item['data'])
+            struct.pack_into('<H', data, item['meta'] + 4, size)
+            item['data'] = bytes(data)
+    return case
+
+
+def _interesting(value, rng):
+    return rng.choice([0, 1, 15, 16, 17, value - 16, value - 1, value + 1, value + 16, MAX_ENCRYPTED_DATA_SIZE,
+                       MAX_ENCRYPTED_DATA_SIZE + 16, 0xFFFF, rng.randrange(0x10000)]) & 0xFFFF
+
+
+def _framed(case):
+    return [i for i, item in enumerate(case) if item['kind'] != 'raw']
+
+
+def mutate(case, rng):
+    """
+    Returns: a copy of {case} with one random mutation applied
+    """
+    case = [dict(item) for item in case]
+    framed = _framed(case)
+    op = rng.randrange(14)
+    if op == 0 and framed: # frame length field
+        item = case[rng.choice(framed)]
+        item['length'] = rng.choice([0, len(item['data']) - 1, len(item['data']) + 1, len(item['data']) + 16,
+                                     MAX_FRAME_LENGTH + 1, 0xFFFF, rng.randrange(0x10000)]) & 0xFFFF
+    elif op == 1 and rng.random() < 0.3: # size(F) that matches the frames
+        case = fit_size(case)
+    elif op == 1: # header field
+        headers = [item for item in case if item['meta'] is not None and len(item['data']) >= item['meta'] + 6]
+        if headers:
+            item = rng.choice(headers)
+            fields = list(struct.unpack_from('<HHH', item['data'], item['meta']))
+            field = rng.randrange(3)
+            fields[field] = _interesting(fields[field], rng)
+            data = bytearray(item['data'])
+            struct.pack_into('<HHH', data, item['meta'], *fields)
+            item['data'] = bytes(data)
+    elif op == 2 and len(case) > 1: # drop a unit
+        del case[rng.randrange(1, len(case))]
+    elif op == 3: # repeat a unit
+        i = rng.randrange(len(case))
+        case.insert(i, dict(case[i]))
+    elif op == 4 and len(case) > 2: # reorder
+        i = rng.randrange(1, len(case) - 1)
+        case[i], case[i + 1] = case[i + 1], case[i]
+    elif op == 5 and framed: # split a frame in two
+        i = rng.choice(framed)
+        item = case[i]
+        if len(item['data']) > 1:
+            cut = rng.randrange(1, len(item['data']))
+            second = dict(item, data=item['data'][cut:], meta=None, sequence=item['sequence'] + 1)
+            item['data'] = item['data'][:cut]
+            case.insert(i + 1, second)
+    elif op == 6 and len(framed) > 1: # merge a frame with the next
+        i = rng.choice(framed[:-1])
+        if case[i + 1]['kind'] == case[i]['kind']:
+            case[i]['data'] += case.pop(i + 1)['data']
+    elif op == 7: # flip bits
+        item = case[rng.randrange(len(case))]
+        if item['data']:
+            data = bytearray(item['data'])
+            for _ in range(rng.randint(1, 4)):
+                data[rng.randrange(len(data))] ^= 1 << rng.randrange(8)
+            item['data'] = bytes(data)
+    elif op == 8: # truncate
+        item = case[rng.randrange(len(case))]
+        item['data'] = item['data'][:rng.randrange(len(item['data']) + 1)]
+    elif op == 9: # trailing data after the end
+        kind = case[-1]['kind'] if case[-1]['kind'] != 'raw' else 'frame'
+        case.append(unit(kind, bytes(rng.randrange(256) for _ in range(rng.choice([1, 16, 64]))),
+                         sequence=case[-1]['sequence'] + 1))
+    elif op == 10 and framed: # sequence number
+        item = case[rng.choice(framed)]
+        item['sequence'] = rng.choice([item['sequence'] - 1, item['sequence'] + 1, 0, 0xFFFF,
+                                       rng.randrange(0x10000)]) & 0xFFFF
+    elif op == 11 and framed: # CRC
+        case[rng.choice(framed)]['crc'] = rng.randrange(1, 0x10000)
+    elif op == 12: # idle line
+        case[rng.randrange(len(case))]['gap'] = rng.choice([IDLE_GAP, SESSION_GAP])
+    else: # instruction byte, or stray bytes between units
+        if rng.random() < 0.5:
+            case[0]['data'] = bytes([rng.choice(INSTRUCTIONS) if rng.random() < 0.8 else rng.randrange(256)])
+        else:
+            case.insert(rng.randrange(1, len(case) + 1),
+                        unit('raw', bytes(rng.randrange(256) for _ in range(rng.randint(1, 8)))))
+    return case
+
+
+def execute(case, public_key=None):
+    """
+    Runs {case} against a new BootloaderModel (with a FlashModel).
+
+    Returns: the model after the last unit
+    """
+    # Units with no idle line between them go in one write(): the model cannot tell the difference,
+    # and it saves most of the per-write work
+    writes = []
+    for item in case:
+        if writes and item['gap'] <= bl_model.FRAME_GAP:
+            writes[-1][1].append(encode(item))
+        else:
+            writes.append((item['gap'], [encode(item)]))
+    now = [0.0]
+    model = BootloaderModel(public_key=public_key, clock=lambda: now[0], flash=FlashModel())
+    for gap, data in writes:
+        now[0] += gap
+        model.write(b''.join(data))
+        model.read(model.in_waiting)
+    return model
+
+
+def outcome(model):
+    """
+    Returns: how the update ended: the model's status and its last console line with numbers
+    taken out ('booted' if the case booted the firmware, whose release message is still encrypted)
+    """
+    last = 'booted' if model.booted else model.console[-1] if model.console else ''
+    return model.status, re.sub(r'0x[0-9a-f]+|\d+', '#', last)
+
+
+def check(model, accepted):
+    """
+    Returns: what is wrong with the state {model} was left in, or None
+
+    Arguments:
+    {accepted}: the SHA-256 digests of the F sections the model may install, or None to allow any
+    """
+    firmware = model.firmware # F itself (the fuzzer's models have no AES key), kept after later transfers
+    if not firmware:
+        return None
+    if len(firmware) % 16 or len(firmware) > MAX_ENCRYPTED_DATA_SIZE:
+        return "installed an F whose size breaks the size(F) rules"
+    if accepted is not None and hashlib.sha256(firmware).hexdigest() not in accepted:
+        return "installed firmware that no seed blob carries"
+    return None
+
+
+def run_case(case, public_key=None, accepted=None):
+    """
+    Runs {case} and checks the result.
+
+    Returns: (failure, outcome): failure is a short description that identifies the failure (the
+    exception and where it was thrown, with the numbers in its message taken out, or what check()
+    found), or None if the run was clean
+    """
+    try:
+        model = execute(case, public_key)
+    except Exception as e: # anything the model throws is a bug in it
+        frame = traceback.extract_tb(e.__traceback__)[-1]
+        return '{} at {}:{}: {}'.format(type(e).__name__, os.path.basename(frame.filename), frame.lineno,
+                                        re.sub(r'\d+', '#', str(e))), None
+    return check(model, accepted), outcome(model)
+
+
+def minimise(case, failure, public_key=None, accepted=None, budget=MINIMISE_BUDGET):
+    """
+    Returns: the smallest case found that still fails with {failure}, within {budget} runs. Units
+    are dropped, their data halved and their fields reset, each with the size(F) field left alone
+    and refitted to the frames that are left (see fit_size).
+    """
+    runs = [0]
+
+    def smaller(candidate):
+        for attempt in (candidate, fit_size(candidate)):
+            if runs[0] >= budget:
+                return None
+            runs[0] += 1
+            if run_case(attempt, public_key, accepted)[0] == failure:
+                return attempt
+        return None
+
+    progress = True
+    while progress and runs[0] < budget:
+        progress = False
+        i = len(case) - 1
+        while i > 0 and runs[0] < budget: # the instruction stays
+            found = smaller(case[:i] + case[i + 1:])
+            if found is not None:
+                case, progress = found, True
+            i = min(i, len(case)) - 1
+        for i in range(len(case)):
+            for change in ({'data': case[i]['data'][:len(case[i]['data']) // 2]}, {'gap': GAP}, {'crc': 0},
+                           {'length': None}):
+                if all(case[i][key] == value for key, value in change.items()):
+                    continue
+                found = smaller(case[:i] + [dict(case[i], **change)] + case[i + 1:])
+                if found is not None:
+                    case, progress = found, True
+    return case
+
+
+def fuzz_worker(seeds, accepted, key_der, duration, seed):
+    """
+    Fuzzes for {duration} seconds from the cases {seeds}, with random.Random({seed}).
+
+    Returns: a dictionary with the number of 'executions', how often each outcome was seen in
+    'outcomes' and the minimised case of each distinct failure in 'failures'
+    """
+    public_key = import_key(key_der) if key_der is not None else None
+    rng = random.Random(seed)
+    corpus = list(seeds)
+    seen = collections.Counter()
+    failures = {}
+    executions = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        case = rng.choice(corpus)
+        for _ in range(rng.randint(1, MAX_MUTATIONS)):
+            case = mutate(case, rng)
+        failure, result = run_case(case, public_key, accepted)
+        executions += 1
+        if failure is not None:
+            if failure not in failures:
+                failures[failure] = case
+            continue
+        if result not in seen and len(corpus) < MAX_CORPUS:
+            corpus.append(case)
+        seen[result] += 1
+    failures = {failure: minimise(case, failure, public_key, accepted) for failure, case in failures.items()}
+    return {'executions': executions, 'outcomes': [(list(key), count) for key, count in seen.items()],
+            'failures': failures}
+
+
+def fuzz(blobs, public_key=None, workers=None, duration=10, seed=None, frame_size=FRAME_SIZE):
+    """
+    Fuzzes the model from valid {blobs} over a pool of {workers} processes (one per core if None)
+    for {duration} seconds.
+
+    Returns: a dictionary with the total 'executions', 'elapsed' seconds, 'workers', the
+    'outcomes' seen (status and console line -> count), the distinct 'failures' (description ->
+    minimised case) and the SHA-256 digests of the F sections the model was allowed to install in
+    'accepted' (None without a public key)
+
+    Throws a ValueError if a blob is not installed by the model as it is (signed with another key,
+    say), since mutations of it would then say nothing.
+    """
+    import concurrent.futures
+    seeds = [case for blob in blobs for case in seed_cases(blob, frame_size)]
+    for case in seeds:
+        failure, result = run_case(case, public_key)
+        if failure is not None or result[0] != 'installed':
+            raise ValueError("A seed blob is not installed by the model: {}".format(failure or ' '.join(result)))
+    accepted = None
+    if public_key is not None:
+        accepted = {hashlib.sha256(bytes(parse_blob(blob).firmware)).hexdigest() for blob in blobs}
+    key_der = public_key.export_key(format='DER') if public_key is not None else None
+    workers = workers or os.cpu_count() or 1
+    rng = random.Random(seed)
+
+    started = time.monotonic()
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        results = list(pool.map(fuzz_worker, *zip(*[(seeds, accepted, key_der, duration, rng.getrandbits(64))
+                                                    for _ in range(workers)])))
+    outcomes = collections.Counter()
+    failures = {}
+    for result in results:
+        outcomes.update({tuple(key): count for key, count in result['outcomes']})
+        for failure, case in result['failures'].items():
+            if failure not in failures or len(case) < len(failures[failure]):
+                failures[failure] = case
+    return {'executions': sum(result['executions'] for result in results), 'elapsed': time.monotonic() - started,
+            'workers': workers, 'outcomes': outcomes, 'failures': failures, 'accepted': accepted}
+
+
+def save_failures(path, failures, accepted=None):
+    """
+    Writes {failures} (description -> case) to {path} as JSON, with unit data in hex, and the
+    {accepted} digests the cases were checked against (see check()).
+    """
+    with open(path, 'w') as fp:
+        json.dump({'accepted': sorted(accepted) if accepted is not None else None,
+                   'failures': [{'failure': failure, 'case': [dict(item, data=item['data'].hex()) for item in case]}
+                                for failure, case in failures.items()]}, fp, indent=1)
+
+
+def load_failures(path):
+    """
+    Returns: the failures saved by save_failures() to {path}, and the digests they were checked
+    against (None if any firmware was allowed)
+    """
+    with open(path) as fp:
+        saved = json.load(fp)
+    if isinstance(saved, list): # written before the digests were kept
+        saved = {'accepted': None, 'failures': saved}
+    failures = {entry['failure']: [dict(item, data=bytes.fromhex(item['data'])) for item in entry['case']]
+                for entry in saved['failures']}
+    accepted = set(saved['accepted']) if saved['accepted'] is not None else None
+    return failures, accepted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bootloader Protocol Fuzzer')
+    parser.add_argument("--firmware", help="Valid firmware blob to mutate (may be repeated).", action='append',
+                        default=[])
+    parser.add_argument("--public-key", help="Public key (or bl_build secrets) the model checks signatures "
+                        "with; without it, any firmware may be installed.", default=None)
+    parser.add_argument("--duration", help="Seconds to fuzz for.", type=float, default=10)
+    parser.add_argument("--workers", help="Processes to fuzz with (default: one per core).", type=int, default=None)
+    parser.add_argument("--seed", help="Seed for the mutations.", type=int, default=None)
+    parser.add_argument("--frame-size", help="Bytes of F per frame in the seed updates.", type=int,
+                        default=FRAME_SIZE)
+    parser.add_argument("--out", help="Where to write the minimised failing inputs.", default='bl_fuzz_failures.json')
+    parser.add_argument("--replay", help="Run the failing inputs saved in this file again.", default=None)
+    args = parser.parse_args()
+    public_key = load_public_key(args.public_key) if args.public_key else None
+
+    if args.replay is not None:
+        failures, accepted = load_failures(args.replay)
+        if accepted is not None and public_key is None:
+            parser.error("the failures were found with a public key; give it with --public-key")
+        for failure, case in failures.items():
+            print('{}\n  now: {}'.format(failure, run_case(case, public_key, accepted)[0] or 'passes'))
+            for item in case:
+                print('  {:<5} gap {:<5} {}'.format(item['kind'], item['gap'], encode(item)[:48].hex()))
+        raise SystemExit(0)
+
+    if not args.firmware:
+        parser.error("give at least one --firmware blob")
+    blobs = []
+    for path in args.firmware:
+        with open(path, 'rb') as fp:
+            blobs.append(fp.read())
+    report = fuzz(blobs, public_key, workers=args.workers, duration=args.duration, seed=args.seed,
+                  frame_size=args.frame_size)
+    print('{} executions by {} workers in {:.1f} s ({:.0f} per second)'.format(
+        report['executions'], report['workers'], report['elapsed'], report['executions'] / report['elapsed']))
+    for (status, line), count in report['outcomes'].most_common():
+        print('  {:>8}  {:<12} {}'.format(count, status, line))
+    if report['failures']:
+        save_failures(args.out, report['failures'], report['accepted'])
+        print('{} failures, minimised and written to {}:'.format(len(report['failures']), args.out))
+        for failure, case in report['failures'].items():
+            print('  {} ({} units)'.format(failure, len(case)))
+    raise SystemExit(1 if report['failures'] else 0)
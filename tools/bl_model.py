@@ -0,0 +1,706 @@
+#!/usr/bin/env python
+"""
+Bootloader Model
+
+A host-side model of the bootloader's update protocol, following load_firmware() in
+bootloader/src/bootloader.c step by step, so the host tools can be exercised without a board or QEMU.
+
+The model looks like a serial port from the host's side: the host write()s bytes to it and read()s
+the bootloader's responses back. Responses are queued as soon as the bytes that cause them have been
+written, and read() returns b'' when nothing is queued, just like a serial read that timed out.
+
+Besides the 'U' protocol of bootloader.c, the model speaks a sequenced protocol, started with 'S',
+in which everything after the handshake is sent in numbered frames protected by a CRC:
+
+[ 0x02 ]   [ 0x02 ]   [ variable ]  [ 0x02 ]
+---------------------------------------------
+| Length | Sequence | Data...     | CRC-16 |
+---------------------------------------------
+
+Frame 0 carries signed(hash(metadata | IV | F)) | metadata | IV, the following frames carry F, and a
+frame with no data ends the transfer. The CRC is CRC-16/CCITT (initial value 0xFFFF) over the length,
+sequence and data. Every frame is answered with a status byte and the low byte of its sequence
+number, followed by the complement of each (see reply()): OK, NAK if the frame was damaged (the host
+sends it again), or ERROR if the update was rejected. OK and ERROR differ by one bit, so the
+complements let the host tell a damaged response from a real one and send the frame again instead of
+giving up. A repeat of the last accepted frame is acknowledged again without being stored, so a lost
+OK costs one retransmission. When the line has been idle for FRAME_GAP seconds the model drops any
+partial frame, which is how it finds the start of the next frame after a damaged length field.
+
+The OK for the empty frame can be lost too. Until the line has been quiet for SESSION_TIMEOUT
+seconds after a transfer ends, a repeat of its empty frame is acknowledged again. Its first byte,
+0x00, is never an instruction, so anything else ends the wait and is taken as one.
+
+If the line stays idle for SESSION_TIMEOUT seconds in the middle of a sequenced transfer, the model
+puts the transfer aside and goes back to waiting for an instruction. A host can then pick it up
+again with 'R' followed by the SHA-256 of frame 0. If that matches the transfer that was put aside,
+the model answers 'R', the sequence number of the next frame it expects and the number of bytes of F
+it already has (>HI), and carries on from there; otherwise it answers 'R' with both set to zero
+and starts a new transfer as if it had been sent 'S'.
+
+To update only the flash pages that changed, a host first sends 'D' and a page count (>H); the model
+answers 'D', the count and a PAGE_DIGEST_LENGTH byte digest for each of that many pages from
+FW_BASE. A digest is HMAC-SHA256 of the page number and page under a key derived from the AES key
+(see fw_blob.page_digests), so it tells nobody without the key anything about the firmware; a model
+with no AES key reports no pages, and the host sends them all. Frame 0 of the sequenced transfer then carries a bitmap after the IV, one bit per page of F
+(least significant bit first), and the frames that follow carry F for the marked pages only. For
+every page that was left out the model re-encrypts what it already has in flash, chaining from the
+ciphertext before it, so the signature is still checked over the whole of metadata | IV | F. Only the
+marked pages are programmed.
+
+Frame 0 may also start with the typed prefix of fw_blob.py: MAGIC, the signature type and the
+cipher. The signature that follows is 256 bytes for RSA or 64 bytes for Ed25519 and ECDSA P-256,
+and is checked over prefix | metadata | IV | F. The 'U' protocol only takes blobs without the
+prefix, as bootloader.c does.
+
+If the prefix names the GCM cipher, F is a run of segments that each carry a tag (see fw_blob.py).
+The model opens every segment as soon as all of it has arrived, as gcm_decrypt_and_verify() in
+beaverssl.c would, and rejects the update at the first segment whose tag does not match instead of
+waiting for the whole of F. The signature is still checked before anything is programmed. GCM
+transfers cannot skip pages.
+
+If the cipher byte has FLAG_SEGMENTS set, a segment map follows the metadata and is signed with it.
+f is then made of runs that are each programmed at the address the map gives, starting on a flash
+page, so a sparse image is sent without its gaps. These transfers cannot skip pages either.
+
+f = unencrypted firmware
+F = encrypted firmware
+metadata = version | size(f) | size(F)
+signed(hash(metadata | IV | F)) | metadata | IV | F
+"""
+import binascii
+import collections
+import hashlib
+import hmac
+import struct
+import time
+
+# Protocol Constants (same values as bootloader.c)
+OK = b'\x00'
+ERROR = b'\x01'
+NAK = b'\x02'
+UPDATE = b'U'
+BOOT = b'B'
+SEQUENCED = b'S'
+RESUME = b'R'
+DIGESTS = b'D'
+
+SIGNATURE_LENGTH = 256 # the RSA signature is 256 bytes long
+METADATA_LENGTH = 6 # version | size(f) | size(F)
+IV_LENGTH = 16 # the IV is 16 bytes long
+HEADER_LENGTH = METADATA_LENGTH + IV_LENGTH # bytes of the receive buffer before F
+MAX_ENCRYPTED_DATA_SIZE = 31744 # largest size(F) the receive buffer can hold
+
+# Typed prefix of a sequenced frame 0 (same values as fw_blob.py)
+MAGIC = b'EMBS'
+PREFIX_LENGTH = len(MAGIC) + 2 # MAGIC | signature type | cipher
+SIG_RSA = 0
+SIG_ED25519 = 1
+SIG_P256 = 2
+SIGNATURE_LENGTHS = {SIG_RSA: SIGNATURE_LENGTH, SIG_ED25519: 64, SIG_P256: 64}
+CIPHER_CBC = 0
+CIPHER_GCM = 1
+FLAG_SEGMENTS = 0x80 # set in the cipher byte when a segment map follows the metadata
+MAX_SEGMENTS = 64
+GCM_TAG_LENGTH = 16
+GCM_SEGMENT_LENGTH = 1024 # bytes of F per GCM segment, tag included
+
+INITIAL_VERSION = 2 # version of the firmware embedded in the bootloader
+
+# Flash layout (same values as bootloader.c)
+METADATA_BASE = 0xFC00
+FW_BASE = 0x10000
+FW_LIMIT = 0x40000 # end of flash
+FLASH_PAGESIZE = 1024
+FLASH_PAGES = (MAX_ENCRYPTED_DATA_SIZE + FLASH_PAGESIZE - 1) // FLASH_PAGESIZE # pages F can occupy
+
+FRAME_HEADER_LENGTH = 4 # length | sequence
+FRAME_CRC_LENGTH = 2
+MAX_FRAME_LENGTH = 1024 # longest data section a sequenced frame may carry
+FRAME_GAP = 0.02 # seconds of idle line after which a partial frame is dropped
+SESSION_TIMEOUT = 5 # seconds of idle line after which a sequenced transfer is put aside
+DIGEST_LENGTH = 32 # SHA-256 of frame 0, which identifies a transfer when resuming
+PAGE_DIGEST_LENGTH = 8 # bytes of HMAC-SHA256 sent per flash page
+PAGE_DIGEST_LABEL = b'EMBS page digest' # what the page digest key is derived from the AES key with
+REPLY_LENGTH = 4 # status | sequence | ~status | ~sequence
+
+
+class LineIdle(Exception):
+    """Thrown into the receive loop when the line goes idle in the middle of a frame."""
+
+
+class SessionIdle(Exception):
+    """Thrown into the receive loop when the host has gone quiet in the middle of a transfer."""
+
+
+def crc16(data):
+    """
+    Returns: the CRC-16/CCITT of {data} with an initial value of 0xFFFF
+    """
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+def reply(status, ack=b''):
+    """
+    Returns: the response {status} to a 'U' transfer step, or, given the {ack} byte (the low byte of
+    a sequenced frame's sequence number), the sequenced response: status | ack | ~status | ~ack
+    """
+    if not ack:
+        return status
+    return status + ack + bytes([~status[0] & 0xFF, ~ack[0] & 0xFF])
+
+
+class BootloaderModel:
+    """
+    Models one bootloader on the other end of a serial line.
+
+    Arguments:
+    {aes_key}: AES key used to decrypt F, or None to keep F encrypted
+    {public_key}: public key the signature is checked against (RSA, Ed25519 or P-256), or None to
+        skip the check
+    {version}: version of the firmware that is already installed
+    {clock}: function returning the current time in seconds, used to notice an idle line
+        (serial_sim.SimulatedSerial points this at its own clock)
+    {flash}: a flash_model.FlashModel to program the metadata and firmware into, as
+        load_firmware() does, or None
+
+    After every update {status} is one of 'installed', 'rejected' (bad metadata or framing),
+    'unauthenticated' (signature check failed), 'suspended' (the host went quiet part way through a
+    sequenced transfer) or 'receiving' while a transfer is in progress.
+    """
+
+    def __init__(self, aes_key=None, public_key=None, version=INITIAL_VERSION, clock=time.monotonic, flash=None):
+        self.aes_key = aes_key
+        self.public_key = public_key
+        self.version = version
+        self.clock = clock
+        self.flash = flash
+        self.size = 0
+        self.firmware = b'' # the decrypted firmware (and release message) of the last good update
+        self.status = 'idle'
+        self.booted = False
+        self.console = collections.deque(maxlen=256) # what the bootloader prints on UART2
+        self._out = bytearray()
+        self.reset()
+
+    def reset(self):
+        """SysCtlReset(): drops any partial transfer and waits for a new instruction."""
+        self._pending = bytearray()
+        self._suspended = None # a sequenced transfer that can be resumed
+        self._linger = None # (end frame, its response, until when) of the sequenced transfer that just ended
+        self._in_session = False # in the middle of a sequenced transfer
+        self._in_frame = False # waiting for (part of) a sequenced frame
+        self._discarding = False # dropping input until the line goes idle
+        self._last_rx = None
+        self._machine = self._main()
+        self._want = next(self._machine)
+
+    # Serial interface
+
+    @property
+    def in_waiting(self):
+        return len(self._out)
+
+    def write(self, data):
+        """
+        Feeds bytes from the host into the bootloader.
+
+        Returns: the number of bytes written
+        """
+        data = bytes(data)
+        received_at = self.clock()
+        quiet = received_at - self._last_rx if self._last_rx is not None else 0
+        idle = quiet > FRAME_GAP
+        self._last_rx = received_at
+        if self._in_session and quiet > SESSION_TIMEOUT:
+            self._pending.clear()
+            self._discarding = False
+            self._want = self._machine.throw(SessionIdle)
+        elif self._discarding:
+            if not idle:
+                return len(data)
+            self._discarding = False
+            self._pending.clear()
+        elif idle and self._in_frame:
+            self._pending.clear()
+            self._want = self._machine.throw(LineIdle)
+
+        pos = 0
+        while pos < len(data):
+            if not self._pending and len(data) - pos >= self._want: # all of it is here, no need to buffer
+                received = data[pos: pos + self._want]
+                pos += self._want
+            else:
+                chunk = data[pos: pos + self._want - len(self._pending)]
+                pos += len(chunk)
+                self._pending += chunk
+                if len(self._pending) < self._want:
+                    break
+                received = bytes(self._pending)
+                self._pending.clear()
+            self._want = self._machine.send(received)
+            if self._discarding: # the rest of this write belongs to a damaged frame
+                break
+        return len(data)
+
+    def read(self, size=1):
+        """
+        Returns: up to {size} bytes of queued responses, or b'' if there are none
+        """
+        resp = bytes(self._out[:size])
+        del self._out[:size]
+        return resp
+
+    def _respond(self, resp):
+        self._out += resp
+
+    def _debug(self, message):
+        self.console.append(message)
+
+    # Bootloader
+
+    def _main(self):
+        """The while(1) loop in main(): waits for 'U' or 'B'."""
+        while True:
+            instruction = yield 1
+            if instruction == b'\x00' and self._linger is not None and self.clock() <= self._linger[2]:
+                yield from self._reacknowledge_end()
+                continue
+            self._linger = None
+            if instruction == UPDATE:
+                self._respond(UPDATE)
+                self.status = 'receiving'
+                self.status = yield from self._load_firmware()
+            elif instruction == SEQUENCED:
+                self._respond(SEQUENCED)
+                self._suspended = None
+                self.status = 'receiving'
+                self.status = yield from self._load_firmware_sequenced()
+            elif instruction == RESUME:
+                digest = yield DIGEST_LENGTH
+                session, self._suspended = self._suspended, None
+                if session is None or hashlib.sha256(session['header']).digest() != digest:
+                    session = None
+                    self._respond(RESUME + struct.pack('>HI', 0, 0))
+                else:
+                    self._respond(RESUME + struct.pack('>HI', session['expected'], len(session['encrypted_fw'])))
+                    self._debug("resuming at frame {}".format(session['expected']))
+                self.status = 'receiving'
+                self.status = yield from self._load_firmware_sequenced(session)
+            elif instruction == DIGESTS:
+                count = min(struct.unpack('>H', (yield 2))[0], FLASH_PAGES)
+                if self.aes_key is None:
+                    count = 0
+                self._respond(DIGESTS + struct.pack('>H', count))
+                key = hmac.new(self.aes_key, PAGE_DIGEST_LABEL, hashlib.sha256).digest() if count else None
+                for page in range(count):
+                    mac = hmac.new(key, struct.pack('>H', page) + self._installed_page(page), hashlib.sha256)
+                    self._respond(mac.digest()[:PAGE_DIGEST_LENGTH])
+            elif instruction == BOOT:
+                self._respond(BOOT)
+                self.booted = True
+                self._debug(self.firmware[self.size:].split(b'\x00', 1)[0].decode(errors='replace'))
+
+    def _reacknowledge_end(self):
+        """
+        Receives the rest of what may be a repeat of the last transfer's empty frame (see the module
+        docstring) and acknowledges it again if it is one.
+        """
+        end_frame, response, _ = self._linger
+        self._in_frame = True
+        try:
+            rest = yield len(end_frame) - 1
+        except LineIdle:
+            return
+        finally:
+            self._in_frame = False
+        if end_frame[:1] + rest == end_frame:
+            self._respond(response)
+            self._linger[2] = self.clock() + SESSION_TIMEOUT
+
+    def _load_firmware(self):
+        """
+        load_firmware(): receives the signed hash, metadata, IV and frames, then checks and installs them.
+
+        Returns: the status of the update
+        """
+        self._debug("entering loop")
+        signed_hash = yield SIGNATURE_LENGTH
+        self._debug("loop passed")
+        self._respond(OK)
+
+        metadata = yield METADATA_LENGTH
+        status = self._check_metadata(metadata)
+        if status is not None:
+            return status
+        version, size, encrypted_size = struct.unpack('<HHH', metadata)
+        self._respond(OK) # Acknowledge the metadata.
+
+        iv = yield IV_LENGTH
+        self._respond(OK)
+
+        encrypted_fw = bytearray()
+        while len(encrypted_fw) < encrypted_size:
+            frame_length = struct.unpack('>H', (yield 2))[0]
+            if frame_length == 0 or len(encrypted_fw) + frame_length > encrypted_size:
+                return self._reject("Nice try, nerd")
+            self._debug(hex(frame_length & 0xFF))
+            encrypted_fw += yield frame_length
+            self._respond(OK) # Acknowledge the frame.
+
+        if struct.unpack('>H', (yield 2))[0] != 0:
+            return self._reject("Nice try, nerd: Too much data is sent.")
+        self._respond(OK)
+
+        return self._install(signed_hash, metadata, iv, bytes(encrypted_fw))
+
+    def _recv_frame(self):
+        """
+        Receives one sequenced frame, answering NAK if it is damaged and dropping it if the line goes
+        idle part way through.
+
+        Returns: (sequence, data) of the next intact frame
+        """
+        self._in_frame = True
+        while True:
+            try:
+                header = yield FRAME_HEADER_LENGTH
+                length, sequence = struct.unpack('>HH', header)
+                if length > MAX_FRAME_LENGTH:
+                    self._nak(sequence)
+                    continue
+                body = yield length + FRAME_CRC_LENGTH
+            except LineIdle:
+                continue
+            data, crc = body[:length], struct.unpack('>H', body[length:])[0]
+            if crc16(header + data) != crc:
+                self._nak(sequence)
+                continue
+            self._in_frame = False
+            return sequence, data
+
+    def _nak(self, sequence):
+        """Asks for the frame again and ignores the rest of it until the line goes idle."""
+        self._respond(reply(NAK, bytes([sequence & 0xFF])))
+        self._debug("bad frame")
+        self._discarding = True
+
+    def _load_firmware_sequenced(self, session=None):
+        """
+        The sequenced version of load_firmware(): frame 0 holds the signed hash, metadata and IV, the
+        following frames hold F and an empty frame ends the transfer.
+
+        Returns: the status of the update ('suspended' if the host went quiet part way through)
+
+        Arguments:
+        {session}: a transfer that was put aside, to carry on with instead of starting a new one
+        """
+        if session is None:
+            session = {'header': None, 'expected': 0, 'encrypted_fw': bytearray(), 'encrypted_size': 0, 'pages': None,
+                       'gcm': False, 'firmware': bytearray(), 'opened': 0}
+        encrypted_fw = session['encrypted_fw']
+        self._in_session = True
+        try:
+            while True:
+                sequence, data = yield from self._recv_frame()
+                ack = bytes([sequence & 0xFF])
+                if sequence == session['expected'] - 1:
+                    self._respond(reply(OK, ack)) # our OK was lost, the host sent the frame again
+                    continue
+                if sequence != session['expected']:
+                    self._respond(reply(NAK, ack))
+                    continue
+
+                if session['header'] is None:
+                    parts = self._split_header(data)
+                    if parts is None:
+                        return self._reject("Nice try, nerd", ack)
+                    status = self._check_metadata(parts['metadata'], ack)
+                    if status is not None:
+                        return status
+                    if parts['segments'] is not None and not self._check_segments(parts['segments']):
+                        return self._reject("Nice try, nerd: bad segment map.", ack)
+                    session['header'] = data
+                    session['encrypted_size'] = struct.unpack_from('<H', parts['metadata'], 4)[0]
+                    session['gcm'] = parts['cipher'] == CIPHER_GCM
+                    bitmap = data[parts['end']:]
+                    if bitmap and (session['gcm'] or parts['segments'] is not None):
+                        return self._reject("Nice try, nerd: bad page map.", ack)
+                    if bitmap:
+                        session['pages'] = self._read_bitmap(bitmap, session['encrypted_size'])
+                        if session['pages'] is None:
+                            return self._reject("Nice try, nerd: bad page map.", ack)
+                        session['encrypted_size'] = sum(
+                            min(FLASH_PAGESIZE, session['encrypted_size'] - page * FLASH_PAGESIZE)
+                            for page in session['pages'])
+                elif not data:
+                    if len(encrypted_fw) != session['encrypted_size']: # if firmware end is too early
+                        return self._reject("Nice try, nerd", ack)
+                    if session['gcm'] and not self._open_segments(session, final=True):
+                        return self._reject("Nice try, nerd: GCM authentication failure.", ack)
+                    self._respond(reply(OK, ack))
+                    end_frame = struct.pack('>HH', 0, sequence)
+                    self._linger = [end_frame + struct.pack('>H', crc16(end_frame)), reply(OK, ack),
+                                    self.clock() + SESSION_TIMEOUT]
+                    break
+                elif len(encrypted_fw) + len(data) > session['encrypted_size']: # if firmware is larger than the size declares
+                    return self._reject("Nice try, nerd: Too much data is sent.", ack)
+                else:
+                    self._debug(hex(len(data) & 0xFF))
+                    encrypted_fw += data
+                    if session['gcm'] and not self._open_segments(session):
+                        return self._reject("Nice try, nerd: GCM authentication failure.", ack)
+                self._respond(reply(OK, ack))
+                session['expected'] += 1
+        except SessionIdle:
+            self._in_frame = False
+            if session['header'] is None:
+                return 'idle'
+            self._suspended = session
+            self._debug("transfer suspended at frame {}".format(session['expected']))
+            return 'suspended'
+        finally:
+            self._in_session = False
+
+        parts = self._split_header(session['header'])
+        if session['pages'] is not None:
+            encrypted_fw = self._fill_pages(parts['iv'], session['pages'], bytes(encrypted_fw),
+                                            struct.unpack_from('<H', parts['metadata'], 4)[0])
+        firmware = bytes(session['firmware']) if session['gcm'] and self.aes_key is not None else None
+        return self._install(parts['signature'], parts['metadata'], parts['iv'], bytes(encrypted_fw), session['pages'],
+                             parts['prefix'], firmware, parts['segment_map'], parts['segments'])
+
+    def _open_segments(self, session, final=False):
+        """
+        Authenticates and decrypts the GCM segments of the transfer that have arrived since the last
+        call, adding their data to session['firmware'] ({final}: the last segment may be short).
+
+        Returns: False if a segment's tag does not match
+        """
+        if self.aes_key is None:
+            return True
+        from Crypto.Cipher import AES
+        parts = self._split_header(session['header'])
+        metadata, iv = parts['metadata'], parts['iv']
+        encrypted_fw = session['encrypted_fw']
+        while True:
+            index = session['opened']
+            segment = encrypted_fw[index * GCM_SEGMENT_LENGTH: (index + 1) * GCM_SEGMENT_LENGTH]
+            if len(segment) < GCM_SEGMENT_LENGTH and not (final and segment):
+                return True
+            if len(segment) <= GCM_TAG_LENGTH:
+                return False
+            nonce = bytes(iv[:12]) + struct.pack('>I', index)
+            cipher = AES.new(self.aes_key, AES.MODE_GCM, nonce=nonce, mac_len=GCM_TAG_LENGTH)
+            cipher.update(bytes(metadata))
+            try:
+                session['firmware'] += cipher.decrypt_and_verify(bytes(segment[:-GCM_TAG_LENGTH]),
+                                                                 bytes(segment[-GCM_TAG_LENGTH:]))
+            except ValueError:
+                return False
+            session['opened'] = index + 1
+
+    @staticmethod
+    def _split_header(header):
+        """
+        Returns: the sections of sequenced frame 0 {header} as a dictionary ('prefix', 'signature',
+        'metadata', 'segment_map', 'iv'), with the 'cipher', the (address, length) 'segments' (None
+        without a segment map) and where the header 'end's, or None if the header is too short or
+        its typed prefix names a signature type or cipher the model does not know
+        """
+        prefix, sig_type, cipher, segments = b'', SIG_RSA, CIPHER_CBC, None
+        if header.startswith(MAGIC):
+            if len(header) < PREFIX_LENGTH:
+                return None
+            prefix, sig_type, cipher = header[:PREFIX_LENGTH], header[len(MAGIC)], header[len(MAGIC) + 1]
+        if sig_type not in SIGNATURE_LENGTHS or cipher & ~FLAG_SEGMENTS not in (CIPHER_CBC, CIPHER_GCM):
+            return None
+        metadata_start = len(prefix) + SIGNATURE_LENGTHS[sig_type]
+        map_end = metadata_start + METADATA_LENGTH
+        if cipher & FLAG_SEGMENTS:
+            if len(header) < map_end + 2:
+                return None
+            count = struct.unpack_from('>H', header, map_end)[0]
+            if not 0 < count <= MAX_SEGMENTS or len(header) < map_end + 2 + count * 8:
+                return None
+            segments = [struct.unpack_from('>II', header, map_end + 2 + i * 8) for i in range(count)]
+            map_end += 2 + count * 8
+        if len(header) < map_end + IV_LENGTH:
+            return None
+        return {
+            'prefix': prefix,
+            'signature': header[len(prefix): metadata_start],
+            'metadata': header[metadata_start: metadata_start + METADATA_LENGTH],
+            'segment_map': header[metadata_start + METADATA_LENGTH: map_end],
+            'iv': header[map_end: map_end + IV_LENGTH],
+            'cipher': cipher & ~FLAG_SEGMENTS,
+            'segments': segments,
+            'end': map_end + IV_LENGTH,
+        }
+
+    def _read_bitmap(self, bitmap, encrypted_size):
+        """
+        Returns: the page numbers marked in {bitmap}, or None if it does not fit F or the model
+        cannot rebuild the pages it leaves out
+        """
+        pages = (encrypted_size + FLASH_PAGESIZE - 1) // FLASH_PAGESIZE
+        if self.aes_key is None or len(bitmap) != (pages + 7) // 8:
+            return None
+        marked = [page for page in range(len(bitmap) * 8) if bitmap[page // 8] >> (page % 8) & 1]
+        if marked and marked[-1] >= pages:
+            return None
+        return marked
+
+    def _installed_page(self, page):
+        """
+        Returns: the 1 KB flash page {page} pages after FW_BASE, as it is programmed now
+        """
+        if self.flash is not None:
+            return self.flash.read(FW_BASE + page * FLASH_PAGESIZE, FLASH_PAGESIZE)
+        return self.firmware[page * FLASH_PAGESIZE: (page + 1) * FLASH_PAGESIZE].ljust(FLASH_PAGESIZE, b'\xff')
+
+    def _fill_pages(self, iv, pages, received, encrypted_size):
+        """
+        Rebuilds the whole of F from the pages that were sent and the pages already in flash, which
+        are encrypted again in CBC mode starting from the ciphertext block before each one.
+
+        Returns: F
+        """
+        from Crypto.Cipher import AES
+        encrypted_fw = bytearray()
+        sent = set(pages)
+        for page in range((encrypted_size + FLASH_PAGESIZE - 1) // FLASH_PAGESIZE):
+            length = min(FLASH_PAGESIZE, encrypted_size - page * FLASH_PAGESIZE)
+            if page in sent:
+                encrypted_fw += received[:length]
+                received = received[length:]
+            else:
+                chain = encrypted_fw[-16:] if encrypted_fw else iv
+                plaintext = self._installed_page(page)[:length]
+                encrypted_fw += AES.new(self.aes_key, AES.MODE_CBC, iv=bytes(chain)).encrypt(plaintext)
+        return bytes(encrypted_fw)
+
+    def _check_metadata(self, metadata, ack=b''):
+        """
+        Applies the bootloader's checks to the metadata and records the new version and size.
+
+        Returns: None if the metadata is accepted, otherwise the status of the rejected update
+        """
+        version, size, encrypted_size = struct.unpack('<HHH', metadata)
+        self._debug("Received Firmware Version: {}".format(hex(version)))
+        self._debug("Received Firmware Size: {}".format(hex(size)))
+        self._debug("Received Encrypted Firmware Size: {}".format(hex(encrypted_size)))
+        if encrypted_size > MAX_ENCRYPTED_DATA_SIZE or encrypted_size % 16 != 0:
+            return self._reject("Nice try, nerd.", ack)
+        if version != 0 and version < self.version:
+            return self._reject("Nice try, nerd", ack)
+        if version != 0: # If debug firmware, don't change version
+            self.version = version
+        self.size = size
+        if self.flash is not None:
+            # Write new firmware size and version to Flash: version at the lower address, size at the higher
+            self.flash.program_flash(METADATA_BASE, struct.pack('<HH', self.version, size), 4)
+        return None
+
+    def _reject(self, message, ack=b''):
+        self._respond(reply(ERROR, ack))
+        self._debug(message)
+        return 'rejected'
+
+    def _install(self, signed_hash, metadata, iv, encrypted_fw, pages=None, prefix=b'', firmware=None,
+                 segment_map=b'', segments=None):
+        """
+        Verifies the signature over prefix | metadata | segment map | IV | F, decrypts F and
+        "programs" it.
+
+        Returns: the status of the update
+
+        Arguments:
+        {pages}: the page numbers to program, or None for all of them
+        {prefix}: the typed prefix of frame 0 (empty for an RSA signature)
+        {firmware}: F already decrypted (segment by segment, in GCM mode), or None to decrypt it here
+        {segment_map}, {segments}: the segment map of frame 0 and its (address, length) pairs, or
+            None to program f from FW_BASE
+        """
+        if self.public_key is not None:
+            sig_type = prefix[len(MAGIC)] if prefix else SIG_RSA
+            if not self._verify(sig_type, prefix + metadata + segment_map + iv + encrypted_fw, signed_hash):
+                self._debug("Nice try, nerd: {} authentication failure.".format(
+                    'RSA' if sig_type == SIG_RSA else 'ECC'))
+                return 'unauthenticated'
+            self._debug("passed verification")
+
+        if firmware is not None:
+            self.firmware = firmware
+            self._debug("passed decryption")
+        elif self.aes_key is not None:
+            from Crypto.Cipher import AES
+            self.firmware = AES.new(self.aes_key, AES.MODE_CBC, iv=iv).decrypt(encrypted_fw)
+            self._debug("passed decryption")
+        else:
+            self.firmware = encrypted_fw
+
+        if self.flash is not None and segments is not None:
+            self._program_segments(self.firmware, segments)
+        elif self.flash is not None:
+            self._program_firmware(self.firmware, pages)
+        self._debug("update complete")
+        return 'installed'
+
+    def _verify(self, sig_type, message, signature):
+        """
+        Returns: True if {signature} of type {sig_type} over the SHA-256 of {message} is valid under
+        the model's public key
+        """
+        from Crypto.Hash import SHA256
+        from Crypto.Signature import DSS, eddsa, pkcs1_15
+        digest = SHA256.new(message)
+        try:
+            if sig_type == SIG_RSA:
+                pkcs1_15.new(self.public_key).verify(digest, signature)
+            elif sig_type == SIG_ED25519:
+                eddsa.new(self.public_key, 'rfc8032').verify(digest.digest(), signature)
+            else:
+                DSS.new(self.public_key, 'fips-186-3').verify(digest, signature)
+        except (ValueError, TypeError, AttributeError): # a bad signature, or a key of another type
+            return False
+        return True
+
+    def _program_firmware(self, firmware, pages=None, base=FW_BASE):
+        """
+        Programs {firmware} from {base} a page at a time, like the end of load_firmware(),
+        skipping any page not listed in {pages} (when it is not None).
+        """
+        page = 0
+        while len(firmware) - page * FLASH_PAGESIZE > FLASH_PAGESIZE:
+            if pages is None or page in pages:
+                self._debug("programming flash page:{}".format(hex(page)))
+                self.flash.program_flash(base + page * FLASH_PAGESIZE, firmware[page * FLASH_PAGESIZE:],
+                                         FLASH_PAGESIZE)
+            page += 1
+        if pages is None or page in pages:
+            self.flash.program_flash(base + page * FLASH_PAGESIZE, firmware[page * FLASH_PAGESIZE:],
+                                     len(firmware) - page * FLASH_PAGESIZE)
+
+    def _program_segments(self, firmware, segments):
+        """
+        Programs each run of {firmware} at the address its segment gives. The release message and
+        padding after f go after the last run.
+        """
+        offset = 0
+        for i, (address, length) in enumerate(segments):
+            end = offset + length if i < len(segments) - 1 else len(firmware)
+            self._program_firmware(firmware[offset: end], base=address)
+            offset = end
+
+    def _check_segments(self, segments):
+        """
+        Returns: True if the runs of {segments} start on flash pages, come in address order without
+        overlapping, fit between FW_BASE and FW_LIMIT and add up to size(f)
+        """
+        end = FW_BASE
+        for address, length in segments:
+            if address % FLASH_PAGESIZE or address < end:
+                return False
+            end = address + length
+        return end <= FW_LIMIT and sum(length for _, length in segments) == self.size
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""
+Boot Latency Benchmark
+
+Measures how long the emulated board takes from a reset to the firmware's startup banner: the
+bootloader's 'B' path (printing the release message and jumping to 0x10001) and the firmware's
+startup up to printBanner(). Run it against an emulator started with bl_emulate.py --snapshot.
+
+If a protected image is given it is flashed first with fw_update, and the flashed state is saved as
+its own VM snapshot. Each trial then resets the board in one of two ways:
+
+    uart0     write 0x20 to UART0, wait for the bootloader's welcome message, then send 'B'. The
+              time includes the bootloader starting up.
+    snapshot  restore the VM snapshot taken while the bootloader waited for an instruction, then
+              send 'B'. The time includes the restore instead, which is far shorter.
+
+Either way a trial is timed from the moment the reset is issued (the 0x20 is written, or loadvm
+is sent to the QEMU monitor) until FIRMWARE_BANNER, the start of the banner's first line with
+text on it (its second line), has been read from UART2; the rest of the banner is not waited for.
+That covers the reset, the 'B' path and the firmware's startup up to printBanner(), and also the
+host's side of the line: bl_emulate's bridge passes each byte on as soon as it arrives (see
+bl_emulate.connect_socks), and the reads here return as soon as there is a byte, so this adds
+well under a millisecond.
+"""
+import argparse
+import json
+import statistics
+import time
+
+from serial import Serial
+
+import bl_emulate
+import fw_update
+from fw_scenario import percentile
+from uart_capture import BOOTLOADER_READY, UPDATE_DONE
+
+UART0 = '/embsec/UART0'
+UART1 = '/embsec/UART1'
+UART2 = '/embsec/UART2'
+FIRMWARE_BANNER = b'  __  __ _____ _______ _____' # second line of STARTUP_BANNER (the first is blank)
+FLASHED_SNAPSHOT = 'flashed' # VM snapshot of the bootloader ready with the benchmarked image installed
+RESET = b'\x20' # written to UART0, resets the device
+
+
+def wait_for(ser, marker, timeout):
+    """
+    Reads from {ser} until {marker} has been received.
+
+    Returns: the time it arrived
+
+    Throws a RuntimeError if it has not arrived within {timeout} seconds.
+    """
+    deadline = time.monotonic() + timeout
+    received = b''
+    while marker not in received:
+        if time.monotonic() > deadline:
+            raise RuntimeError("{!r} did not appear on {} within {} seconds".format(marker, ser.port, timeout))
+        received = received[-len(marker):] + ser.read(max(1, ser.in_waiting))
+    return time.monotonic()
+
+
+def flash(firmware_blob, monitor_path=bl_emulate.MONITOR_PATH):
+    """
+    Installs {firmware_blob} in the emulator and saves the result as FLASHED_SNAPSHOT.
+    """
+    with Serial(UART1, baudrate=115200, timeout=2) as ser, Serial(UART2, baudrate=115200, timeout=.1) as debug:
+        debug.reset_input_buffer()
+        fw_update.update(ser, firmware_blob)
+        # After an update the bootloader goes back to waiting for an instruction
+        wait_for(debug, UPDATE_DONE.encode(), timeout=60)
+    monitor = bl_emulate.QemuMonitor(monitor_path)
+    try:
+        monitor.savevm(FLASHED_SNAPSHOT)
+    finally:
+        monitor.close()
+
+
+def boot_once(uart0, uart1, uart2, method, snapshot, timeout=10):
+    """
+    Resets the board, boots the firmware and waits for its banner.
+
+    Returns: seconds from issuing the reset to the banner (see the module docstring)
+    """
+    uart2.reset_input_buffer()
+    uart1.reset_input_buffer()
+    started = time.monotonic()
+    if method == 'uart0':
+        uart0.write(RESET)
+        wait_for(uart2, BOOTLOADER_READY.encode(), timeout)
+    else:
+        bl_emulate.reset(name=snapshot) # the VM is waiting for an instruction once loadvm returns
+        uart2.reset_input_buffer() # anything the old VM state still had in flight
+    uart1.reset_input_buffer()
+    uart1.write(b'B')
+    return wait_for(uart2, FIRMWARE_BANNER, timeout) - started
+
+
+def benchmark(trials=20, method='snapshot', firmware_blob=None, timeout=10):
+    """
+    Boots the emulated board {trials} times.
+
+    Returns: the boot times in seconds and a summary of their distribution
+
+    Arguments:
+    {method}: how to reset the board, 'uart0' or 'snapshot'
+    {firmware_blob}: a protected image to flash first, or None to boot whatever is installed
+    {timeout}: seconds to wait for the banner on each boot
+    """
+    snapshot = bl_emulate.SNAPSHOT_NAME
+    if firmware_blob is not None:
+        bl_emulate.reset()
+        flash(firmware_blob)
+        snapshot = FLASHED_SNAPSHOT
+
+    times = []
+    with Serial(UART0, baudrate=115200, timeout=.1) as uart0, \
+            Serial(UART1, baudrate=115200, timeout=.1) as uart1, \
+            Serial(UART2, baudrate=115200, timeout=.1) as uart2:
+        for _ in range(trials):
+            times.append(boot_once(uart0, uart1, uart2, method, snapshot, timeout=timeout))
+    return times, {
+        'trials': trials,
+        'method': method,
+        'mean': statistics.mean(times),
+        'stdev': statistics.stdev(times) if len(times) > 1 else 0.0,
+        'min': min(times),
+        'p50': percentile(times, 50),
+        'p90': percentile(times, 90),
+        'p99': percentile(times, 99),
+        'max': max(times),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Boot Latency Benchmark')
+    parser.add_argument("--firmware", help="Protected firmware blob to flash before measuring.", default=None)
+    parser.add_argument("--trials", help="Number of boots to time.", type=int, default=20)
+    parser.add_argument("--method", help="How to reset the board between boots.", choices=['snapshot', 'uart0'],
+                        default='snapshot')
+    parser.add_argument("--timeout", help="Seconds to wait for the banner on each boot.", type=float, default=10)
+    parser.add_argument("--json", help="Print the boot times and summary as JSON.", action='store_true')
+    args = parser.parse_args()
+
+    firmware_blob = None
+    if args.firmware is not None:
+        with open(args.firmware, 'rb') as fp:
+            firmware_blob = fp.read()
+
+    times, summary = benchmark(trials=args.trials, method=args.method, firmware_blob=firmware_blob,
+                               timeout=args.timeout)
+    if args.json:
+        print(json.dumps({'times': times, 'summary': summary}, indent=2))
+    else:
+        print('{trials} boots ({method} reset):'.format(**summary))
+        print('  mean {:.1f} ms  stdev {:.1f} ms'.format(summary['mean'] * 1000, summary['stdev'] * 1000))
+        print('  min {:.1f}  p50 {:.1f}  p90 {:.1f}  p99 {:.1f}  max {:.1f} ms'.format(
+            *(summary[key] * 1000 for key in ('min', 'p50', 'p90', 'p99', 'max'))))
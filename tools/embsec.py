@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+embsec
+
+One entry point for the host tools:
+
+    embsec build ...      bl_build      build the bootloader and provision its keys
+    embsec protect ...    fw_protect    make a firmware blob
+    embsec update ...     fw_update     send a blob to the bootloader
+    embsec emulate ...    bl_emulate    run the bootloader in the emulator
+    embsec inspect ...    fw_blob       show (and check) a blob
+
+and the rest of the tools listed by `embsec --help`. The arguments after the command are the
+tool's own, exactly as if it were run as a script.
+
+Nothing but the standard library is imported until a command has been picked, and then only the
+tool that runs it; each tool in turn loads PyCryptodome and pyserial only once it needs them. So
+--help, a dry run or inspecting a blob never pay for a crypto library or a serial port. The
+startup command times the commands that must start quickly against STARTUP_BUDGET, and names any
+heavy module they imported:
+
+    embsec startup --firmware firmwareblob.blob
+"""
+import os
+import runpy
+import sys
+
+# command -> (module that runs it, summary)
+COMMANDS = {
+    'build': ('bl_build', 'Build the bootloader and provision its keys.'),
+    'keys': ('key_db', 'List the device key database, or export the secrets of one device.'),
+    'protect': ('fw_protect', 'Protect a firmware image into a signed, encrypted blob.'),
+    'update': ('fw_update', 'Send a firmware blob to the bootloader.'),
+    'emulate': ('bl_emulate', 'Run the bootloader in the emulator.'),
+    'inspect': ('fw_blob', 'Show the header of a firmware blob and check it.'),
+    'preflight': ('fw_preflight', 'Check a blob against a public key before an update.'),
+    'audit': ('fw_audit', 'Check every blob in a directory or artifact store.'),
+    'predict': ('fw_predict', 'Predict how long an update will take.'),
+    'image': ('fw_image', 'Show how a firmware image is laid out in flash.'),
+    'store': ('fw_store', 'Manage the firmware artifact store.'),
+    'bundle': ('fw_bundle', 'Pack blobs into a release bundle, or list one.'),
+    'fleet': ('fw_fleet', 'Roll an update out to many devices.'),
+    'fuzz': ('bl_fuzz', 'Fuzz the bootloader model with mutated updates.'),
+    'stress': ('fw_stress', 'Run many updates at once to find where the host stops scaling.'),
+    'rsa-constants': ('rsa_montgomery', 'Check the generated RSA Montgomery constants.'),
+}
+
+STARTUP_BUDGET = 0.25 # seconds from launch to exit for the commands that must start quickly
+STARTUP_RUNS = 5
+HEAVY_MODULES = ('Crypto', 'serial') # packages the quick commands must not import
+
+
+def usage():
+    """Returns: the list of commands, for --help"""
+    width = max(len(name) for name in COMMANDS)
+    lines = ['usage: embsec COMMAND [ARGS...]', '', 'commands:']
+    for name, (module, summary) in COMMANDS.items():
+        lines.append('  {:<{}}  {} ({})'.format(name, width, summary, module))
+    lines.append('  {:<{}}  {}'.format('startup', width, 'Time the start-up of the quick commands.'))
+    lines.append('')
+    lines.append("Run 'embsec COMMAND --help' for the arguments of a command.")
+    return '\n'.join(lines)
+
+
+def run(command, args):
+    """
+    Runs the tool behind {command} with the arguments {args}, as if it were run as a script.
+
+    Throws a KeyError if there is no such command.
+    """
+    module, _ = COMMANDS[command]
+    sys.argv = [sys.argv[0]] + list(args) # argv[0] becomes the tool's own path, as for `python -m`
+    runpy.run_module(module, run_name='__main__', alter_sys=True)
+
+
+def startup_time(args, runs=STARTUP_RUNS):
+    """
+    Runs embsec with {args} {runs} times in a fresh interpreter.
+
+    Returns: the median seconds from launch to exit, and the heavy packages (HEAVY_MODULES) it
+    imported
+    """
+    import statistics
+    import subprocess
+    import time
+
+    times = []
+    heavy = set()
+    for _ in range(runs):
+        started = time.perf_counter()
+        done = subprocess.run([sys.executable, '-X', 'importtime', os.path.abspath(__file__)] + list(args),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        times.append(time.perf_counter() - started)
+        for line in done.stderr.splitlines():
+            if line.startswith('import time:'):
+                package = line.rsplit('|', 1)[-1].strip().split('.')[0]
+                if package in HEAVY_MODULES:
+                    heavy.add(package)
+    return statistics.median(times), sorted(heavy)
+
+
+def startup(argv):
+    """
+    The startup command: times `embsec update --help` and `embsec inspect` against the budget.
+
+    Returns: True if every command started within the budget without importing a heavy module
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='embsec startup', description='Time the start-up of the quick commands.')
+    parser.add_argument("--firmware", help="Blob for `embsec inspect` to read (default: only its --help).",
+                        default=None)
+    parser.add_argument("--runs", help="Launches of each command to take the median of.", type=int,
+                        default=STARTUP_RUNS)
+    parser.add_argument("--budget", help="Seconds each command may take.", type=float, default=STARTUP_BUDGET)
+    args = parser.parse_args(argv)
+
+    commands = [['--help'], ['update', '--help'],
+                ['inspect'] + (['--firmware', args.firmware] if args.firmware else ['--help'])]
+    passed = True
+    for command in commands:
+        elapsed, heavy = startup_time(command, runs=args.runs)
+        ok = elapsed <= args.budget and not heavy
+        passed = passed and ok
+        print('{:<4} embsec {:<40} {:6.1f} ms{}'.format(
+            'ok' if ok else 'SLOW', ' '.join(command), elapsed * 1e3,
+            ' (imported {})'.format(', '.join(heavy)) if heavy else ''))
+    print('Budget: {:.0f} ms per command'.format(args.budget * 1e3))
+    return passed
+
+
+def main(argv):
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage())
+        return 0 if argv else 2
+    command, args = argv[0], argv[1:]
+    if command == 'startup':
+        return 0 if startup(args) else 1
+    if command not in COMMANDS:
+        print("embsec: unknown command '{}'\n\n{}".format(command, usage()), file=sys.stderr)
+        return 2
+    run(command, args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    raise SystemExit(main(sys.argv[1:]))
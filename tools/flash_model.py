@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+Flash Model
+
+A model of the LM3S6965's internal flash as the bootloader uses it: 256 KB in 1 KB pages, erased a
+page at a time to 0xFF and programmed a 4-byte word at a time. It counts erases and programmed words
+per page and adds up how long they would take, so page-level write strategies can be compared
+without hardware.
+
+program_flash() follows program_flash() in bootloader.c: it erases the page, zero-pads the data to
+a whole number of words and programs it. bl_model.BootloaderModel drives it when given one.
+
+The timings are the typical figures for Stellaris parts (about 12 ms to erase a page, 20 us to
+program a word); pass your own to FlashModel if you have better numbers for a particular board.
+"""
+import argparse
+import collections
+
+# Flash layout (same values as bootloader.c)
+FLASH_SIZE = 256 * 1024
+FLASH_PAGESIZE = 1024
+FLASH_WRITESIZE = 4
+METADATA_BASE = 0xFC00 # base address of version and firmware size in Flash
+FW_BASE = 0x10000 # base address of firmware in Flash
+
+PAGE_ERASE_TIME = 0.012 # seconds to erase one page
+WORD_PROGRAM_TIME = 0.00002 # seconds to program one word
+
+
+class FlashModel:
+    """
+    Flash memory with erase and program accounting.
+
+    Arguments:
+    {erase_time}: seconds to erase one page
+    {program_time}: seconds to program one word
+    {fill}: initial value of every byte (QEMU starts with zeros; erased flash reads 0xFF)
+
+    {erases} and {programs} count page erases and programmed words by page number.
+    {time} is the total time spent erasing and programming.
+    {overwrites} counts words programmed without an erase that tried to set a 0 bit back to 1,
+    which real flash cannot do.
+    """
+
+    def __init__(self, erase_time=PAGE_ERASE_TIME, program_time=WORD_PROGRAM_TIME, fill=0xFF):
+        self.erase_time = erase_time
+        self.program_time = program_time
+        self.memory = bytearray([fill]) * FLASH_SIZE
+        self.erases = collections.Counter()
+        self.programs = collections.Counter()
+        self.time = 0.0
+        self.overwrites = 0
+
+    def erase(self, page_addr):
+        """FlashErase(): sets the 1 KB page at {page_addr} to 0xFF."""
+        if page_addr % FLASH_PAGESIZE or not 0 <= page_addr < FLASH_SIZE:
+            raise ValueError("Cannot erase 0x{:x}: not the start of a flash page".format(page_addr))
+        self.memory[page_addr: page_addr + FLASH_PAGESIZE] = b'\xff' * FLASH_PAGESIZE
+        self.erases[page_addr // FLASH_PAGESIZE] += 1
+        self.time += self.erase_time
+
+    def program(self, data, address):
+        """
+        FlashProgram(): programs {data} (a whole number of words) starting at {address}.
+        Programming can only clear bits, so each word ends up as the AND of old and new.
+        """
+        if address % FLASH_WRITESIZE or len(data) % FLASH_WRITESIZE:
+            raise ValueError("Cannot program {} bytes at 0x{:x}: not whole words".format(len(data), address))
+        if address < 0 or address + len(data) > FLASH_SIZE:
+            raise ValueError("Cannot program {} bytes at 0x{:x}: outside flash".format(len(data), address))
+        for offset in range(0, len(data), FLASH_WRITESIZE):
+            addr = address + offset
+            old = self.memory[addr: addr + FLASH_WRITESIZE]
+            new = data[offset: offset + FLASH_WRITESIZE]
+            merged = bytes(a & b for a, b in zip(old, new))
+            if merged != bytes(new):
+                self.overwrites += 1
+            self.memory[addr: addr + FLASH_WRITESIZE] = merged
+            self.programs[addr // FLASH_PAGESIZE] += 1
+        self.time += len(data) // FLASH_WRITESIZE * self.program_time
+
+    def program_flash(self, page_addr, data, data_len):
+        """
+        program_flash() from bootloader.c: erases the page at {page_addr}, then programs the first
+        {data_len} bytes of {data}, zero-padded to a whole number of words.
+        """
+        self.erase(page_addr)
+        data = bytes(data[:data_len])
+        if data_len % FLASH_WRITESIZE:
+            data += b'\x00' * (FLASH_WRITESIZE - data_len % FLASH_WRITESIZE)
+        self.program(data, page_addr)
+
+    def read(self, address, length):
+        """
+        Returns: {length} bytes of flash starting at {address}
+        """
+        return bytes(self.memory[address: address + length])
+
+    def snapshot(self):
+        """
+        Returns: the current counters, to pass to report() later
+        """
+        return self.time, collections.Counter(self.erases), collections.Counter(self.programs)
+
+    def report(self, since=None):
+        """
+        Returns: a dictionary of the flash work done since {since} (a snapshot(); default: ever):
+            'time': seconds spent erasing and programming
+            'erases': page erases
+            'words': words programmed
+            'pages': number of distinct pages erased
+            'max_page_erases': the most times any one page has been erased in total (wear)
+        """
+        time, erases, programs = since if since is not None else (0.0, collections.Counter(), collections.Counter())
+        new_erases = self.erases - erases
+        return {
+            'time': self.time - time,
+            'erases': sum(new_erases.values()),
+            'words': sum((self.programs - programs).values()),
+            'pages': len(new_erases),
+            'max_page_erases': max(self.erases.values(), default=0),
+        }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Flash Model')
+    parser.add_argument("--firmware", help="Path to the firmware blob to install.", required=True)
+    parser.add_argument("--secrets", help="Keys from bl_build, so the device model can verify and decrypt.",
+                        default=None)
+    parser.add_argument("--updates", help="Number of times to install the blob.", type=int, default=1)
+    args = parser.parse_args()
+
+    import contextlib
+    import io
+
+    import fw_update
+    from bl_model import BootloaderModel
+    from serial_sim import SimulatedSerial
+
+    with open(args.firmware, 'rb') as fp:
+        blob = fp.read()
+    aes_key, signing_key = None, None
+    if args.secrets is not None:
+        from fw_protect import load_secrets
+        aes_key, signing_key = load_secrets(args.secrets)
+
+    flash = FlashModel()
+    device = BootloaderModel(aes_key=aes_key, public_key=signing_key.public_key() if signing_key else None, flash=flash)
+    for update in range(args.updates):
+        before = flash.snapshot()
+        with contextlib.redirect_stdout(io.StringIO()):
+            fw_update.update(SimulatedSerial(device), blob, sequenced=True)
+        report = flash.report(before)
+        print('Update {}: {}, {:.3f} s in flash, {} page erases, {} words, most-erased page {} times'.format(
+            update + 1, device.status, report['time'], report['erases'], report['words'], report['max_page_erases']))
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""
+Firmware Archive Auditor
+
+Checks every blob in a directory tree or an artifact store (see fw_store) against the bootloader's
+rules and the public key, and writes a JSON report of what it found. Each blob gets the checks
+fw_preflight makes before an update:
+
+    structure   the header fits and the segment map, if any, is sound
+    size(F)     a multiple of 16, no larger than MAX_ENCRYPTED_DATA_SIZE and what the blob holds
+    signature   valid under the public key (PKCS#1 v1.5 for RSA blobs)
+
+and a blob from a store must also hash to the name it is kept under.
+
+An archive holds thousands of blobs and the signature check is the cost, so the blobs are shared
+out over a pool of processes (one per core by default), each of which imports the key once. A
+worker maps each blob and parses it in place, so no blob is copied on its way to the hash.
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import mmap
+import os
+import pathlib
+import time
+
+from fw_blob import (SIGNATURE_TYPES, check_blob, import_key, key_fingerprint, load_public_key, parse_blob,
+                     verify_signature)
+
+PATTERN = '*.blob'
+CHUNKS_PER_WORKER = 4 # each worker is handed about this many batches, so a slow batch cannot hold up the end
+
+_public_key = None # the key in a worker process, set by _init_worker
+
+
+def find_blobs(path, pattern=PATTERN):
+    """
+    Returns: (path, expected SHA-256 or None) for each blob to audit under {path}: the objects an
+    artifact store indexes if {path} is a store, and otherwise the files matching {pattern} in the
+    tree
+    """
+    path = pathlib.Path(path)
+    if (path / 'index').is_file() and (path / 'objects').is_dir():
+        from fw_store import Store
+        store = Store(path)
+        hashes = sorted({entry.blob_hash for entry in store.entries()})
+        return [(str(store.blob_path(blob_hash)), blob_hash) for blob_hash in hashes]
+    return [(str(found), None) for found in sorted(path.rglob(pattern)) if found.is_file()]
+
+
+def _init_worker(key_der):
+    global _public_key
+    _public_key = import_key(key_der)
+
+
+def _check(view, public_key):
+    problems = check_blob(view)
+    if problems:
+        return problems, None
+    blob = parse_blob(view)
+    if not verify_signature(view, public_key):
+        problems.append("signature does not verify against the public key")
+    return problems, {'version': blob.version, 'size': blob.size, 'encrypted_size': blob.encrypted_size,
+                      'signature': blob.sig_type}
+
+
+def audit_blob(path, expected_hash=None, public_key=None):
+    """
+    Checks the blob at {path}.
+
+    Returns: a dictionary with the 'path' and 'sha256' of the blob, 'ok' (True if it passed every
+    check), the 'problems' found, and its 'version', 'size', 'encrypted_size' and 'signature' type
+    if its header could be read
+
+    Arguments:
+    {expected_hash}: the hex SHA-256 the blob should have, or None
+    {public_key}: the key to check the signature with (the worker's key if None)
+    """
+    public_key = _public_key if public_key is None else public_key
+    result = {'path': path, 'sha256': None, 'ok': False, 'problems': []}
+    try:
+        fp = open(path, 'rb')
+    except OSError as e:
+        result['problems'].append("cannot be read: {}".format(e.strerror))
+        return result
+    with fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            result['problems'].append("file is empty")
+            return result
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                result['sha256'] = hashlib.sha256(view).hexdigest()
+                problems, fields = _check(view, public_key)
+            finally:
+                view.release()
+    if expected_hash is not None and result['sha256'] != expected_hash:
+        problems.insert(0, "contents do not match the hash it is stored under")
+    if fields is not None:
+        names = {value: name for name, value in SIGNATURE_TYPES.items()}
+        fields['signature'] = names[fields['signature']]
+        result.update(fields)
+    result['problems'] = problems
+    result['ok'] = not problems
+    return result
+
+
+def _audit_one(item):
+    return audit_blob(*item)
+
+
+def audit(blobs, public_key, workers=None):
+    """
+    Checks {blobs} over a pool of {workers} processes (one per core if None).
+
+    Returns: the report, a dictionary with the 'public_key' fingerprint, the number of blobs
+    'checked' and 'failed', the 'elapsed' seconds and the audit_blob() result for each blob in
+    'blobs', in the order of {blobs}
+
+    Arguments:
+    {blobs}: (path, expected SHA-256 or None) pairs, as from find_blobs()
+    {public_key}: the public key to check signatures with
+    """
+    workers = workers or os.cpu_count() or 1
+    started = time.monotonic()
+    chunksize = max(1, len(blobs) // (workers * CHUNKS_PER_WORKER))
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=_init_worker,
+                                                initargs=(public_key.export_key(format='DER'),)) as pool:
+        results = list(pool.map(_audit_one, blobs, chunksize=chunksize))
+    return {
+        'public_key': key_fingerprint(public_key),
+        'checked': len(results),
+        'failed': sum(not result['ok'] for result in results),
+        'workers': workers,
+        'elapsed': time.monotonic() - started,
+        'blobs': results,
+    }
+
+
+def write_report(path, report):
+    """Writes {report} to {path} as JSON, replacing the file atomically."""
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as fp:
+        json.dump(report, fp, indent=1)
+    os.replace(tmp, path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Firmware Archive Auditor')
+    parser.add_argument("--path", help="Directory of blobs, or an artifact store, to audit.", required=True)
+    parser.add_argument("--public-key", help="Public key (or bl_build secrets) to check signatures with.",
+                        required=True)
+    parser.add_argument("--report", help="Where to write the JSON report.", required=True)
+    parser.add_argument("--pattern", help="File names to audit in a directory.", default=PATTERN)
+    parser.add_argument("--workers", help="Processes to check blobs with (default: one per core).", type=int,
+                        default=None)
+    args = parser.parse_args()
+
+    blobs = find_blobs(args.path, args.pattern)
+    report = audit(blobs, load_public_key(args.public_key), workers=args.workers)
+    write_report(args.report, report)
+    print('{} blobs checked by {} workers in {:.2f} s ({:.0f} per second), {} failed'.format(
+        report['checked'], report['workers'], report['elapsed'],
+        report['checked'] / report['elapsed'] if report['elapsed'] else 0, report['failed']))
+    for result in report['blobs']:
+        if not result['ok']:
+            print('FAILED {}: {}'.format(result['path'], '; '.join(result['problems'])))
+    raise SystemExit(1 if report['failed'] else 0)
@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+"""
+Firmware Blob Reader
+
+Splits a firmware blob made by fw_protect into its parts and checks it against the rules the
+bootloader applies in load_firmware().
+
+f = unencrypted firmware
+F = encrypted firmware
+metadata = version | size(f) | size(F)
+signed(hash(metadata | IV | F)) | metadata | IV | F
+
+That is a blob signed with RSA, as bootloader.c expects. A blob signed with an elliptic-curve key
+starts with a typed prefix, which is signed along with the rest:
+
+prefix = MAGIC | signature type | cipher
+prefix | signed(hash(prefix | metadata | IV | F)) | metadata | IV | F
+
+and its signature is 64 bytes instead of 256: Ed25519 over the SHA-256 digest, or ECDSA P-256 over
+SHA-256 (r | s). A blob without the prefix is an RSA blob.
+
+The cipher in the prefix is CBC (F is AES-CBC under the IV, as bootloader.c decrypts it) or GCM.
+In a GCM blob the padded firmware is cut into GCM_DATA_LENGTH byte pieces, and each is sealed with
+AES-GCM on its own, using the first 12 bytes of the IV and the piece number (>I) as the 16 byte
+nonce and the metadata as associated data. Its ciphertext followed by its tag makes a segment of
+at most GCM_SEGMENT_LENGTH bytes (one full sequenced frame), and F is the segments one after the
+other. A receiver can then authenticate and decrypt F a segment at a time as it arrives, and the
+segments can be sealed and opened in parallel. A GCM blob always has the prefix, whatever its key.
+
+If the top bit of the cipher byte (FLAG_SEGMENTS) is set, f is not one run from FW_BASE but
+several runs that are programmed at the addresses in a segment map, which follows the metadata
+and is signed with it:
+
+segment map = count (>H) | count x (address (>I) | length (>I))
+prefix | signed(hash(prefix | metadata | segment map | IV | F)) | metadata | segment map | IV | F
+
+size(f) is then the sum of the lengths, and F holds the runs one after the other (see fw_image).
+
+parse_blob() slices whatever it is given, so passing a memoryview (of an mmap, for example) gives
+views into it instead of copies.
+"""
+import argparse
+import collections
+import hashlib
+import hmac
+import struct
+
+SIGNATURE_LENGTH = 256 # the RSA signature is 256 bytes long
+METADATA_LENGTH = 6 # version | size(f) | size(F)
+IV_LENGTH = 16 # the IV is 16 bytes long
+HEADER_LENGTH = SIGNATURE_LENGTH + METADATA_LENGTH + IV_LENGTH # everything before F in an RSA blob
+MAX_ENCRYPTED_DATA_SIZE = 31744 # largest size(F) the bootloader's receive buffer can hold
+FLASH_PAGESIZE = 1024 # the bootloader programs F into flash a page at a time
+FW_BASE = 0x10000 # where the bootloader programs f
+PAGE_DIGEST_LENGTH = 8 # bytes of HMAC-SHA256 kept per page in page manifests
+PAGE_DIGEST_LABEL = b'EMBS page digest' # what the page digest key is derived from the AES key with
+
+# Typed prefix
+MAGIC = b'EMBS'
+PREFIX_LENGTH = len(MAGIC) + 2 # MAGIC | signature type | cipher
+SIG_RSA = 0
+SIG_ED25519 = 1
+SIG_P256 = 2
+SIGNATURE_TYPES = {'rsa': SIG_RSA, 'ed25519': SIG_ED25519, 'p256': SIG_P256}
+SIGNATURE_LENGTHS = {SIG_RSA: SIGNATURE_LENGTH, SIG_ED25519: 64, SIG_P256: 64}
+CIPHER_CBC = 0
+CIPHER_GCM = 1
+CIPHERS = {'cbc': CIPHER_CBC, 'gcm': CIPHER_GCM}
+FLAG_SEGMENTS = 0x80 # set in the cipher byte when a segment map follows the metadata
+SEGMENT = struct.Struct('>II') # address | length
+MAX_SEGMENTS = 64
+GCM_TAG_LENGTH = 16
+GCM_SEGMENT_LENGTH = 1024 # bytes of F per GCM segment, tag included
+GCM_DATA_LENGTH = GCM_SEGMENT_LENGTH - GCM_TAG_LENGTH # bytes of padded firmware per segment
+
+Blob = collections.namedtuple('Blob', ['prefix', 'signature', 'metadata', 'segment_map', 'iv', 'firmware', 'version',
+                                       'size', 'encrypted_size', 'sig_type', 'cipher', 'segments', 'header_length'])
+
+
+def parse_blob(firmware_blob):
+    """
+    Returns: a Blob with the prefix (empty for an RSA blob), signature, metadata, segment map
+    (empty if there is none), IV and F sections of {firmware_blob}, the version, size(f) and size(F)
+    fields of the metadata, the signature type and cipher of the prefix, the (address, length) pairs
+    of the segment map (None if there is none) and the length of everything before F
+
+    Throws a ValueError if the blob is too short to hold its header or has an unknown signature type.
+    """
+    sig_type, cipher, prefix_length = SIG_RSA, CIPHER_CBC, 0
+    if firmware_blob[:len(MAGIC)] == MAGIC and len(firmware_blob) >= PREFIX_LENGTH:
+        sig_type, cipher, prefix_length = firmware_blob[len(MAGIC)], firmware_blob[len(MAGIC) + 1], PREFIX_LENGTH
+        if sig_type not in SIGNATURE_LENGTHS:
+            raise ValueError("Firmware blob has unknown signature type {}".format(sig_type))
+    metadata_start = prefix_length + SIGNATURE_LENGTHS[sig_type]
+    map_start = metadata_start + METADATA_LENGTH
+    iv_start = map_start
+    segments = None
+    if cipher & FLAG_SEGMENTS:
+        if len(firmware_blob) < map_start + 2:
+            raise ValueError("Firmware blob is too short to hold its segment map")
+        count = struct.unpack_from('>H', firmware_blob, map_start)[0]
+        if count > MAX_SEGMENTS:
+            raise ValueError("Firmware blob has {} segments, more than {}".format(count, MAX_SEGMENTS))
+        iv_start = map_start + 2 + count * SEGMENT.size
+        if len(firmware_blob) < iv_start:
+            raise ValueError("Firmware blob is too short to hold its segment map")
+        segments = [SEGMENT.unpack_from(firmware_blob, map_start + 2 + i * SEGMENT.size) for i in range(count)]
+    header_length = iv_start + IV_LENGTH
+    if len(firmware_blob) < header_length:
+        raise ValueError("Firmware blob is {} bytes, shorter than its {} byte header".format(
+            len(firmware_blob), header_length))
+    version, size, encrypted_size = struct.unpack_from('<HHH', firmware_blob, metadata_start)
+    return Blob(
+        prefix=firmware_blob[:prefix_length],
+        signature=firmware_blob[prefix_length: metadata_start],
+        metadata=firmware_blob[metadata_start: map_start],
+        segment_map=firmware_blob[map_start: iv_start],
+        iv=firmware_blob[iv_start: header_length],
+        firmware=firmware_blob[header_length:],
+        version=version,
+        size=size,
+        encrypted_size=encrypted_size,
+        sig_type=sig_type,
+        cipher=cipher & ~FLAG_SEGMENTS,
+        segments=segments,
+        header_length=header_length,
+    )
+
+
+def check_blob(firmware_blob):
+    """
+    Checks the structure of {firmware_blob} against the bootloader's rules.
+
+    Returns: a list of the problems found (empty if the blob is well-formed)
+    """
+    try:
+        blob = parse_blob(firmware_blob)
+    except ValueError as e:
+        return [str(e)]
+    problems = []
+    if blob.cipher not in CIPHERS.values():
+        problems.append("cipher {} is not one the bootloader supports".format(blob.cipher))
+    if blob.segments is not None:
+        problems.extend(check_segments(blob.segments, blob.size))
+    if blob.cipher == CIPHER_GCM and 0 < blob.encrypted_size % GCM_SEGMENT_LENGTH <= GCM_TAG_LENGTH:
+        problems.append("size(F) {} leaves a GCM segment with no data".format(blob.encrypted_size))
+    if blob.encrypted_size != len(blob.firmware):
+        problems.append("size(F) is {} but the blob holds {} bytes of F".format(blob.encrypted_size, len(blob.firmware)))
+    if blob.encrypted_size % 16 != 0:
+        problems.append("size(F) {} is not a multiple of 16".format(blob.encrypted_size))
+    if blob.encrypted_size > MAX_ENCRYPTED_DATA_SIZE:
+        problems.append("size(F) {} is larger than MAX_ENCRYPTED_DATA_SIZE ({})".format(
+            blob.encrypted_size, MAX_ENCRYPTED_DATA_SIZE))
+    if blob.size >= blob.encrypted_size: # F also holds the release message, its terminator and padding
+        problems.append("size(f) {} does not fit in size(F) {}".format(blob.size, blob.encrypted_size))
+    return problems
+
+
+def check_segments(segments, size):
+    """
+    Returns: a list of the problems with a segment map of {segments} for an f of {size} bytes
+    """
+    problems = []
+    if not segments:
+        problems.append("the segment map is empty")
+    if sum(length for _, length in segments) != size:
+        problems.append("the segments hold {} bytes but size(f) is {}".format(
+            sum(length for _, length in segments), size))
+    end = FW_BASE
+    for address, length in segments:
+        if address % FLASH_PAGESIZE:
+            problems.append("segment at 0x{:x} does not start on a flash page".format(address))
+        if address < end:
+            problems.append("segment at 0x{:x} lies below FW_BASE or overlaps the segment before it".format(address))
+        end = address + length
+    return problems
+
+
+def page_digest_key(aes_key):
+    """
+    Returns: the key page digests are made with for firmware encrypted with {aes_key}:
+    HMAC-SHA256(aes_key, PAGE_DIGEST_LABEL)
+    """
+    return hmac.new(aes_key, PAGE_DIGEST_LABEL, hashlib.sha256).digest()
+
+
+def page_digests(image, aes_key):
+    """
+    Returns: the digest of each flash page that {image} (decrypted F) occupies once it is programmed
+    from FW_BASE. A partial last page is digested as flash holds it, with the rest of the page erased.
+    
+    A digest is HMAC-SHA256 under page_digest_key({aes_key}) of the page number (>H) and the page,
+    so without the AES key the digests published in a manifest, or sent by the bootloader, cannot
+    be used to check guesses at the firmware.
+    """
+    key = page_digest_key(aes_key)
+    digests = []
+    for number, start in enumerate(range(0, len(image), FLASH_PAGESIZE)):
+        page = bytes(image[start: start + FLASH_PAGESIZE]).ljust(FLASH_PAGESIZE, b'\xff')
+        digests.append(hmac.new(key, struct.pack('>H', number) + page, hashlib.sha256).digest()[:PAGE_DIGEST_LENGTH])
+    return digests
+
+
+def import_key(data):
+    """
+    Returns: the RSA or elliptic-curve key object for the PEM {data}
+    """
+    from Crypto.PublicKey import ECC, RSA
+    try:
+        return RSA.import_key(data)
+    except ValueError:
+        return ECC.import_key(data)
+
+
+def signature_type(key):
+    """
+    Returns: the signature type (SIG_RSA, SIG_ED25519 or SIG_P256) that {key} makes or checks
+    """
+    if hasattr(key, 'n'):
+        return SIG_RSA
+    if key.curve == 'Ed25519':
+        return SIG_ED25519
+    if key.curve == 'NIST P-256':
+        return SIG_P256
+    raise ValueError("Keys on curve {} cannot sign firmware".format(key.curve))
+
+
+def gcm_nonce(iv, index):
+    """
+    Returns: the nonce GCM segment {index} is sealed with: the first 12 bytes of {iv} and {index}
+    """
+    return bytes(iv[:12]) + struct.pack('>I', index)
+
+
+def gcm_segments(firmware):
+    """
+    Returns: the segments of a GCM blob's F, each its ciphertext followed by its tag
+    """
+    return [firmware[start: start + GCM_SEGMENT_LENGTH] for start in range(0, len(firmware), GCM_SEGMENT_LENGTH)]
+
+
+def open_segment(aes_key, iv, metadata, index, segment):
+    """
+    Returns: the decrypted data of GCM segment {index}
+
+    Throws a ValueError if its tag does not match.
+    """
+    from Crypto.Cipher import AES
+    cipher = AES.new(aes_key, AES.MODE_GCM, nonce=gcm_nonce(iv, index), mac_len=GCM_TAG_LENGTH)
+    cipher.update(bytes(metadata))
+    return cipher.decrypt_and_verify(bytes(segment[:-GCM_TAG_LENGTH]), bytes(segment[-GCM_TAG_LENGTH:]))
+
+
+def decrypt_blob(firmware_blob, aes_key, workers=None):
+    """
+    Decrypts F as the bootloader does: the whole of it in CBC mode, or segment by segment in GCM
+    mode, checking each segment's tag. GCM segments are opened by {workers} threads.
+
+    Returns: the decrypted F (f, the release message, its terminator and padding)
+
+    Throws a ValueError if a GCM tag does not match, naming the first bad segment.
+    """
+    import concurrent.futures
+    from Crypto.Cipher import AES
+    blob = parse_blob(firmware_blob)
+    if blob.cipher == CIPHER_CBC:
+        return AES.new(aes_key, AES.MODE_CBC, iv=bytes(blob.iv)).decrypt(bytes(blob.firmware))
+    if blob.cipher != CIPHER_GCM:
+        raise ValueError("Firmware blob has unknown cipher {}".format(blob.cipher))
+
+    def open_one(item):
+        index, segment = item
+        try:
+            return open_segment(aes_key, blob.iv, blob.metadata, index, segment)
+        except ValueError:
+            raise ValueError("GCM segment {} failed authentication".format(index)) from None
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        return b''.join(pool.map(open_one, enumerate(gcm_segments(blob.firmware))))
+
+
+def load_public_key(path):
+    """
+    Reads the public key used to check blob signatures.
+
+    Returns: the public key object (RSA, Ed25519 or P-256)
+
+    Arguments:
+    {path}: a PEM public key, or the secrets file written by bl_build (the public half is used)
+    """
+    with open(path, 'rb') as fp:
+        data = fp.read()
+    if not data.startswith(b'-----BEGIN'):
+        data = data[16:] # the secrets file starts with the AES key
+    return import_key(data).public_key()
+
+
+def key_fingerprint(public_key):
+    """
+    Returns: a short hex fingerprint of {public_key}
+    """
+    return hashlib.sha256(public_key.export_key(format='DER')).hexdigest()[:16]
+
+
+def signed_digest(blob):
+    """
+    Returns: the SHA-256 hash object of the signed part of the parsed {blob}:
+    prefix | metadata | segment map | IV | F
+    """
+    from Crypto.Hash import SHA256
+    digest = SHA256.new()
+    for section in (blob.prefix, blob.metadata, blob.segment_map, blob.iv, blob.firmware):
+        digest.update(section)
+    return digest
+
+
+def verify_digest(sig_type, digest, signature, public_key):
+    """
+    Returns: True if {signature} of type {sig_type} over the SHA-256 hash object {digest} is valid
+    under {public_key}
+    """
+    from Crypto.Signature import DSS, eddsa, pkcs1_15
+    if signature_type(public_key) != sig_type:
+        return False
+    try:
+        if sig_type == SIG_RSA:
+            pkcs1_15.new(public_key).verify(digest, bytes(signature))
+        elif sig_type == SIG_ED25519:
+            eddsa.new(public_key, 'rfc8032').verify(digest.digest(), bytes(signature))
+        else:
+            DSS.new(public_key, 'fips-186-3').verify(digest, bytes(signature))
+    except ValueError:
+        return False
+    return True
+
+
+def verify_signature(firmware_blob, public_key):
+    """
+    Returns: True if the signature of {firmware_blob} is valid under {public_key}
+    """
+    blob = parse_blob(firmware_blob)
+    return verify_digest(blob.sig_type, signed_digest(blob), blob.signature, public_key)
+
+
+def benchmark(firmware_blob, public_key, trials=100):
+    """
+    Returns: the mean seconds taken to check the signature of {firmware_blob} under {public_key}
+    (hashing included)
+    """
+    import time
+    started = time.perf_counter()
+    for _ in range(trials):
+        verify_signature(firmware_blob, public_key)
+    return (time.perf_counter() - started) / trials
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Firmware Blob Reader')
+    parser.add_argument("--firmware", help="Path to the firmware blob.", required=True)
+    parser.add_argument("--public-key", help="Public key (or bl_build secrets) to check the signature with.",
+                        default=None)
+    parser.add_argument("--benchmark", help="Time the signature check over this many trials.", type=int,
+                        default=0)
+    parser.add_argument("--secrets", help="bl_build secrets to decrypt F (and check its GCM tags) with.",
+                        default=None)
+    args = parser.parse_args()
+
+    with open(args.firmware, 'rb') as fp:
+        firmware_blob = fp.read()
+    blob = parse_blob(firmware_blob)
+    names = {value: name for name, value in SIGNATURE_TYPES.items()}
+    print('Version: {}\nFirmware Size: {} bytes\nEncrypted Firmware size: {}'.format(
+        blob.version, blob.size, blob.encrypted_size))
+    ciphers = {value: name for name, value in CIPHERS.items()}
+    print('Signature type: {} ({} byte header)\nCipher: {}'.format(
+        names[blob.sig_type], blob.header_length, ciphers.get(blob.cipher, blob.cipher)))
+    for address, length in blob.segments or ():
+        print('Segment: 0x{:08x}-0x{:08x} ({} bytes)'.format(address, address + length, length))
+    for problem in check_blob(firmware_blob):
+        print('Problem: {}'.format(problem))
+    if args.public_key is not None:
+        public_key = load_public_key(args.public_key)
+        valid = verify_signature(firmware_blob, public_key)
+        print('Signature: {}'.format('valid' if valid else 'INVALID'))
+        if args.benchmark:
+            print('Verification: {:.3f} ms'.format(benchmark(firmware_blob, public_key, args.benchmark) * 1e3))
+    if args.secrets is not None:
+        with open(args.secrets, 'rb') as fp:
+            aes_key = fp.read(16)
+        try:
+            image = decrypt_blob(firmware_blob, aes_key)
+        except ValueError as e:
+            print('Decryption: FAILED ({})'.format(e))
+        else:
+            print('Decryption: ok, release message {!r}'.format(
+                image[blob.size:].split(b'\x00', 1)[0].decode(errors='replace')))
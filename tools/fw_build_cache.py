@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+Firmware Build Cache
+
+Remembers the blobs fw_protect has made, so that protecting the same firmware image again with the
+same version, release message and signing key returns the earlier blob instead of encrypting and
+signing it again.
+
+A cache key is the SHA-256 of the input image, the version, the message, the fingerprint of the
+signing key, a fingerprint of the AES key (a truncated HMAC, which does not give the key away) and
+the cipher, so a blob encrypted under an AES key that has since been replaced is never served.
+Each entry is two files in the cache directory, {key}.blob and its page manifest {key}.pages. A hit touches the entry, and put() evicts the least recently used entries once the
+cache holds more than its size limit.
+
+The cache is only a shortcut: fw_protect checks the signature of a cached blob against the current
+key (and that it carries the right version) before it uses it, and protects the image again if not.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import pathlib
+import struct
+
+CACHE_DIR = pathlib.Path(__file__).parent.absolute() / '.build_cache'
+MAX_CACHE_BYTES = 16 * 1024 * 1024
+AES_KEY_LABEL = b'EMBS build cache' # what the AES key fingerprint is made from
+
+
+def aes_key_id(aes_key):
+    """
+    Returns: a short hex fingerprint of {aes_key}: HMAC-SHA256(aes_key, AES_KEY_LABEL), truncated
+    """
+    return hmac.new(aes_key, AES_KEY_LABEL, hashlib.sha256).hexdigest()[:16]
+
+
+def cache_key(image, version, message, key_id, aes_key, cipher='cbc'):
+    """
+    Returns: the cache key (hex) for protecting {image} as {version} with release {message} using
+    the signing key with fingerprint {key_id}, the {aes_key} and the {cipher}
+    """
+    digest = hashlib.sha256()
+    digest.update(hashlib.sha256(image).digest())
+    digest.update(struct.pack('<H', version))
+    digest.update(hashlib.sha256(message.encode()).digest())
+    digest.update(key_id.encode())
+    digest.update(aes_key_id(aes_key).encode())
+    digest.update(cipher.encode())
+    return digest.hexdigest()
+
+
+class BuildCache:
+    """
+    A directory of protected blobs by cache key.
+
+    Arguments:
+    {path}: the cache directory (created if it does not exist)
+    {max_bytes}: how much the entries may take before the least recently used are evicted
+    """
+
+    def __init__(self, path=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def get(self, key):
+        """
+        Returns: (blob, page manifest) cached under {key}, or None
+        """
+        blob_path, manifest_path = self.path / (key + '.blob'), self.path / (key + '.pages')
+        try:
+            with open(blob_path, 'rb') as fp:
+                blob = fp.read()
+            with open(manifest_path) as fp:
+                manifest = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return None
+        os.utime(blob_path) # most recently used
+        return blob, manifest
+
+    def put(self, key, blob, manifest):
+        """Caches {blob} and its page {manifest} under {key} and evicts entries over the size limit."""
+        for suffix, data in (('.pages', json.dumps(manifest).encode()), ('.blob', blob)):
+            path = self.path / (key + suffix)
+            tmp = path.with_suffix('.tmp')
+            with open(tmp, 'wb') as fp:
+                fp.write(data)
+            os.replace(tmp, path)
+        self.evict()
+
+    def discard(self, key):
+        """Removes the entry for {key}, if there is one."""
+        for suffix in ('.blob', '.pages'):
+            try:
+                os.unlink(self.path / (key + suffix))
+            except FileNotFoundError:
+                pass
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in its size limit.
+
+        Returns: the keys that were removed
+        """
+        entries = []
+        for path in self.path.glob('*.blob'):
+            stat = path.stat()
+            pages = path.with_suffix('.pages')
+            entries.append((stat.st_mtime, stat.st_size + (pages.stat().st_size if pages.exists() else 0), path.stem))
+        total = sum(size for _, size, _ in entries)
+        evicted = []
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.discard(key)
+            total -= size
+            evicted.append(key)
+        return evicted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Firmware Build Cache')
+    parser.add_argument("--cache", help="Path to the cache directory.", default=CACHE_DIR)
+    parser.add_argument("--max-bytes", help="Evict entries until the cache holds at most this many bytes.",
+                        type=int, default=MAX_CACHE_BYTES)
+    args = parser.parse_args()
+
+    for key in BuildCache(args.cache, max_bytes=args.max_bytes).evict():
+        print('Evicted {}'.format(key))
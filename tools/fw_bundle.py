@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""
+Firmware Bundle
+
+Packs the blobs of a release (firmware variants, debug builds with version 0) into one file, and
+reads single blobs back out of it without reading the rest.
+
+A bundle is a fixed header, a table of contents with one fixed-size record per blob, and the blobs
+themselves, each starting on an ALIGNMENT boundary:
+
+    [ 0x04 ] [ 0x02 ]  [ 0x02 ] [ 0x04 ]     [ 0x04 ]
+    ---------------------------------------------------
+    | MAGIC | Format | Count | Alignment | Reserved |      header
+    ---------------------------------------------------
+
+    [ 0x04 ] [ 0x04 ] [ 0x02 ]  [ 0x10 ]  [ 0x20 ]  [ 0x06 ]
+    -----------------------------------------------------------
+    | Offset | Length | Version | Variant | SHA-256 | Reserved |  one per blob
+    -----------------------------------------------------------
+
+All fields are big-endian, the variant is a name of up to 16 ASCII bytes padded with NULs, and the
+version is the one in the blob's metadata. Bundle maps the file and hands out memoryviews of the
+map, so picking one blob out of a bundle copies nothing; the views are valid until the Bundle is
+closed.
+"""
+import argparse
+import collections
+import hashlib
+import mmap
+import os
+import struct
+
+from fw_blob import parse_blob
+
+MAGIC = b'EMBB'
+FORMAT = 1
+ALIGNMENT = 64 # bytes; every blob starts on a multiple of this
+HEADER = struct.Struct('>4sHHI4x') # magic | format | count | alignment
+RECORD = struct.Struct('>IIH16s32s6x') # offset | length | version | variant | SHA-256
+VARIANT_LENGTH = 16
+
+Entry = collections.namedtuple('Entry', ['offset', 'length', 'version', 'variant', 'digest'])
+
+
+def write_bundle(path, images, alignment=ALIGNMENT):
+    """
+    Writes a bundle of {images} to {path}.
+
+    Arguments:
+    {images}: (variant, firmware blob) pairs, in the order they go into the bundle
+    {alignment}: the boundary each blob starts on
+    """
+    toc_end = HEADER.size + RECORD.size * len(images)
+    offset = toc_end
+    records, payloads = [], []
+    for variant, blob in images:
+        name = variant.encode('ascii')
+        if not name or len(name) > VARIANT_LENGTH or b'\x00' in name:
+            raise ValueError("Variant name {!r} must be 1 to {} ASCII characters".format(variant, VARIANT_LENGTH))
+        offset += -offset % alignment
+        records.append(RECORD.pack(offset, len(blob), parse_blob(blob).version, name, hashlib.sha256(blob).digest()))
+        payloads.append((offset, blob))
+        offset += len(blob)
+
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, FORMAT, len(images), alignment))
+        fp.write(b''.join(records))
+        for offset, blob in payloads:
+            fp.write(b'\x00' * (offset - fp.tell()))
+            fp.write(blob)
+    os.replace(tmp, path)
+
+
+class Bundle:
+    """
+    A bundle mapped into memory.
+
+    Arguments:
+    {path}: the bundle file
+
+    Throws a ValueError if the file is not a bundle or its table of contents does not fit in it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        try:
+            self.entries = self._read_toc()
+        except ValueError:
+            self.close()
+            raise
+
+    def _read_toc(self):
+        if len(self._map) < HEADER.size:
+            raise ValueError("{} is too short to be a bundle".format(self.path))
+        magic, version, count, _ = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != FORMAT:
+            raise ValueError("{} is not a format {} bundle".format(self.path, FORMAT))
+        if HEADER.size + RECORD.size * count > len(self._map):
+            raise ValueError("{} is shorter than its table of contents".format(self.path))
+        entries = []
+        for i in range(count):
+            offset, length, version, variant, digest = RECORD.unpack_from(self._map, HEADER.size + RECORD.size * i)
+            if offset + length > len(self._map):
+                raise ValueError("{}: blob {} runs past the end of the bundle".format(self.path, i))
+            entries.append(Entry(offset, length, version, variant.rstrip(b'\x00').decode('ascii'), digest.hex()))
+        return entries
+
+    def select(self, variant, version=None):
+        """
+        Returns: the Entry of {variant} with {version}, or with the highest version if {version} is
+        None, or None if the bundle has no such blob
+        """
+        entries = [entry for entry in self.entries
+                   if entry.variant == variant and (version is None or entry.version == version)]
+        return max(entries, key=lambda entry: entry.version, default=None)
+
+    def blob(self, entry, verify=True):
+        """
+        Returns: a memoryview of the blob of {entry}
+
+        Throws a ValueError if {verify} is set and the blob does not match its digest.
+        """
+        view = self._view[entry.offset: entry.offset + entry.length]
+        if verify and hashlib.sha256(view).hexdigest() != entry.digest:
+            view.release()
+            raise ValueError("{}: the {} v{} blob does not match its digest".format(
+                self.path, entry.variant, entry.version))
+        return view
+
+    def close(self):
+        """Unmaps the bundle. Views handed out by blob() must have been released first."""
+        self._view.release()
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Firmware Bundle')
+    parser.add_argument("--bundle", help="Path to the bundle.", required=True)
+    parser.add_argument("--add", help="VARIANT=BLOB to put in a new bundle (may be repeated).", action='append',
+                        default=[])
+    args = parser.parse_args()
+
+    if args.add:
+        images = []
+        for item in args.add:
+            variant, _, path = item.partition('=')
+            if not path:
+                parser.error("--add takes VARIANT=BLOB")
+            with open(path, 'rb') as fp:
+                images.append((variant, fp.read()))
+        write_bundle(args.bundle, images)
+
+    with Bundle(args.bundle) as bundle:
+        for entry in bundle.entries:
+            print('{variant:<16} v{version:<5} {length:>6} bytes at {offset:#08x} {digest:.16}'.format(
+                **entry._asdict()))
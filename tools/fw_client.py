@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Firmware Update Client
+
+Hands an update to a running fw_daemon instead of starting fw_update, so the port is already open
+and nothing has to be imported but the standard library. The job and its result travel over the
+daemon's Unix socket as one line of JSON each:
+
+-> {"op": "update", "port": ..., "firmware": ..., <fw_update options>}
+<- {"ok": true, "result": {<the update result from fw_update.update>}}
+<- {"ok": false, "error": "..."}
+
+"status" returns the daemon's port pool, and "shutdown" stops the daemon.
+
+The socket lives in a directory only its user can enter ($XDG_RUNTIME_DIR, or /tmp/embsec-<uid>)
+and the daemon only takes jobs from its own user (see fw_daemon.py).
+"""
+import argparse
+import json
+import os
+import socket
+import tempfile
+
+
+def socket_dir():
+    """
+    Returns: the private directory the daemon's socket goes in: $XDG_RUNTIME_DIR if it is set,
+    otherwise embsec-<uid> in the temporary directory
+    """
+    return os.environ.get('XDG_RUNTIME_DIR') or os.path.join(tempfile.gettempdir(), 'embsec-{}'.format(os.getuid()))
+
+
+DAEMON_SOCKET = os.path.join(socket_dir(), 'embsec-fw-daemon.sock')
+
+
+def request(job, path=DAEMON_SOCKET, timeout=None):
+    """
+    Sends {job} (a dictionary) to the daemon listening on {path} and waits for its answer.
+
+    Returns: the daemon's reply
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(json.dumps(job).encode() + b'\n')
+        reply = b''
+        while not reply.endswith(b'\n'):
+            data = sock.recv(65536)
+            if not data:
+                raise ConnectionError("fw_daemon closed the connection without answering")
+            reply += data
+    return json.loads(reply)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Firmware Update Client')
+    parser.add_argument("--socket", help="The daemon's socket.", default=DAEMON_SOCKET)
+    parser.add_argument("--port", help="Serial port to send update over.", default=None)
+    parser.add_argument("--firmware", help="Path to firmware image to load.", default=None)
+    parser.add_argument("--frame-size", help="Number of firmware bytes per frame.", type=int, default=None)
+    parser.add_argument("--adaptive", help="Resize frames to suit the measured link quality.", action='store_true')
+    parser.add_argument("--timeout", help="Seconds to wait for each response before giving up (the daemon "
+                        "caps it, and picks one if not given).", type=float, default=None)
+    parser.add_argument("--sequenced", help="Number and checksum frames so damaged ones are sent again.",
+                        action='store_true')
+    parser.add_argument("--journal", help="Directory to record progress in.", default=None)
+    parser.add_argument("--pages", help="Page manifest; only send the pages the device does not have.", default=None)
+    parser.add_argument("--status", help="Show the daemon's ports instead of updating.", action='store_true')
+    parser.add_argument("--shutdown", help="Stop the daemon.", action='store_true')
+    args = parser.parse_args()
+
+    if args.status or args.shutdown:
+        job = {'op': 'status' if args.status else 'shutdown'}
+    else:
+        if args.port is None or args.firmware is None:
+            parser.error("--port and --firmware are required for an update")
+        job = {'op': 'update', 'port': args.port, 'firmware': os.path.abspath(args.firmware),
+               'adaptive': args.adaptive, 'sequenced': args.sequenced, 'timeout': args.timeout}
+        if args.frame_size is not None:
+            job['frame_size'] = args.frame_size
+        if args.journal is not None:
+            job['journal'] = os.path.abspath(args.journal)
+        if args.pages is not None:
+            job['pages'] = os.path.abspath(args.pages)
+
+    reply = request(job, path=args.socket)
+    if not reply['ok']:
+        raise SystemExit("ERROR: {}".format(reply['error']))
+    print(json.dumps(reply.get('result'), indent=2))
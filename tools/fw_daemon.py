@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+"""
+Firmware Update Daemon
+
+A long-running process that keeps device serial ports open and runs update jobs sent to it by
+fw_client over a Unix socket (see fw_client.py for the request format). A flashing station pays for
+starting Python and opening each port once instead of once per update.
+
+Ports live in a PortPool. A job leases its port for the whole update, so two jobs never talk to the
+same device at once, while jobs for different ports run side by side. A port is opened when it is
+first leased and kept open afterwards. A background thread checks idle ports every
+HEALTH_INTERVAL seconds and closes any that have gone away (a device unplugged, say) so that the
+next lease opens them afresh, and a port whose update fails with a serial error is closed the same
+way.
+
+A job names files to read and a port to drive, so only the daemon's own user may send one: the
+socket is created with mode 0600 in a directory only that user can enter, and every connection's
+peer credentials are checked. With --allow, the files a job names must also lie under one of the
+allowed directories.
+"""
+import argparse
+import contextlib
+import json
+import os
+import socket
+import socketserver
+import stat
+import struct
+import threading
+import time
+
+from serial import Serial, SerialException
+
+import fw_update
+from fw_client import DAEMON_SOCKET, socket_dir
+from fw_journal import Journal
+
+HEALTH_INTERVAL = 5 # seconds between health checks of idle ports
+LEASE_TIMEOUT = 600 # seconds a job waits for a busy port before giving up
+JOB_TIMEOUT = 10 # seconds a job waits for any one response from the device if it does not say
+MAX_JOB_TIMEOUT = 120 # the longest a job may wait for any one response
+
+# fw_update.update options a job may set (and 'timeout', see job_timeout)
+JOB_OPTIONS = ('debug', 'frame_size', 'adaptive', 'sequenced', 'retries')
+JOB_PATHS = ('firmware', 'pages', 'journal') # job fields that name files or directories
+
+
+def private_dir(path):
+    """
+    Makes sure the directory {path} exists, belongs to this user and is closed to everyone else,
+    creating it with mode 0700 if need be.
+
+    Throws a PermissionError if it belongs to another user or others can enter it.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise PermissionError("{} must be a directory of this user that no one else can enter".format(path))
+
+
+def peer_uid(sock):
+    """
+    Returns: the user ID of the process at the other end of the Unix socket {sock}, or None where
+    the platform does not say
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    _, uid, _ = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+    return uid
+
+
+def check_paths(job, allowed):
+    """
+    Throws a PermissionError if a file {job} names does not lie under one of the {allowed}
+    directories (None allows any).
+    """
+    if allowed is None:
+        return
+    for name in JOB_PATHS:
+        if job.get(name) is None:
+            continue
+        path = os.path.realpath(job[name])
+        if not any(os.path.commonpath([path, root]) == root for root in allowed):
+            raise PermissionError("{} {} is not under an allowed directory".format(name, job[name]))
+
+
+def job_timeout(timeout):
+    """
+    Returns: the seconds an update job that asked for {timeout} waits for any one response:
+    JOB_TIMEOUT if it gave None, and never more than MAX_JOB_TIMEOUT. A job never waits for ever, as
+    it would hold its port's lease until the daemon restarted if the device had died.
+
+    Throws a ValueError if {timeout} is not a positive number.
+    """
+    if timeout is None:
+        return JOB_TIMEOUT
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or not timeout > 0:
+        raise ValueError("timeout must be a positive number of seconds, not {!r}".format(timeout))
+    return min(timeout, MAX_JOB_TIMEOUT)
+
+
+def open_port(port):
+    """
+    Returns: {port} opened the way fw_update opens it
+    """
+    return Serial(port, baudrate=115200, timeout=2)
+
+
+def port_healthy(port, ser):
+    """
+    Returns: False if the open port {ser} named {port} can no longer be used
+    """
+    return ser.is_open and os.path.exists(port)
+
+
+class PortPool:
+    """
+    Open serial ports with exclusive leases.
+
+    Arguments:
+    {opener}: opens a port given its name
+    {healthy}: tells whether an idle port (given its name and the open port) is still usable
+    """
+
+    def __init__(self, opener=open_port, healthy=port_healthy):
+        self.opener = opener
+        self.healthy = healthy
+        self._lock = threading.Lock()
+        self._ports = {} # name -> {'lock', 'ser', 'jobs', 'failures', 'opened', 'leased'}
+
+    def _slot(self, port):
+        with self._lock:
+            return self._ports.setdefault(port, {'lock': threading.Lock(), 'ser': None, 'jobs': 0, 'failures': 0,
+                                                 'opened': None, 'leased': False})
+
+    @contextlib.contextmanager
+    def lease(self, port, timeout=LEASE_TIMEOUT):
+        """
+        Gives the caller sole use of {port}, opening it if it is not open.
+
+        Throws a TimeoutError if another job holds the port for longer than {timeout} seconds.
+        """
+        slot = self._slot(port)
+        if not slot['lock'].acquire(timeout=timeout):
+            raise TimeoutError("{} is busy".format(port))
+        try:
+            slot['leased'] = True
+            if slot['ser'] is None:
+                slot['ser'] = self.opener(port)
+                slot['opened'] = time.time()
+            if hasattr(slot['ser'], 'reset_input_buffer'):
+                slot['ser'].reset_input_buffer() # anything left over from the last job
+            try:
+                yield slot['ser']
+            except (SerialException, OSError):
+                slot['failures'] += 1
+                self._close(slot)
+                raise
+            finally:
+                slot['jobs'] += 1
+        finally:
+            slot['leased'] = False
+            slot['lock'].release()
+
+    @staticmethod
+    def _close(slot):
+        ser, slot['ser'] = slot['ser'], None
+        if ser is not None:
+            try:
+                ser.close()
+            except (SerialException, OSError):
+                pass
+
+    def check(self):
+        """
+        Closes every idle port that is no longer usable.
+
+        Returns: the names of the ports that were closed
+        """
+        closed = []
+        with self._lock:
+            slots = list(self._ports.items())
+        for port, slot in slots:
+            if not slot['lock'].acquire(blocking=False):
+                continue # in use, so evidently still there
+            try:
+                ser = slot['ser']
+                if ser is not None and not self.healthy(port, ser):
+                    slot['failures'] += 1
+                    self._close(slot)
+                    closed.append(port)
+            finally:
+                slot['lock'].release()
+        return closed
+
+    def close(self):
+        """Closes every port."""
+        with self._lock:
+            slots = list(self._ports.values())
+        for slot in slots:
+            with slot['lock']:
+                self._close(slot)
+
+    def status(self):
+        """
+        Returns: a dictionary describing each port in the pool
+        """
+        with self._lock:
+            return {port: {'open': slot['ser'] is not None, 'leased': slot['leased'], 'jobs': slot['jobs'],
+                           'failures': slot['failures'], 'opened': slot['opened']}
+                    for port, slot in self._ports.items()}
+
+
+def run_job(pool, job):
+    """
+    Runs one update job, holding a lease on its port.
+
+    Returns: the update result from fw_update.update
+    """
+    with open(job['firmware'], 'rb') as fp:
+        firmware_blob = fp.read()
+    options = {name: job[name] for name in JOB_OPTIONS if job.get(name) is not None}
+    options['timeout'] = job_timeout(job.get('timeout'))
+    if job.get('journal') is not None:
+        options['journal'] = Journal(job['journal'])
+        options['device'] = job.get('device', job['port'])
+        options['sequenced'] = True
+    if job.get('pages') is not None:
+        with open(job['pages']) as fp:
+            options['manifest'] = json.load(fp)
+    with pool.lease(job['port']) as ser:
+        return fw_update.update(ser, firmware_blob, **options)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """Reads one JSON job from the connection and answers it with one JSON reply."""
+
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline()) # read first, so the client is not cut off mid-send
+            uid = peer_uid(self.request)
+            if uid is not None and uid not in (os.getuid(), 0):
+                raise PermissionError("jobs are only taken from the daemon's own user")
+            op = job.get('op')
+            if op == 'update':
+                check_paths(job, self.server.allowed)
+                reply = {'ok': True, 'result': run_job(self.server.pool, job)}
+            elif op == 'status':
+                reply = {'ok': True, 'result': self.server.pool.status()}
+            elif op == 'shutdown':
+                reply = {'ok': True, 'result': None}
+                threading.Thread(target=self.server.shutdown, daemon=True).start()
+            else:
+                reply = {'ok': False, 'error': "Unknown operation {!r}".format(op)}
+        except Exception as e: # the daemon outlives any one job, so every failure goes back to the client
+            reply = {'ok': False, 'error': '{}: {}'.format(type(e).__name__, e)}
+        self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+class Daemon(socketserver.ThreadingUnixStreamServer):
+    """
+    The update daemon: a Unix socket server with a PortPool and a health check thread.
+
+    Arguments:
+    {path}: the socket to listen on (replaced if it exists); created with mode 0600, and in the
+        default location its directory is made private (see private_dir)
+    {pool}: the PortPool to run jobs with
+    {interval}: seconds between health checks
+    {allowed}: directories the files a job names must lie under, or None to allow any
+    """
+    daemon_threads = True
+
+    def __init__(self, path=DAEMON_SOCKET, pool=None, interval=HEALTH_INTERVAL, allowed=None):
+        if os.path.dirname(os.path.abspath(path)) == os.path.abspath(socket_dir()):
+            private_dir(socket_dir())
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self.pool = pool if pool is not None else PortPool()
+        self.interval = interval
+        self.allowed = [os.path.realpath(root) for root in allowed] if allowed is not None else None
+        self._stopped = threading.Event()
+        umask = os.umask(0o177) # the socket is created 0600, with no moment when others could connect
+        try:
+            super().__init__(path, Handler)
+        finally:
+            os.umask(umask)
+        threading.Thread(target=self._health_checks, daemon=True).start()
+
+    def _health_checks(self):
+        while not self._stopped.wait(self.interval):
+            for port in self.pool.check():
+                print('Closed {}: it is no longer usable'.format(port))
+
+    def server_close(self):
+        self._stopped.set()
+        super().server_close()
+        self.pool.close()
+        try:
+            os.unlink(self.server_address)
+        except FileNotFoundError:
+            pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Firmware Update Daemon')
+    parser.add_argument("--socket", help="Unix socket to accept jobs on.", default=DAEMON_SOCKET)
+    parser.add_argument("--interval", help="Seconds between health checks of idle ports.", type=float,
+                        default=HEALTH_INTERVAL)
+    parser.add_argument("--allow", help="Only take jobs whose files lie under this directory (may be given "
+                        "more than once).", action='append', default=None)
+    args = parser.parse_args()
+
+    with Daemon(args.socket, interval=args.interval, allowed=args.allow) as daemon:
+        print('Waiting for jobs on {}'.format(args.socket))
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
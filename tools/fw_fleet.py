@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+"""
+Fleet Rollout Scheduler
+
+Updates many devices at once from an inventory, a CSV file with one device per row:
+
+port,firmware,hub,group
+/dev/ttyUSB0,releases/v3.blob,hub-a,canary
+/dev/ttyUSB1,releases/v3.blob,hub-a,production
+
+hub is the USB hub the device hangs off (devices behind one hub share its bandwidth) and group is a
+name used to order the rollout; both may be left empty (a device with no hub is only held to the
+global limit).
+
+At most {concurrency} updates run at a time, and at most {hub_concurrency} behind any one hub.
+Devices are started in group order (the groups given by --groups first, in that order, then the
+rest), and in inventory order within a group. A failed update is tried again after a backoff that
+doubles with each attempt, up to {attempts} attempts.
+
+Every start, success and failure is appended to a JSON-lines progress log and flushed to disk before
+the scheduler goes on, so if the scheduler is killed, running it again with the same log skips the
+devices that already have their firmware and carries on with the rest.
+"""
+import argparse
+import csv
+import json
+import os
+import threading
+import time
+
+from fw_journal import blob_hash
+
+CONCURRENCY = 8 # updates at once across the fleet
+HUB_CONCURRENCY = 4 # updates at once behind one USB hub
+ATTEMPTS = 3 # tries per device
+BACKOFF = 5 # seconds before the first retry; doubles with every retry after it
+MAX_BACKOFF = 300
+
+
+def read_inventory(path):
+    """
+    Returns: the devices in an inventory CSV, as dictionaries with 'port', 'firmware', 'hub' and
+    'group'
+    """
+    devices = []
+    with open(path, newline='') as fp:
+        for row in csv.DictReader(fp):
+            devices.append({
+                'port': row['port'],
+                'firmware': row['firmware'],
+                'hub': row.get('hub') or '',
+                'group': row.get('group') or '',
+            })
+    return devices
+
+
+class ProgressLog:
+    """
+    An append-only JSON-lines log of rollout events, written through to disk.
+
+    Arguments:
+    {path}: the log file (appended to if it exists)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def completed(self):
+        """
+        Returns: the set of (port, blob hash) pairs the log records as updated
+        """
+        done = set()
+        try:
+            with open(self.path) as fp:
+                for line in fp:
+                    try:
+                        event = json.loads(line)
+                    except ValueError: # the last line of a log that was cut off
+                        continue
+                    if event.get('event') == 'done':
+                        done.add((event['port'], event['blob']))
+        except FileNotFoundError:
+            pass
+        return done
+
+    def write(self, **event):
+        """Appends {event} (with the time) to the log and waits until it is on disk."""
+        event['time'] = time.time()
+        with self._lock:
+            with open(self.path, 'a') as fp:
+                fp.write(json.dumps(event) + '\n')
+                fp.flush()
+                os.fsync(fp.fileno())
+
+
+def serial_runner(port, firmware, **options):
+    """
+    Updates the device on {port} with the blob at {firmware} over its own serial connection.
+
+    Returns: the update result from fw_update.update
+    """
+    from serial import Serial
+    import fw_update
+    with open(firmware, 'rb') as fp:
+        firmware_blob = fp.read()
+    with Serial(port, baudrate=115200, timeout=2) as ser:
+        return fw_update.update(ser, firmware_blob, **options)
+
+
+def daemon_runner(path):
+    """
+    Returns: a runner that hands each update to the fw_daemon listening on {path}
+    """
+    from fw_client import request
+
+    def run(port, firmware, **options):
+        reply = request(dict(options, op='update', port=port, firmware=os.path.abspath(firmware)), path=path)
+        if not reply['ok']:
+            raise RuntimeError(reply['error'])
+        return reply['result']
+    return run
+
+
+class Scheduler:
+    """
+    Runs a rollout.
+
+    Arguments:
+    {devices}: the inventory, from read_inventory()
+    {runner}: called as runner(port, firmware, **options) to update one device; it returns the
+        update result or throws an exception if the update failed
+    {log}: a ProgressLog, or None
+    {concurrency}, {hub_concurrency}, {attempts}, {backoff}, {max_backoff}: see the module docstring
+    {groups}: group names in the order they should be updated
+    {options}: passed on to every {runner} call
+    {clock}: the time source backoffs are measured with
+    """
+
+    def __init__(self, devices, runner=serial_runner, log=None, concurrency=CONCURRENCY,
+                 hub_concurrency=HUB_CONCURRENCY, attempts=ATTEMPTS, backoff=BACKOFF, max_backoff=MAX_BACKOFF,
+                 groups=(), options=None, clock=time.monotonic):
+        self.runner = runner
+        self.log = log
+        self.concurrency = concurrency
+        self.hub_concurrency = hub_concurrency
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.options = options or {}
+        self.clock = clock
+        self._cond = threading.Condition()
+        self._running = 0
+        self._hubs = {} # hub -> updates running behind it
+        self.results = {} # port -> final outcome
+
+        order = {group: rank for rank, group in enumerate(groups)}
+        done = log.completed() if log is not None else set()
+        self._queue = [] # devices waiting to start, in priority order
+        for idx, device in enumerate(devices):
+            device = dict(device, attempt=0, ready=0.0, blob=self._hash(device['firmware']))
+            if (device['port'], device['blob']) in done:
+                self.results[device['port']] = {'ok': True, 'skipped': True, 'attempts': 0}
+                continue
+            # Listed groups first, in the order given, then the others by name
+            rank = order.get(device['group'])
+            device['priority'] = (0, rank, idx) if rank is not None else (1, device['group'], idx)
+            self._queue.append(device)
+        self._queue.sort(key=lambda device: device['priority'])
+
+    @staticmethod
+    def _hash(path):
+        with open(path, 'rb') as fp:
+            return blob_hash(fp.read())
+
+    def _next(self):
+        """
+        Returns: the first waiting device that may start now, or None, and how long until one might
+        """
+        now = self.clock()
+        wait = None
+        if self._running >= self.concurrency:
+            return None, None
+        for device in self._queue:
+            if device['hub'] and self._hubs.get(device['hub'], 0) >= self.hub_concurrency:
+                continue
+            if device['ready'] > now:
+                wait = device['ready'] - now if wait is None else min(wait, device['ready'] - now)
+                continue
+            return device, None
+        return None, wait
+
+    def _run(self, device):
+        device['attempt'] += 1
+        error, result = None, None
+        started = self.clock()
+        try:
+            # inside the try, so a log that cannot be written fails the attempt instead of leaving it
+            # counted as running for ever
+            if self.log is not None:
+                self.log.write(event='start', port=device['port'], blob=device['blob'], attempt=device['attempt'])
+            result = self.runner(device['port'], device['firmware'], **self.options)
+        except Exception as e: # any failure of one device is retried or reported, never fatal to the rollout
+            error = '{}: {}'.format(type(e).__name__, e)
+        elapsed = self.clock() - started
+
+        log_error = None
+        try:
+            # before the device stops counting as running, so the run does not end with it unlogged
+            if self.log is not None:
+                self.log.write(event='done' if error is None else 'failed', port=device['port'],
+                               blob=device['blob'], attempt=device['attempt'], error=error, elapsed=elapsed)
+        except Exception as e: # the outcome still stands; a rerun just updates the device again
+            log_error = '{}: {}'.format(type(e).__name__, e)
+
+        with self._cond:
+            self._running -= 1
+            self._hubs[device['hub']] -= 1
+            if error is None:
+                outcome = {'ok': True, 'attempts': device['attempt'], 'time': elapsed, 'result': result}
+            elif device['attempt'] < self.attempts:
+                outcome = None
+                device['ready'] = self.clock() + min(self.max_backoff, self.backoff * 2 ** (device['attempt'] - 1))
+                self._queue.append(device)
+                self._queue.sort(key=lambda device: device['priority'])
+            else:
+                outcome = {'ok': False, 'attempts': device['attempt'], 'error': error}
+            if outcome is not None:
+                if log_error is not None:
+                    outcome['log_error'] = log_error
+                self.results[device['port']] = outcome
+            self._cond.notify_all()
+
+    def run(self):
+        """
+        Updates every device in the inventory.
+
+        Returns: port -> {'ok', 'attempts', and 'time' and 'result' or 'error'}, plus 'log_error' if
+        the outcome could not be written to the progress log
+        """
+        threads = []
+        with self._cond:
+            while self._queue or self._running:
+                device, wait = self._next()
+                if device is None:
+                    self._cond.wait(timeout=wait)
+                    continue
+                self._queue.remove(device)
+                self._running += 1
+                self._hubs[device['hub']] = self._hubs.get(device['hub'], 0) + 1
+                thread = threading.Thread(target=self._run, args=(device,), daemon=True)
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return self.results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fleet Rollout Scheduler')
+    parser.add_argument("--inventory", help="CSV of port,firmware,hub,group.", required=True)
+    parser.add_argument("--log", help="Progress log; devices it records as done are skipped.", required=True)
+    parser.add_argument("--concurrency", help="Updates at once across the fleet.", type=int, default=CONCURRENCY)
+    parser.add_argument("--hub-concurrency", help="Updates at once behind one hub.", type=int,
+                        default=HUB_CONCURRENCY)
+    parser.add_argument("--attempts", help="Tries per device.", type=int, default=ATTEMPTS)
+    parser.add_argument("--backoff", help="Seconds before the first retry (doubles each retry).", type=float,
+                        default=BACKOFF)
+    parser.add_argument("--groups", help="Comma-separated groups to update first, in order.", default='')
+    parser.add_argument("--daemon", help="Send the updates to the fw_daemon on this socket.", default=None)
+    parser.add_argument("--sequenced", help="Number and checksum frames so damaged ones are sent again.",
+                        action='store_true')
+    parser.add_argument("--timeout", help="Seconds to wait for each response before giving up.", type=float,
+                        default=10)
+    args = parser.parse_args()
+
+    scheduler = Scheduler(read_inventory(args.inventory),
+                          runner=daemon_runner(args.daemon) if args.daemon else serial_runner,
+                          log=ProgressLog(args.log), concurrency=args.concurrency,
+                          hub_concurrency=args.hub_concurrency, attempts=args.attempts, backoff=args.backoff,
+                          groups=[group for group in args.groups.split(',') if group],
+                          options={'sequenced': args.sequenced, 'timeout': args.timeout})
+    started = time.monotonic()
+    results = scheduler.run()
+    failed = sorted(port for port, outcome in results.items() if not outcome['ok'])
+    print('{} of {} devices updated in {:.1f} s'.format(len(results) - len(failed), len(results),
+                                                         time.monotonic() - started))
+    for port in failed:
+        print('FAILED {}: {}'.format(port, results[port]['error']))
+    for port in sorted(port for port, outcome in results.items() if 'log_error' in outcome):
+        print('NOT LOGGED {}: {}'.format(port, results[port]['log_error']))
+    raise SystemExit(1 if failed else 0)
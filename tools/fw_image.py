@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+Firmware Image Reader
+
+Reads the firmware image fw_protect is given and lays it out for flash. Three formats are read:
+
+    .bin        a flat image, programmed from FW_BASE
+    .hex        Intel HEX (data, extended segment and extended linear address records)
+    .axf, .elf  a 32-bit little-endian ELF file; the PT_LOAD segments with file contents are
+                placed at their load (physical) addresses
+
+The loadable pieces are coalesced into runs that start on a flash page boundary: pieces whose
+pages touch or overlap go into one run, with the bytes between them erased (0xFF), and a gap of a
+whole page or more starts a new run. A blob made from more than one run, or from one that does
+not start at FW_BASE, carries a segment map (see fw_blob) so that the gaps are never encrypted or
+sent.
+"""
+import argparse
+import struct
+
+from fw_blob import FLASH_PAGESIZE, FW_BASE
+
+ERASED = 0xFF
+
+PT_LOAD = 1
+
+
+def read_bin(path):
+    """
+    Returns: the pieces of the flat image at {path}: one, at FW_BASE
+    """
+    with open(path, 'rb') as fp:
+        return [(FW_BASE, fp.read())]
+
+
+def read_hex(path):
+    """
+    Returns: the (address, data) pieces of the Intel HEX file at {path}, one per data record
+
+    Throws a ValueError if a record is malformed or its checksum is wrong.
+    """
+    pieces = []
+    base = 0
+    with open(path) as fp:
+        for number, line in enumerate(fp, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                if not line.startswith(':'):
+                    raise ValueError
+                record = bytes.fromhex(line[1:])
+            except ValueError:
+                raise ValueError("{}:{}: not an Intel HEX record".format(path, number)) from None
+            if len(record) < 5 or len(record) != record[0] + 5:
+                raise ValueError("{}:{}: record length does not match its byte count".format(path, number))
+            if sum(record) & 0xFF:
+                raise ValueError("{}:{}: bad checksum".format(path, number))
+            address, kind, data = struct.unpack_from('>H', record, 1)[0], record[3], record[4:-1]
+            if kind == 0x00:
+                pieces.append((base + address, data))
+            elif kind == 0x01: # end of file
+                break
+            elif kind == 0x02: # extended segment address
+                base = struct.unpack('>H', data)[0] << 4
+            elif kind == 0x04: # extended linear address
+                base = struct.unpack('>H', data)[0] << 16
+            # 0x03 and 0x05 give the start address, which the bootloader does not use
+    return pieces
+
+
+def read_elf(path):
+    """
+    Returns: the (load address, data) pieces of the PT_LOAD segments of the ELF file at {path}
+    that have file contents
+
+    Throws a ValueError if the file is not a 32-bit little-endian ELF file.
+    """
+    with open(path, 'rb') as fp:
+        elf = fp.read()
+    if elf[:4] != b'\x7fELF' or elf[4] != 1 or elf[5] != 1:
+        raise ValueError("{} is not a 32-bit little-endian ELF file".format(path))
+    phoff, = struct.unpack_from('<I', elf, 28)
+    phentsize, phnum = struct.unpack_from('<HH', elf, 42)
+    pieces = []
+    for i in range(phnum):
+        kind, offset, _, paddr, filesz, _, _, _ = struct.unpack_from('<8I', elf, phoff + i * phentsize)
+        if kind == PT_LOAD and filesz:
+            pieces.append((paddr, elf[offset: offset + filesz]))
+    return pieces
+
+
+def read_image(path):
+    """
+    Returns: the (address, data) pieces of the firmware image at {path}, read as Intel HEX, ELF or
+    a flat image by its extension (or, failing that, its contents)
+    """
+    suffix = str(path).lower().rsplit('.', 1)[-1]
+    if suffix == 'hex':
+        return read_hex(path)
+    if suffix in ('axf', 'elf'):
+        return read_elf(path)
+    with open(path, 'rb') as fp:
+        is_elf = fp.read(4) == b'\x7fELF'
+    return read_elf(path) if is_elf else read_bin(path)
+
+
+def coalesce(pieces, page_size=FLASH_PAGESIZE):
+    """
+    Returns: the (address, data) runs {pieces} fill, each starting on a page boundary, in address
+    order (see the module docstring)
+
+    Throws a ValueError if pieces overlap or lie below FW_BASE.
+    """
+    runs = []
+    end = None
+    for address, data in sorted((address, bytes(data)) for address, data in pieces if data):
+        if address < FW_BASE:
+            raise ValueError("Data at 0x{:x} lies below FW_BASE (0x{:x})".format(address, FW_BASE))
+        if end is not None and address < end:
+            raise ValueError("Data at 0x{:x} overlaps the data before it".format(address))
+        if end is not None and address // page_size <= (end - 1) // page_size + 1:
+            _, run = runs[-1]
+            run += bytes([ERASED]) * (address - end) + data
+        else:
+            start = address - address % page_size
+            runs.append((start, bytearray([ERASED]) * (address - start) + data))
+        end = address + len(data)
+    return [(start, bytes(run)) for start, run in runs]
+
+
+def layout(path):
+    """
+    Returns: (f, segments) for the firmware image at {path}: the runs of the image one after the
+    other, and their (address, length) pairs, or None for segments if the image is a single run
+    from FW_BASE
+    """
+    runs = coalesce(read_image(path))
+    if not runs:
+        raise ValueError("{} has no data to program".format(path))
+    f = b''.join(run for _, run in runs)
+    if len(runs) == 1 and runs[0][0] == FW_BASE:
+        return f, None
+    return f, [(start, len(run)) for start, run in runs]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Firmware Image Reader')
+    parser.add_argument("--infile", help="Firmware image (.bin, .hex, .axf or .elf).", required=True)
+    args = parser.parse_args()
+
+    pieces = read_image(args.infile)
+    runs = coalesce(pieces)
+    span = runs[-1][0] + len(runs[-1][1]) - runs[0][0] if runs else 0
+    print('{} pieces in {} runs: {} bytes to send, {} bytes of flash spanned'.format(
+        len(pieces), len(runs), sum(len(run) for _, run in runs), span))
+    for start, run in runs:
+        print('  0x{:08x}-0x{:08x} ({} bytes)'.format(start, start + len(run), len(run)))
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Firmware Transfer Journal
+
+Remembers how far a sequenced update got, so that an update that was interrupted (the tool was
+killed or the cable came out) can carry on from the last acknowledged frame instead of starting over.
+
+There is one small JSON file per device in the journal directory:
+
+{"device": ..., "blob": sha256 of the firmware blob, "sequence": last acknowledged frame,
+ "offset": bytes of F acknowledged, "updated": time of the last write}
+
+Every write replaces the file atomically, so a crash leaves either the old or the new entry behind,
+never half of one. A journal entry is only a hint: fw_update resumes only if the blob still has
+the recorded hash, and it always takes the position to resume from from the device itself.
+"""
+import argparse
+import hashlib
+import json
+import os
+import pathlib
+import re
+import time
+
+
+def blob_hash(firmware_blob):
+    """
+    Returns: the hex SHA-256 of {firmware_blob}, which is how the journal identifies a blob
+    """
+    return hashlib.sha256(firmware_blob).hexdigest()
+
+
+class Journal:
+    """
+    A directory of per-device transfer records.
+
+    Arguments:
+    {path}: the journal directory (created if it does not exist)
+    """
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def _entry_path(self, device):
+        # Device identities are usually port paths such as /dev/ttyUSB0
+        return self.path / (re.sub(r'[^A-Za-z0-9_.-]', '_', device) + '.json')
+
+    def load(self, device):
+        """
+        Returns: the journal entry for {device}, or None if it has no unfinished transfer
+        """
+        try:
+            with open(self._entry_path(device)) as fp:
+                entry = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return None
+        return entry if entry.get('device') == device else None
+
+    def record(self, device, blob, sequence, offset):
+        """
+        Records that {device} has acknowledged frame {sequence} of {blob}, which ends {offset}
+        bytes into F.
+
+        Arguments:
+        {device}: the device identity
+        {blob}: the blob hash from blob_hash()
+        {sequence}: sequence number of the last acknowledged frame
+        {offset}: number of bytes of F the device has acknowledged
+        """
+        entry = {'device': device, 'blob': blob, 'sequence': sequence, 'offset': offset, 'updated': time.time()}
+        path = self._entry_path(device)
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'w') as fp:
+            json.dump(entry, fp)
+        os.replace(tmp, path)
+
+    def clear(self, device):
+        """Forgets the transfer to {device}, once it has finished or can no longer be resumed."""
+        try:
+            os.unlink(self._entry_path(device))
+        except FileNotFoundError:
+            pass
+
+    def entries(self):
+        """
+        Returns: every unfinished transfer in the journal
+        """
+        entries = []
+        for path in sorted(self.path.glob('*.json')):
+            with open(path) as fp:
+                entries.append(json.load(fp))
+        return entries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Firmware Transfer Journal')
+    parser.add_argument("--journal", help="Path to the journal directory.", required=True)
+    parser.add_argument("--clear", help="Forget the unfinished transfer to this device.", default=None)
+    args = parser.parse_args()
+
+    journal = Journal(args.journal)
+    if args.clear is not None:
+        journal.clear(args.clear)
+    for entry in journal.entries():
+        print('{device}: frame {sequence}, {offset} bytes of blob {blob}'.format(**entry))
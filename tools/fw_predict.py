@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+Firmware Update Time Predictor
+
+Predicts how long fw_update will take to send a blob without opening a port. The prediction counts
+the frames the blob will be split into and adds up three kinds of cost for each phase:
+
+    wire time   bytes sent * byte_time (10 bits per byte at the baud rate)
+    round trips one rtt per response the tool waits for (latency plus the bootloader's own work)
+    delays      the pauses fw_update makes itself (PHASE_DELAY, ACK_DELAY)
+
+byte_time and rtt make up the model. They start from the nominal baud rate and a guess at the
+round-trip time, and calibrate() fits them to the results of real updates (see fw_update
+--calibration), so the prediction follows the protocol and the hardware as they change.
+"""
+import argparse
+import collections
+import json
+import math
+
+import fw_update
+from fw_blob import parse_blob
+
+BAUDRATE = 115200
+DEFAULT_RTT = 0.005 # seconds, a guess until calibrate() has measurements to go on
+FRAME_OVERHEAD = 2 # length
+SEQUENCED_OVERHEAD = 6 # length | sequence | CRC-16
+
+Model = collections.namedtuple('Model', ['byte_time', 'rtt'])
+DEFAULT_MODEL = Model(byte_time=10 / BAUDRATE, rtt=DEFAULT_RTT)
+
+
+def predict(firmware_blob, frame_size=fw_update.FRAME_SIZE, sequenced=False, model=DEFAULT_MODEL):
+    """
+    Returns: a dictionary of the predicted seconds for each phase of the update ('handshake',
+    'header', 'frames', 'finish') and in 'total', the number of frames of F in 'frames_sent' and
+    the number of bytes of F in 'bytes'
+
+    Arguments:
+    {firmware_blob}: the firmware blob (created by fw_protect.py)
+    {frame_size}, {sequenced}: as for fw_update.update
+    {model}: the Model to predict with
+    """
+    fw_update.check_frame_size(frame_size)
+    blob = parse_blob(firmware_blob)
+    firmware = blob.firmware
+    frames = math.ceil(len(firmware) / frame_size)
+    if sequenced:
+        phases = {
+            'handshake': model.rtt + model.byte_time,
+            'header': model.rtt + (blob.header_length + SEQUENCED_OVERHEAD) * model.byte_time,
+            'frames': frames * model.rtt + (len(firmware) + frames * SEQUENCED_OVERHEAD) * model.byte_time,
+            'finish': model.rtt + SEQUENCED_OVERHEAD * model.byte_time,
+        }
+    else:
+        # signed hash, metadata and IV are each sent and acknowledged separately
+        phases = {
+            'handshake': model.rtt + model.byte_time,
+            'header': (4 * fw_update.PHASE_DELAY + 3 * (fw_update.ACK_DELAY + model.rtt)
+                       + blob.header_length * model.byte_time),
+            'frames': (frames * (fw_update.ACK_DELAY + model.rtt)
+                       + (len(firmware) + frames * FRAME_OVERHEAD) * model.byte_time),
+            'finish': FRAME_OVERHEAD * model.byte_time,
+        }
+    phases['total'] = sum(phases.values())
+    phases['frames_sent'] = frames
+    phases['bytes'] = len(firmware)
+    return phases
+
+
+def measurement(result, sequenced):
+    """
+    Returns: the parts of an update result from fw_update.update that calibrate() needs
+    """
+    return {'sequenced': sequenced, 'frames': result['frames'], 'bytes': result['bytes'], 'elapsed': result['elapsed']}
+
+
+def calibrate(measurements, default=DEFAULT_MODEL):
+    """
+    Fits a Model to the frame loops of real updates: for each one,
+
+        elapsed - own delays = frames * rtt + bytes on the wire * byte_time
+
+    is solved for rtt and byte_time by least squares. If the measurements cannot tell the two
+    apart (they all used the same frame size, say), byte_time keeps its value from {default} and
+    only rtt is fitted.
+
+    Returns: the fitted Model ({default} if there are no measurements)
+    """
+    rows = []
+    for m in measurements:
+        if not m['frames']:
+            continue
+        overhead = SEQUENCED_OVERHEAD if m['sequenced'] else FRAME_OVERHEAD
+        delays = 0 if m['sequenced'] else m['frames'] * fw_update.ACK_DELAY
+        rows.append((m['frames'], m['bytes'] + m['frames'] * overhead, m['elapsed'] - delays))
+    if not rows:
+        return default
+
+    # Normal equations for y = frames * rtt + wire * byte_time
+    ff = sum(f * f for f, _, _ in rows)
+    fw = sum(f * w for f, w, _ in rows)
+    ww = sum(w * w for _, w, _ in rows)
+    fy = sum(f * y for f, _, y in rows)
+    wy = sum(w * y for _, w, y in rows)
+    det = ff * ww - fw * fw
+    if det > 1e-9 * ff * ww:
+        rtt = (fy * ww - wy * fw) / det
+        byte_time = (ff * wy - fw * fy) / det
+        if rtt >= 0 and byte_time > 0:
+            return Model(byte_time=byte_time, rtt=rtt)
+    byte_time = default.byte_time
+    rtt = sum(y - w * byte_time for _, w, y in rows) / sum(f for f, _, _ in rows)
+    return Model(byte_time=byte_time, rtt=max(rtt, 0.0))
+
+
+def load_measurements(path):
+    """
+    Returns: the measurements recorded in the JSON-lines file at {path} (none if it does not exist)
+    """
+    try:
+        with open(path) as fp:
+            return [json.loads(line) for line in fp if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def record_measurement(path, result, sequenced):
+    """Appends the measurement of an update {result} to the JSON-lines file at {path}."""
+    with open(path, 'a') as fp:
+        fp.write(json.dumps(measurement(result, sequenced)) + '\n')
+
+
+def format_prediction(prediction):
+    """
+    Returns: a few lines describing a prediction from predict()
+    """
+    lines = ['Predicted update time: {:.2f} s ({} frames, {} bytes of F)'.format(
+        prediction['total'], prediction['frames_sent'], prediction['bytes'])]
+    for phase in ('handshake', 'header', 'frames', 'finish'):
+        lines.append('  {:<10} {:.3f} s'.format(phase, prediction[phase]))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Firmware Update Time Predictor')
+    parser.add_argument("--firmware", help="Path to the firmware blob.", required=True)
+    parser.add_argument("--frame-size", help="Number of firmware bytes per frame.", type=fw_update.frame_size_arg,
+                        default=fw_update.FRAME_SIZE)
+    parser.add_argument("--sequenced", help="Predict a sequenced update.", action='store_true')
+    parser.add_argument("--calibration", help="Measurements of real updates to fit the model to.", default=None)
+    args = parser.parse_args()
+
+    with open(args.firmware, 'rb') as fp:
+        blob = fp.read()
+    model = calibrate(load_measurements(args.calibration)) if args.calibration else DEFAULT_MODEL
+    print('Model: {:.1f} us per byte, {:.2f} ms per round trip'.format(model.byte_time * 1e6, model.rtt * 1e3))
+    print(format_prediction(predict(blob, frame_size=args.frame_size, sequenced=args.sequenced, model=model)))
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+Firmware Pre-flight Check
+
+Checks a firmware blob before fw_update opens the serial port, so that a truncated blob, a blob
+signed with the wrong key or a bad size field is caught up front instead of by the bootloader
+answering ERROR (or failing the signature check) after a long transfer.
+
+The check covers the blob structure, the size(F) % 16 == 0 rule, the MAX_ENCRYPTED_DATA_SIZE
+limit and the PKCS#1 v1.5 signature. Results are cached by blob hash and key fingerprint, one small
+JSON file per result, so flashing the same artifact again skips the check.
+"""
+import argparse
+import hashlib
+import json
+import os
+import pathlib
+
+from fw_blob import check_blob, key_fingerprint, load_public_key, verify_signature
+
+CACHE_DIR = pathlib.Path(__file__).parent.absolute() / '.preflight_cache'
+
+
+def preflight(firmware_blob, public_key, cache_dir=CACHE_DIR):
+    """
+    Checks {firmware_blob} and the signature on it.
+
+    Returns: a dictionary with
+        'ok': True if the blob passed every check
+        'problems': what was wrong with it
+        'cached': True if the result came from the cache
+
+    Arguments:
+    {firmware_blob}: the firmware blob (created by fw_protect.py)
+    {public_key}: the provisioned RSA public key
+    {cache_dir}: directory of cached results, or None to always run the check
+    """
+    entry = None
+    if cache_dir is not None:
+        cache_dir = pathlib.Path(cache_dir)
+        entry = cache_dir / '{}-{}.json'.format(hashlib.sha256(firmware_blob).hexdigest(), key_fingerprint(public_key))
+        try:
+            with open(entry) as fp:
+                result = json.load(fp)
+            result['cached'] = True
+            return result
+        except (FileNotFoundError, ValueError):
+            pass
+
+    problems = check_blob(firmware_blob)
+    if not problems and not verify_signature(firmware_blob, public_key):
+        problems.append("signature does not verify against the provisioned public key")
+    result = {'ok': not problems, 'problems': problems, 'cached': False}
+
+    if entry is not None:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = entry.with_suffix('.tmp')
+        with open(tmp, 'w') as fp:
+            json.dump({'ok': result['ok'], 'problems': problems}, fp)
+        os.replace(tmp, entry)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Firmware Pre-flight Check')
+    parser.add_argument("--firmware", help="Path to the firmware blob.", required=True)
+    parser.add_argument("--public-key", help="Public key (or bl_build secrets) to check the signature with.",
+                        required=True)
+    parser.add_argument("--no-cache", help="Always run the check.", action='store_true')
+    args = parser.parse_args()
+
+    with open(args.firmware, 'rb') as fp:
+        firmware_blob = fp.read()
+    result = preflight(firmware_blob, load_public_key(args.public_key), cache_dir=None if args.no_cache else CACHE_DIR)
+    print('{}{}'.format('OK' if result['ok'] else 'FAILED', ' (cached)' if result['cached'] else ''))
+    for problem in result['problems']:
+        print('Problem: {}'.format(problem))
+    raise SystemExit(0 if result['ok'] else 1)
@@ -1,28 +1,212 @@
 from Crypto.Cipher import AES
-from Crypto.PublicKey import RSA
 from Crypto.Hash import SHA256
 from Crypto.Util import Padding
-from Crypto.Signature import pkcs1_15
+from Crypto.Signature import DSS, eddsa, pkcs1_15
+import collections
+import concurrent.futures
+import hashlib
+import json
+import math
 import struct
 import argparse
+
+from fw_blob import (CIPHERS, FLAG_SEGMENTS, FLASH_PAGESIZE, GCM_DATA_LENGTH, GCM_TAG_LENGTH, MAGIC,
+                     PAGE_DIGEST_LENGTH, SEGMENT, SIG_ED25519, SIG_RSA, check_blob, gcm_nonce, import_key,
+                     key_fingerprint, page_digests, parse_blob, signature_type, verify_signature)
+from fw_build_cache import CACHE_DIR, BuildCache, cache_key
+from fw_image import layout
 """
 f = unencrypted firmware
 F = encrypted firmware
 metadata = version | size(f) | size(F)
 signed(hash(metadata | IV | F)) | metadata | IV | F
+
+or, with an elliptic-curve signing key or in GCM mode (see fw_blob):
+prefix | signed(hash(prefix | metadata | IV | F)) | metadata | IV | F
 """
-def protect_firmware(infile, outfile, version, message):
+SECRETS_FILE = "secret_build_output.txt"
+
+
+def load_secrets(path=SECRETS_FILE):
+    """
+    Reads the keys written by the {bl_build} tool.
+    
+    Returns: (aes_key, signing_key), the 16 byte AES key and the private key object (RSA, Ed25519
+    or P-256, whichever bl_build generated)
+    
+    Arguments:
+    {path}: the secrets file, "secret_build_output.txt" in the working directory by default
+    """
+    with open(path, 'rb') as sec_output:
+        aes_key = sec_output.read(16) # get symmetric key
+        signing_key = import_key(sec_output.read()) # get private key
+    return aes_key, signing_key
+
+
+def sign(hashed_fw, signing_key):
+    """
+    Returns: the signature of the SHA-256 hash object {hashed_fw} made with {signing_key}
+    """
+    sig_type = signature_type(signing_key)
+    if sig_type == SIG_RSA:
+        return pkcs1_15.new(signing_key).sign(hashed_fw)
+    if sig_type == SIG_ED25519:
+        return eddsa.new(signing_key, 'rfc8032').sign(hashed_fw.digest())
+    return DSS.new(signing_key, 'fips-186-3').sign(hashed_fw)
+
+
+def page_manifest(fw_blob, image, version, aes_key):
+    """
+    Returns: the page manifest for a firmware blob: a digest of each flash page of the decrypted
+    firmware, which fw_update compares with the pages a device already has so that it only sends
+    the pages that changed
+    
+    Arguments:
+    {fw_blob}: the firmware blob the manifest belongs to
+    {image}: the decrypted F, as the bootloader programs it from FW_BASE
+    {version}: the version of the firmware
+    {aes_key}: the AES key the blob is encrypted with, which the digests are keyed with (see
+    fw_blob.page_digests)
+    """
+    return {
+        'blob': hashlib.sha256(fw_blob).hexdigest(),
+        'version': version,
+        'page_size': FLASH_PAGESIZE,
+        'digest_length': PAGE_DIGEST_LENGTH,
+        'pages': [digest.hex() for digest in page_digests(image, aes_key)],
+    }
+
+
+def write_page_manifest(path, manifest):
+    """Writes a page manifest from {page_manifest} to {path}."""
+    with open(path, 'w') as out:
+        json.dump(manifest, out, indent=1)
+
+
+def seal_segments(aes_key, iv, metadata, padded_fw, workers=None):
+    """
+    Encrypts {padded_fw} as GCM segments (see fw_blob), sealing them on {workers} threads.
+    
+    Returns: F, the segments one after the other
+    """
+    pieces = [padded_fw[start: start + GCM_DATA_LENGTH] for start in range(0, len(padded_fw), GCM_DATA_LENGTH)]
+    
+    def seal(index):
+        cipher = AES.new(aes_key, AES.MODE_GCM, nonce=gcm_nonce(iv, index), mac_len=GCM_TAG_LENGTH)
+        cipher.update(metadata)
+        ciphertext, tag = cipher.encrypt_and_digest(pieces[index])
+        return ciphertext + tag
+    
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        return b''.join(pool.map(seal, range(len(pieces))))
+
+
+Plaintext = collections.namedtuple('Plaintext', ['version', 'size', 'padded_fw', 'segments'])
+
+
+def prepare_image(fw, version, message, segments=None):
+    """
+    Prepares the firmware image {fw} for encryption: appends the release {message} and pads it.
+    None of this depends on the keys, so one Plaintext serves every device a release is protected
+    for (see seal_image).
+    
+    {segments} are the (address, length) runs {fw} is made of (see fw_image.layout), or None if it
+    is programmed from FW_BASE in one piece.
+    
+    Returns: the Plaintext
+    """
+    fw_message = fw + message.encode() + b'\00' # appends release message to end of firmware
+    padded_fw = Padding.pad(fw_message, AES.block_size)
+    return Plaintext(version, len(fw), padded_fw, segments)
+
+
+def seal_image(plaintext, aes_key, signing_key, cipher='cbc'):
+    """
+    Encrypts and signs a {plaintext} from prepare_image. An RSA {signing_key} and the 'cbc'
+    {cipher} make the blob bootloader.c reads; an elliptic-curve key, the 'gcm' cipher or segments
+    make a blob with the typed prefix.
+    
+    Returns: (firmware blob, page manifest)
+    """
+    padded_fw, segments = plaintext.padded_fw, plaintext.segments
+    metadata = struct.pack("<HH", plaintext.version, plaintext.size) # packs initial metadata: version, length  of unencrypted firmware
+    
+    if cipher == 'gcm':
+        iv = AES.get_random_bytes(AES.block_size)
+        tags = math.ceil(len(padded_fw) / GCM_DATA_LENGTH) # one per GCM segment
+        metadata += struct.pack("<H", len(padded_fw) + tags * GCM_TAG_LENGTH) # the tags are part of F
+        encrypted_fw = seal_segments(aes_key, iv, metadata, padded_fw)
+    else:
+        aes = AES.new(aes_key, AES.MODE_CBC) # creates AES object
+        iv = aes.iv
+        encrypted_fw = aes.encrypt(padded_fw) # encrypts firmware
+        metadata += struct.pack("<H", len(encrypted_fw)) # adds the length of encrypted firmware to metadata
+    
+    segment_map = b''
+    if segments is not None:
+        segment_map = struct.pack(">H", len(segments)) + b''.join(SEGMENT.pack(*segment) for segment in segments)
+    
+    sig_type = signature_type(signing_key)
+    if sig_type == SIG_RSA and cipher == 'cbc' and segments is None:
+        prefix = b'' # keeps the layout bootloader.c reads
+    else:
+        prefix = MAGIC + bytes([sig_type, CIPHERS[cipher] | (FLAG_SEGMENTS if segments is not None else 0)])
+    
+    # hashes the metadata, segment map, IV, and encrypted firmware
+    hashed_fw = SHA256.new(data = prefix + metadata + segment_map + iv + encrypted_fw)
+    
+    signature = sign(hashed_fw, signing_key) # signs the hashed metadata, IV, and firmware using the private key
+    
+    fw_blob = prefix + signature + metadata + segment_map + iv + encrypted_fw # creates blob to be sent to bootloader
+    
+    return fw_blob, page_manifest(fw_blob, padded_fw, plaintext.version, aes_key)
+
+
+def protect_image(fw, version, message, aes_key, signing_key, cipher='cbc', segments=None):
+    """
+    Encrypts and signs the firmware image {fw} (see protect_firmware, prepare_image and
+    seal_image).
+    
+    Returns: (firmware blob, page manifest)
+    """
+    return seal_image(prepare_image(fw, version, message, segments), aes_key, signing_key, cipher)
+
+
+def cached_blob(cache, key, version, public_key):
+    """
+    Returns: (firmware blob, page manifest) from the build {cache} for {key}, or None if there is
+    no entry or the entry is not a valid {version} blob under {public_key} (it is then discarded)
+    """
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    fw_blob, manifest = entry
+    if check_blob(fw_blob) or parse_blob(fw_blob).version != version or not verify_signature(fw_blob, public_key):
+        cache.discard(key)
+        return None
+    return fw_blob, manifest
+
+
+def protect_firmware(infile, outfile, version, message, store=None, cache=None, cipher='cbc', secrets=SECRETS_FILE):
     """
     Arguments are:
-    {infile} contains the firmware to be protected.
+    {infile} contains the firmware to be protected: a flat .bin, Intel HEX (.hex) or ELF (.axf, .elf).
     {outfile} is where the encrypted firmware blob is written.
     {version} is the version of the firmware -- a positive integer value, or 0 to debug the firmware.
     {message} is the release message, which gets appended to the firmware and encrypted with it.
     firmware = firmware + message + "\0"
+    {store} is a fw_store.Store to publish the blob to as well, or None.
+    {cache} is a fw_build_cache.BuildCache of earlier blobs, or None to always protect the firmware.
+    {cipher} is 'cbc', which bootloader.c decrypts, or 'gcm' for a blob whose F is sealed in
+    segments that each carry a tag (see fw_blob).
+    {secrets} is the secrets file to take the keys from.
     
-    Takes keys generated by the {bl_build} tool from "secret_build_output.txt". 
+    Takes keys generated by the {bl_build} tool from "secret_build_output.txt" (or the file bl_build
+    wrote its elliptic-curve keys to, given as {secrets}). 
     The {aes_key} is used to encrypt the firmware {fw},
-    and the {rsa_key} is used to sign the hash of a copy of the metadata, IV, and encrypted firmware.
+    and the {signing_key} is used to sign the hash of a copy of the metadata, IV, and encrypted firmware.
+    The signing key is RSA unless bl_build was asked for an Ed25519 or P-256 key, in which case the
+    blob starts with the typed prefix described in fw_blob and carries a 64 byte signature.
     
     The plaintext and encrypted firmware will be referred to as "f" and "F" respectively.
     The overall structure of the firmware blob is such:
@@ -30,43 +214,123 @@ def protect_firmware(infile, outfile, version, message):
     metadata = version | size(f) | size(F)
     signed(hash(metadata | IV | F)) | metadata | IV | F
     
+    An ELF or HEX image whose data is spread over flash with gaps of a page or more is sent as the
+    runs of pages that hold data, and the blob carries a segment map saying where each run goes
+    (see fw_image and fw_blob), so the gaps are neither encrypted nor sent.
+    
+    A page manifest for fw_update's changed-pages mode is written next to it, to {outfile}.pages.
+    {outfile} may be None when the blob only goes to the {store}.
+    
+    If the {cache} has a blob for the same image, version, message, signing key, AES key and cipher whose signature
+    still verifies, that blob is used instead of encrypting and signing the firmware again.
+    
     Returns: 0
-    Outputs: {outfile}
+    Outputs: {outfile}, {outfile}.pages
     """
     with open(infile, 'rb') as f: # reads firmware
-        fw = f.read()
-        print(fw)
-        
-    metadata = struct.pack("<HH", version, len(fw)) # packs initial metadata: version, length  of unencrypted firmware
+        raw = f.read()
+    fw, segments = layout(infile)
+    print(fw)
+    input_hash = hashlib.sha256(raw).hexdigest()
     
-    fw = fw + message.encode() + b'\00' # appends release message to end of firmware
-    
-    with open("secret_build_output.txt", 'rb') as sec_output:
-        aes_key = sec_output.read(16) # get symmetric key
-        rsa_key = RSA.import_key(sec_output.read()) # get private key
-        
-    cipher = AES.new(aes_key, AES.MODE_CBC) # creates AES object
+    aes_key, signing_key = load_secrets(secrets)
+    key_id = key_fingerprint(signing_key.public_key())
     
-    encrypted_fw = cipher.encrypt(Padding.pad(fw, AES.block_size)) # encrypts firmware
+    protected = None
+    if cache is not None:
+        key = cache_key(raw, version, message, key_id, aes_key, cipher)
+        protected = cached_blob(cache, key, version, signing_key.public_key())
+    if protected is None:
+        protected = protect_image(fw, version, message, aes_key, signing_key, cipher, segments)
+        if cache is not None:
+            cache.put(key, *protected)
+    fw_blob, manifest = protected
     
-    metadata += struct.pack("<H", len(encrypted_fw)) # adds the length of encrypted firmware to metadata
+    if outfile is not None:
+        with open(outfile, "w+b") as out: # writes firmware blob to outfile
+            out.write(fw_blob)
+        write_page_manifest(outfile + '.pages', manifest)
+    if store is not None:
+        store.publish(fw_blob, key_id, version, input_hash, manifest)
+    return 0
+
+
+def protect_for_devices(infile, outdir, version, message, key_db, device_ids=None, store=None, cipher='cbc'):
+    """
+    Protects one release for many devices, each with its own keys from the device key database
+    (see bl_build.provision), in a single pass: the image is read, laid out, padded and digested
+    once (prepare_image), and only the encryption and signature are done per device (seal_image).
     
-    hashed_fw = SHA256.new(data = metadata + cipher.iv + encrypted_fw) # hashes the metadata, IV, and encrypted firmware
+    Arguments are as for protect_firmware, and:
+    {outdir} is the directory the blobs are written to, as <device_id>.blob and
+    <device_id>.blob.pages, or None when they only go to the {store} (under each device's key id).
+    {key_db} is the key_db.KeyDatabase holding the devices' keys.
+    {device_ids} are the devices to protect the release for, or None for every device in {key_db}.
     
-    signature = pkcs1_15.new(rsa_key).sign(hashed_fw) # signs the hashed metadata, IV, and firmware using the private key
+    Returns: the number of blobs made
+    Outputs: {outdir}/<device_id>.blob, {outdir}/<device_id>.blob.pages
+    """
+    import pathlib
     
-    fw_blob = signature + metadata + cipher.iv + encrypted_fw # creates blob to be sent to bootloader
+    with open(infile, 'rb') as f: # reads firmware
+        raw = f.read()
+    fw, segments = layout(infile)
+    input_hash = hashlib.sha256(raw).hexdigest()
+    plaintext = prepare_image(fw, version, message, segments)
     
-    with open(outfile, "w+b") as out: # writes firmware blob to outfile
-        out.write(fw_blob)
-    return 0
+    if outdir is not None:
+        outdir = pathlib.Path(outdir)
+        outdir.mkdir(parents=True, exist_ok=True)
+    devices = key_db.devices(device_ids)
+    for device in devices:
+        fw_blob, manifest = seal_image(plaintext, device.aes_key, import_key(device.private_key), cipher)
+        if outdir is not None:
+            outfile = outdir / '{}.blob'.format(device.device_id)
+            with open(outfile, "w+b") as out:
+                out.write(fw_blob)
+            write_page_manifest('{}.pages'.format(outfile), manifest)
+        if store is not None:
+            store.publish(fw_blob, device.key_id, version, input_hash, manifest)
+    return len(devices)
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Firmware Update Tool')
     parser.add_argument("--infile", help="Path to the firmware image to protect.", required=True)
-    parser.add_argument("--outfile", help="Filename for the output firmware.", required=True)
+    parser.add_argument("--outfile", help="Filename for the output firmware.", default=None)
     parser.add_argument("--version", help="Version number of this firmware.", required=True)
     parser.add_argument("--message", help="Release message for this firmware.", required=True)
+    parser.add_argument("--store", help="Also publish the blob to this artifact store directory.", default=None)
+    parser.add_argument("--no-cache", help="Always encrypt and sign, even if an identical build is cached.",
+                        action='store_true')
+    parser.add_argument("--cipher", help="How to encrypt the firmware.", choices=sorted(CIPHERS), default='cbc')
+    parser.add_argument("--secrets", help="Keys from bl_build (secret_build_output_ed25519.txt for its Ed25519 "
+                        "keys, say).", default=SECRETS_FILE)
+    parser.add_argument("--key-db", help="Protect the release for each device in this key database (from bl_build --devices).",
+                        default=None)
+    parser.add_argument("--devices", help="Comma-separated IDs of the devices to protect for (default: all of them).",
+                        default=None)
+    parser.add_argument("--outdir", help="Directory for the per-device blobs, with --key-db.", default=None)
     args = parser.parse_args()
+    if args.key_db is not None:
+        if args.outdir is None and args.store is None:
+            parser.error("one of --outdir and --store is required with --key-db")
+    elif args.outfile is None and args.store is None:
+        parser.error("one of --outfile and --store is required")
 
-    protect_firmware(infile=args.infile, outfile=args.outfile, version=int(args.version), message=args.message)
\ No newline at end of file
+    store = None
+    if args.store is not None:
+        from fw_store import Store
+        store = Store(args.store)
+    if args.key_db is not None:
+        from key_db import KeyDatabase
+        device_ids = args.devices.split(',') if args.devices is not None else None
+        with KeyDatabase(args.key_db) as db:
+            count = protect_for_devices(infile=args.infile, outdir=args.outdir, version=int(args.version),
+                                        message=args.message, key_db=db, device_ids=device_ids, store=store,
+                                        cipher=args.cipher)
+        print("Protected the release for {} devices".format(count))
+        raise SystemExit(0)
+    protect_firmware(infile=args.infile, outfile=args.outfile, version=int(args.version), message=args.message,
+                     store=store, cache=None if args.no_cache else BuildCache(CACHE_DIR), cipher=args.cipher,
+                     secrets=args.secrets)
\ No newline at end of file
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""
+Firmware Update Scenario Runner
+
+Runs fw_update against the bootloader model (bl_model) over a simulated serial link (serial_sim)
+many times per scenario, and reports how often updates succeed, how long they take and the goodput
+(bytes of F delivered per second of the whole update) as distributions.
+
+All times are simulated, so the protocol's own delays (the sleeps between phases and after each
+frame) are counted but do not have to be waited out. The device model programs a flash model, so
+each update also reports the time the bootloader would spend erasing and programming flash.
+"""
+import argparse
+import contextlib
+import io
+import json
+import statistics
+
+import fw_update
+from bl_model import BootloaderModel
+from flash_model import FlashModel
+from fw_blob import parse_blob
+from serial_sim import SimulatedSerial
+
+# name -> SimulatedSerial arguments
+SCENARIOS = {
+    'clean': {},
+    'slow': {'baudrate': 9600},
+    'latency': {'latency': 0.02, 'jitter': 0.02},
+    'noisy': {'corrupt': 1e-5},
+    'lossy': {'drop': 1e-5},
+    'stalls': {'stall': 0.01, 'stall_time': 1.5},
+}
+
+
+def percentile(values, pct):
+    """
+    Returns: the {pct}th percentile of {values} (nearest rank), or None if there are none
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def distribution(values):
+    """
+    Returns: the 'mean', 'p50', 'p90', 'p99' and 'max' of {values}, each None if there are none
+    """
+    return {
+        'mean': statistics.mean(values) if values else None,
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+        'max': max(values) if values else None,
+    }
+
+
+def run_trial(firmware_blob, link_args, seed, keys=(None, None), frame_size=fw_update.FRAME_SIZE,
+              adaptive=False, timeout=10, sequenced=False):
+    """
+    Runs one update of {firmware_blob} over a simulated link.
+
+    Returns: a dictionary with
+        'ok': whether the device ended up with the new firmware installed
+        'status': the device model's status after the update
+        'error': the error fw_update raised, if any
+        'time': simulated seconds from the handshake until the last byte was sent
+        'retransmissions': frames fw_update had to send again
+        'stats': the link's byte and fault counters
+        'flash': the flash work the update caused (see flash_model.FlashModel.report)
+
+    Arguments:
+    {firmware_blob}: the firmware blob (created by fw_protect.py)
+    {link_args}: arguments for SimulatedSerial, such as one of the SCENARIOS
+    {seed}: seed for the link's fault generator
+    {keys}: (aes_key, signing_key) for the device model to decrypt and verify with, or (None, None)
+    {frame_size}, {adaptive}, {timeout}, {sequenced}: passed on to fw_update.update
+    """
+    aes_key, signing_key = keys
+    flash = FlashModel()
+    device = BootloaderModel(aes_key=aes_key, public_key=signing_key.public_key() if signing_key else None, flash=flash)
+    link = SimulatedSerial(device, seed=seed, **link_args)
+    error = None
+    result = {}
+    with contextlib.redirect_stdout(io.StringIO()): # fw_update prints every response
+        try:
+            result = fw_update.update(link, firmware_blob, frame_size=frame_size, adaptive=adaptive,
+                                      timeout=timeout, sequenced=sequenced)
+        except RuntimeError as e:
+            error = str(e)
+    return {
+        'ok': error is None and device.status == 'installed',
+        'status': device.status,
+        'error': error,
+        'time': link.monotonic(),
+        'retransmissions': result.get('retransmissions', 0),
+        'stats': dict(link.stats),
+        'flash': flash.report(),
+    }
+
+
+def run_scenario(firmware_blob, link_args, trials=20, seed=0, **kwargs):
+    """
+    Runs {trials} updates over links built from {link_args}, each with its own seed.
+
+    Returns: a summary with the success rate and the completion time and goodput distributions
+    of the successful updates
+    """
+    payload = len(parse_blob(firmware_blob).firmware) # bytes of F
+    results = [run_trial(firmware_blob, link_args, seed + i, **kwargs) for i in range(trials)]
+    times = [r['time'] for r in results if r['ok']]
+    goodput = [payload / t for t in times if t > 0]
+    flash_times = [r['flash']['time'] for r in results if r['ok']]
+    summary = {
+        'trials': trials,
+        'succeeded': len(times),
+        'success_rate': len(times) / trials if trials else 0.0,
+        'failures': sorted({r['error'] or r['status'] for r in results if not r['ok']}),
+        'retransmissions': sum(r['retransmissions'] for r in results),
+    }
+    for name, values in (('time', times), ('goodput', goodput), ('flash_time', flash_times)):
+        summary[name] = distribution(values)
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Firmware Update Scenario Runner')
+    parser.add_argument("--firmware", help="Path to the firmware blob to send.", required=True)
+    parser.add_argument("--secrets", help="Keys from bl_build, so the device model can verify and decrypt.",
+                        default=None)
+    parser.add_argument("--scenario", help="Scenario to run (default: all of them).",
+                        choices=sorted(SCENARIOS), action='append')
+    parser.add_argument("--trials", help="Updates per scenario.", type=int, default=20)
+    parser.add_argument("--seed", help="Seed of the first trial.", type=int, default=0)
+    parser.add_argument("--frame-size", help="Number of firmware bytes per frame.", type=fw_update.frame_size_arg,
+                        default=fw_update.FRAME_SIZE)
+    parser.add_argument("--adaptive", help="Let fw_update resize its frames.", action='store_true')
+    parser.add_argument("--timeout", help="Seconds fw_update waits for each response.", type=float, default=10)
+    parser.add_argument("--sequenced", help="Use sequenced frames with retransmission.", action='store_true')
+    parser.add_argument("--json", help="Print the summaries as JSON.", action='store_true')
+    args = parser.parse_args()
+
+    with open(args.firmware, 'rb') as fp:
+        blob = fp.read()
+    keys = (None, None)
+    if args.secrets is not None:
+        from fw_protect import load_secrets
+        keys = load_secrets(args.secrets)
+
+    summaries = {}
+    for name in args.scenario or sorted(SCENARIOS):
+        summaries[name] = run_scenario(blob, SCENARIOS[name], trials=args.trials, seed=args.seed, keys=keys,
+                                       frame_size=args.frame_size, adaptive=args.adaptive, timeout=args.timeout,
+                                       sequenced=args.sequenced)
+
+    if args.json:
+        print(json.dumps(summaries, indent=2))
+    else:
+        for name, summary in summaries.items():
+            print('{}: {}/{} succeeded, {} retransmissions'.format(name, summary['succeeded'], summary['trials'],
+                                                                  summary['retransmissions']))
+            if summary['succeeded']:
+                print('  time (s):        p50 {p50:.2f}  p90 {p90:.2f}  p99 {p99:.2f}  max {max:.2f}'.format(
+                    **summary['time']))
+                print('  goodput (B/s):   p50 {p50:.0f}  p90 {p90:.0f}  p99 {p99:.0f}'.format(**summary['goodput']))
+                print('  flash time (s):  p50 {p50:.3f}  max {max:.3f}'.format(**summary['flash_time']))
+            for failure in summary['failures']:
+                print('  failure: {}'.format(failure))
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+Firmware Artifact Store
+
+A local content-addressed store of protected firmware blobs. Each blob is kept once, under its
+SHA-256, in objects/ (with its page manifest next to it), and an index maps
+
+    (key id, version, input hash) -> blob
+
+where the key id is the fingerprint of the signing key (fw_blob.key_fingerprint) and the input hash
+is the SHA-256 of the unprotected firmware image fw_protect was given.
+
+The index is a file of fixed-size big-endian records kept sorted by (key id, version, input hash),
+so a lookup maps it and bisects it without reading or parsing the whole file:
+
+    [ 0x08 ]  [ 0x02 ]  [ 0x20 ]      [ 0x20 ]     [ 0x04 ] [ 0x08 ]
+    -------------------------------------------------------------------
+    | Key id | Version | Input hash | Blob hash | Size | Added (ns) |
+    -------------------------------------------------------------------
+
+Publishing rewrites the index (atomically, through a temporary file) while holding an exclusive
+lock on index.lock, so concurrent publishes, from threads or processes, cannot lose each other's
+records; lookups take no lock, as they only ever see a whole index. gc() holds the same lock and keeps the objects under a size limit by dropping the blobs that were
+published longest ago, along with their index records.
+"""
+import argparse
+import collections
+import contextlib
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import pathlib
+import struct
+import time
+
+STORE_DIR = pathlib.Path(__file__).parent.absolute() / '.fw_store'
+RECORD = struct.Struct('>8sH32s32sIQ') # key id | version | input hash | blob hash | size | added
+KEY_LENGTH = 8 + 2 + 32 # bytes of a record the index is sorted by
+
+Entry = collections.namedtuple('Entry', ['key_id', 'version', 'input_hash', 'blob_hash', 'size', 'added'])
+
+
+def _entry(record):
+    key_id, version, input_hash, blob_hash, size, added = RECORD.unpack(record)
+    return Entry(key_id.hex(), version, input_hash.hex(), blob_hash.hex(), size, added)
+
+
+class Store:
+    """
+    A firmware artifact store.
+
+    Arguments:
+    {path}: the store directory (created if it does not exist)
+    """
+
+    def __init__(self, path=STORE_DIR):
+        self.path = pathlib.Path(path)
+        self.objects = self.path / 'objects'
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.index = self.path / 'index'
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Holds an exclusive lock on the store's index for the duration of the with block. The lock
+        is taken on a file of its own, as the index is replaced rather than rewritten in place.
+        """
+        with open(self.path / 'index.lock', 'a') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def blob_path(self, blob_hash):
+        """
+        Returns: where the blob with SHA-256 {blob_hash} (hex) is kept
+        """
+        return self.objects / blob_hash
+
+    def manifest_path(self, blob_hash):
+        """
+        Returns: where the page manifest of the blob with SHA-256 {blob_hash} (hex) is kept
+        """
+        return self.objects / (blob_hash + '.pages')
+
+    def _records(self):
+        try:
+            with open(self.index, 'rb') as fp:
+                data = fp.read()
+        except FileNotFoundError:
+            return []
+        return [data[i: i + RECORD.size] for i in range(0, len(data), RECORD.size)]
+
+    def _write_index(self, records):
+        tmp = self.index.with_suffix('.tmp')
+        with open(tmp, 'wb') as fp:
+            fp.write(b''.join(sorted(records)))
+        os.replace(tmp, self.index)
+
+    def publish(self, firmware_blob, key_id, version, input_hash, manifest=None):
+        """
+        Adds {firmware_blob} to the store.
+
+        Returns: the blob's SHA-256 (hex)
+
+        Arguments:
+        {firmware_blob}: the protected blob
+        {key_id}: fingerprint (hex) of the key it was signed with
+        {version}: its firmware version
+        {input_hash}: SHA-256 (hex) of the firmware image it was made from
+        {manifest}: its page manifest (see fw_protect.page_manifest), if there is one
+        """
+        blob_hash = hashlib.sha256(firmware_blob).hexdigest()
+        # Under the lock, so that gc() cannot delete the blob before its record is written
+        with self._locked():
+            self._publish(blob_hash, firmware_blob, key_id, version, input_hash, manifest)
+        return blob_hash
+
+    def _publish(self, blob_hash, firmware_blob, key_id, version, input_hash, manifest):
+        path = self.blob_path(blob_hash)
+        if not path.exists():
+            tmp = path.with_suffix('.tmp')
+            with open(tmp, 'wb') as fp:
+                fp.write(firmware_blob)
+            os.replace(tmp, path)
+        if manifest is not None:
+            tmp = self.manifest_path(blob_hash).with_suffix('.tmp')
+            with open(tmp, 'w') as fp:
+                json.dump(manifest, fp, indent=1)
+            os.replace(tmp, self.manifest_path(blob_hash))
+
+        record = RECORD.pack(bytes.fromhex(key_id), version, bytes.fromhex(input_hash), bytes.fromhex(blob_hash),
+                             len(firmware_blob), time.time_ns())
+        # A record with the same key replaces the old one
+        records = [r for r in self._records() if r[:KEY_LENGTH] != record[:KEY_LENGTH]]
+        self._write_index(records + [record])
+
+    def _search(self, prefix):
+        """
+        Returns: the Entries whose key starts with {prefix}, found by bisecting the mapped index
+        """
+        try:
+            fp = open(self.index, 'rb')
+        except FileNotFoundError:
+            return []
+        with fp:
+            if os.fstat(fp.fileno()).st_size < RECORD.size:
+                return []
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as index:
+                count = len(index) // RECORD.size
+                lo, hi = 0, count
+                while lo < hi: # first record whose key is not below {prefix}
+                    mid = (lo + hi) // 2
+                    if index[mid * RECORD.size: mid * RECORD.size + len(prefix)] < prefix:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                entries = []
+                while lo < count and index[lo * RECORD.size: lo * RECORD.size + len(prefix)] == prefix:
+                    entries.append(_entry(index[lo * RECORD.size: (lo + 1) * RECORD.size]))
+                    lo += 1
+        return entries
+
+    def lookup(self, key_id, version, input_hash):
+        """
+        Returns: the Entry for exactly this key, version and input, or None
+        """
+        entries = self._search(bytes.fromhex(key_id) + struct.pack('>H', version) + bytes.fromhex(input_hash))
+        return entries[0] if entries else None
+
+    def resolve(self, version, key_id=None):
+        """
+        Returns: the Entry of the most recently published blob of {version}, signed with {key_id}
+        if it is given, or None if there is none
+        """
+        if key_id is not None:
+            entries = self._search(bytes.fromhex(key_id) + struct.pack('>H', version))
+        else:
+            entries = [entry for entry in self.entries() if entry.version == version]
+        return max(entries, key=lambda entry: entry.added, default=None)
+
+    def entries(self):
+        """
+        Returns: every Entry in the index
+        """
+        return [_entry(record) for record in self._records()]
+
+    def size(self):
+        """
+        Returns: the number of bytes of blobs in the store
+        """
+        return sum(path.stat().st_size for path in self.objects.iterdir() if not path.suffix)
+
+    def gc(self, max_bytes):
+        """
+        Deletes the least recently published blobs (and their index records) until the blobs take
+        at most {max_bytes}, and any blob no record refers to (one replaced by a later publish).
+
+        Returns: the hashes of the blobs that were deleted
+        """
+        with self._locked():
+            return self._gc(max_bytes)
+
+    def _gc(self, max_bytes):
+        records = self._records()
+        published = {} # blob hash -> time it was last published
+        for record in records:
+            entry = _entry(record)
+            published[entry.blob_hash] = max(published.get(entry.blob_hash, 0), entry.added)
+        sizes = {blob_hash: self.blob_path(blob_hash).stat().st_size for blob_hash in published
+                 if self.blob_path(blob_hash).exists()}
+
+        total = sum(sizes.values())
+        deleted = set(published) - set(sizes) # records of blobs that have gone missing
+        for blob_hash in sorted(sizes, key=published.get):
+            if total <= max_bytes:
+                break
+            deleted.add(blob_hash)
+            total -= sizes[blob_hash]
+        self._write_index([record for record in records if _entry(record).blob_hash not in deleted])
+
+        for path in self.objects.iterdir():
+            blob_hash = path.name.split('.')[0]
+            if blob_hash in deleted or blob_hash not in published:
+                path.unlink()
+                if not path.suffix:
+                    deleted.add(blob_hash)
+        return sorted(deleted)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Firmware Artifact Store')
+    parser.add_argument("--store", help="Path to the store directory.", default=STORE_DIR)
+    parser.add_argument("--version", help="Print the path of the newest blob of this version.", type=int,
+                        default=None)
+    parser.add_argument("--key-id", help="Only consider blobs signed with this key fingerprint.", default=None)
+    parser.add_argument("--gc", help="Delete the oldest blobs until the store holds at most this many bytes.",
+                        type=int, default=None)
+    args = parser.parse_args()
+
+    store = Store(args.store)
+    if args.gc is not None:
+        for blob_hash in store.gc(args.gc):
+            print('Deleted {}'.format(blob_hash))
+    if args.version is not None:
+        entry = store.resolve(args.version, key_id=args.key_id)
+        if entry is None:
+            raise SystemExit("No blob of version {} in {}".format(args.version, args.store))
+        print(store.blob_path(entry.blob_hash))
+    else:
+        for entry in store.entries():
+            print('{key_id} v{version} {input_hash:.16} -> {blob_hash} ({size} bytes)'.format(**entry._asdict()))
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+"""
+Firmware Update Stress Harness
+
+Runs many fw_update sessions at once from one process, the way fw_daemon and fw_fleet drive a
+rack of devices, to find where the host side stops scaling. Each session has its own thread and
+its own device: a DeviceEndpoint wrapped round a bl_model.BootloaderModel, which behaves like a
+serial port in real time. A write takes as long as its bytes take at the baud rate, and responses
+arrive after the latency. A read with nothing to come blocks for the timeout, as a pyserial read
+does. Sessions therefore spend their time waiting on the line, as real ones do, and the host's
+own work shows up as CPU time.
+
+The report covers the whole run and each session:
+
+    throughput          bytes of F delivered per second, and updates finished per second
+    latency             seconds from handshake to the last acknowledgement, as percentiles
+    CPU per session     host CPU seconds in fw_update, not counting the device model
+    memory per session  growth of the process's peak RSS (or, with --trace-memory, of the peak
+                        traced Python allocations), divided by the number of sessions
+
+--sessions takes a list of session counts (10,100,400) and runs one after the other, so a drop in
+throughput or a climb in latency and CPU per session marks the limit.
+"""
+import argparse
+import concurrent.futures
+import contextlib
+import json
+import os
+import time
+
+import fw_update
+from bl_model import BootloaderModel
+from fw_blob import parse_blob
+from fw_scenario import distribution
+
+BAUDRATE = 115200
+LATENCY = 0.002 # seconds from a response leaving the device to its first byte arriving
+TIMEOUT = 2 # seconds a read waits for data, as in fw_update's Serial(timeout=2)
+
+
+class DeviceEndpoint:
+    """
+    One device on its own line: a serial port in real time with a bootloader model on the far end.
+
+    Arguments:
+    {device}: the BootloaderModel on the far end
+    {baudrate}: line rate writes and responses are paced at (0 for no pacing)
+    {latency}: seconds before a response starts to arrive
+    {timeout}: seconds a read waits when there is nothing to read
+
+    {device_cpu} is the CPU time the calling thread has spent in the device model.
+    """
+
+    def __init__(self, device, baudrate=BAUDRATE, latency=LATENCY, timeout=TIMEOUT):
+        self.device = device
+        self.byte_time = 10 / baudrate if baudrate else 0.0
+        self.latency = latency
+        self.timeout = timeout
+        self.device_cpu = 0.0
+        self._rx = bytearray()
+        self._ready = 0.0 # when the queued responses have all arrived
+
+    @property
+    def in_waiting(self):
+        return len(self._rx) if time.monotonic() >= self._ready else 0
+
+    def write(self, data):
+        """
+        Sends {data} to the device, taking as long as the bytes take at the baud rate.
+
+        Returns: the number of bytes written
+        """
+        data = bytes(data)
+        if self.byte_time:
+            time.sleep(len(data) * self.byte_time)
+        started = time.thread_time()
+        self.device.write(data)
+        waiting = self.device.in_waiting
+        if waiting:
+            self._rx += self.device.read(waiting)
+            self._ready = time.monotonic() + self.latency + waiting * self.byte_time
+        self.device_cpu += time.thread_time() - started
+        return len(data)
+
+    def read(self, size=1):
+        """
+        Returns: up to {size} bytes from the device, or b'' after {timeout} seconds if it has sent
+        nothing (the model only ever answers a write)
+        """
+        if not self._rx:
+            time.sleep(self.timeout)
+            return b''
+        wait = self._ready - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        data = bytes(self._rx[:size])
+        del self._rx[:size]
+        return data
+
+    def reset_input_buffer(self):
+        self._rx.clear()
+
+    def close(self):
+        pass
+
+
+def run_session(firmware_blob, keys=(None, None), link_args=None, options=None):
+    """
+    Runs one update of {firmware_blob} through fw_update.update against a new device.
+
+    Returns: a dictionary with 'ok' (the device installed the firmware), 'error' (what fw_update
+    raised, if anything), 'latency' (wall seconds), 'host_cpu' and 'device_cpu' (CPU seconds of
+    this thread in fw_update and in the device model)
+
+    Arguments:
+    {keys}: (aes_key, signing_key) for the device model to decrypt and verify with, or (None, None)
+    {link_args}: arguments for DeviceEndpoint
+    {options}: arguments for fw_update.update
+    """
+    aes_key, signing_key = keys
+    device = BootloaderModel(aes_key=aes_key, public_key=signing_key.public_key() if signing_key else None)
+    endpoint = DeviceEndpoint(device, **(link_args or {}))
+    error = None
+    started, started_cpu = time.perf_counter(), time.thread_time()
+    try:
+        fw_update.update(endpoint, firmware_blob, **(options or {}))
+    except RuntimeError as e:
+        error = str(e)
+    cpu = time.thread_time() - started_cpu
+    return {
+        'ok': error is None and device.status == 'installed',
+        'error': error or (None if device.status == 'installed' else device.status),
+        'latency': time.perf_counter() - started,
+        'host_cpu': cpu - endpoint.device_cpu,
+        'device_cpu': endpoint.device_cpu,
+    }
+
+
+def _peak_rss():
+    """Returns: the peak resident set size of the process in bytes, or None where it is not known"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # KB on Linux
+
+
+def stress(firmware_blob, sessions, concurrency=None, keys=(None, None), link_args=None, options=None,
+           trace_memory=False):
+    """
+    Runs {sessions} updates of {firmware_blob}, {concurrency} at a time (all at once if None).
+
+    Returns: the report, a dictionary with the number of 'sessions' and how many 'succeeded', the
+    distinct 'failures', the wall 'elapsed' seconds, the 'throughput' (bytes of F per second) and
+    'updates_per_second', the 'latency', 'host_cpu' and 'device_cpu' distributions over the
+    sessions, the process CPU seconds per session in 'process_cpu', and the bytes of memory per
+    session in 'memory' (None where the peak RSS is not known)
+
+    Arguments:
+    {keys}, {link_args}, {options}: as for run_session
+    {trace_memory}: measure memory with tracemalloc, which counts only Python allocations but
+        is not thrown off by what earlier runs left behind (and slows the run down)
+    """
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+    else:
+        baseline = _peak_rss()
+    payload = len(parse_blob(firmware_blob).firmware)
+    started, started_cpu = time.perf_counter(), time.process_time()
+    # fw_update prints as it goes; the sessions share stdout, so it goes nowhere
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        with concurrent.futures.ThreadPoolExecutor(concurrency or sessions) as pool:
+            futures = [pool.submit(run_session, firmware_blob, keys, link_args, options) for _ in range(sessions)]
+            results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+    process_cpu = time.process_time() - started_cpu
+
+    if trace_memory:
+        memory = tracemalloc.get_traced_memory()[1] - baseline
+        tracemalloc.stop()
+    else:
+        peak = _peak_rss()
+        memory = peak - baseline if peak is not None else None
+    done = [result for result in results if result['ok']]
+    return {
+        'sessions': sessions,
+        'succeeded': len(done),
+        'failures': sorted({result['error'] for result in results if not result['ok']}),
+        'elapsed': elapsed,
+        'throughput': len(done) * payload / elapsed,
+        'updates_per_second': len(done) / elapsed,
+        'latency': distribution([result['latency'] for result in done]),
+        'host_cpu': distribution([result['host_cpu'] for result in results]),
+        'device_cpu': distribution([result['device_cpu'] for result in results]),
+        'process_cpu': process_cpu / sessions,
+        'memory': memory / sessions if memory is not None else None,
+    }
+
+
+def format_report(report):
+    """
+    Returns: one table row for a report from stress()
+    """
+    return ('{sessions:>8} {succeeded:>6} {elapsed:>8.2f} {kbps:>9.1f} {updates_per_second:>7.2f} '
+            '{p50:>7.2f} {p90:>7.2f} {p99:>7.2f} {cpu:>9.1f} {device:>9.1f} {kb}').format(
+        kbps=report['throughput'] / 1024, p50=report['latency']['p50'] or 0, p90=report['latency']['p90'] or 0,
+        p99=report['latency']['p99'] or 0, cpu=report['host_cpu']['mean'] * 1e3,
+        device=report['device_cpu']['mean'] * 1e3,
+        kb='{:>8.1f}'.format(report['memory'] / 1024) if report['memory'] is not None else '       ?',
+        **report)
+
+
+HEADER = '{:>8} {:>6} {:>8} {:>9} {:>7} {:>7} {:>7} {:>7} {:>9} {:>9} {:>8}'.format(
+    'sessions', 'ok', 'wall s', 'KB/s', 'upd/s', 'p50 s', 'p90 s', 'p99 s', 'host ms', 'model ms', 'KB/sess')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Firmware Update Stress Harness')
+    parser.add_argument("--firmware", help="Path to the firmware blob to send.", required=True)
+    parser.add_argument("--secrets", help="Keys from bl_build, so the device models verify and decrypt.",
+                        default=None)
+    parser.add_argument("--sessions", help="Comma-separated session counts to run, one after the other.",
+                        default='10,100')
+    parser.add_argument("--concurrency", help="Sessions at once (default: all of them).", type=int, default=None)
+    parser.add_argument("--baudrate", help="Line rate of each device (0: no pacing, to find CPU limits).",
+                        type=int, default=BAUDRATE)
+    parser.add_argument("--latency", help="Seconds before each response starts to arrive.", type=float,
+                        default=LATENCY)
+    parser.add_argument("--frame-size", help="Number of firmware bytes per frame.", type=fw_update.frame_size_arg,
+                        default=fw_update.FRAME_SIZE)
+    parser.add_argument("--legacy", help="Use the 'U' protocol, with its fixed delays, instead of sequenced frames.",
+                        action='store_true')
+    parser.add_argument("--trace-memory", help="Measure memory with tracemalloc instead of the peak RSS.",
+                        action='store_true')
+    parser.add_argument("--json", help="Print the reports as JSON.", action='store_true')
+    args = parser.parse_args()
+
+    with open(args.firmware, 'rb') as fp:
+        blob = fp.read()
+    keys = (None, None)
+    if args.secrets is not None:
+        from fw_protect import load_secrets
+        keys = load_secrets(args.secrets)
+    link_args = {'baudrate': args.baudrate, 'latency': args.latency}
+    options = {'frame_size': args.frame_size, 'sequenced': not args.legacy, 'timeout': 10}
+
+    reports = []
+    if not args.json:
+        print(HEADER)
+    for sessions in (int(count) for count in args.sessions.split(',')):
+        report = stress(blob, sessions, concurrency=args.concurrency, keys=keys, link_args=link_args,
+                        options=options, trace_memory=args.trace_memory)
+        reports.append(report)
+        if not args.json:
+            print(format_report(report))
+            for failure in report['failures']:
+                print('  failure: {}'.format(failure))
+    if args.json:
+        print(json.dumps(reports, indent=2))
@@ -11,18 +11,47 @@ A frame consists of two sections:
 | Length | Data... |
 --------------------
 
-In our case, the data is from one line of the Intel Hex formated .hex file
+In our case, the data is the next piece of F, the encrypted firmware
 
 We write a frame to the bootloader, then wait for it to respond with an
 OK message so we can write the next frame. The OK message in this case is
 just a zero
+
+With --sequenced the update starts with 'S' instead of 'U' and every frame also
+carries a sequence number and a CRC-16, so that a damaged frame is answered with
+a NAK and sent again instead of ending the update:
+
+[ 0x02 ]   [ 0x02 ]   [ variable ]  [ 0x02 ]
+---------------------------------------------
+| Length | Sequence | Data...     | CRC-16 |
+---------------------------------------------
+
+Frame 0 carries signed(hash(metadata | IV | F)) | metadata | IV and the following
+frames carry F. The bootloader answers each frame with a status byte and the low
+byte of the frame's sequence number, followed by the complement of each, so that a
+response damaged on the line is sent for again rather than read as another. See
+bl_model.py for the device side. A blob
+signed with an elliptic-curve key (see fw_blob.py) has a typed prefix before its
+signature, which goes in frame 0 with the rest of the header; such blobs can only
+be sent sequenced. So can GCM blobs, whose F is a run of 1024 byte segments that the
+bootloader authenticates one at a time (--frame-size 1024 sends one per frame).
+
+With --pages MANIFEST (the .pages file fw_protect writes next to the blob) the update
+first asks the bootloader for a digest of each page it has installed with 'D', and then
+sends only the pages of F whose digest differs. Frame 0 then also carries a bitmap of
+the pages that are sent; the bootloader fills in the others from flash, so the signature
+still covers the whole of F.
 """
 
 import argparse
+import binascii
+import hashlib
+import json
 import struct
 import time
 
-from serial import Serial
+from fw_blob import CIPHER_CBC, FLASH_PAGESIZE, PAGE_DIGEST_LENGTH, parse_blob
+from fw_journal import Journal, blob_hash
 
 """
 f = unencrypted firmware
@@ -31,8 +60,85 @@ metadata = version | size(f) | size(F)
 signed(hash(metadata | IV | F)) | metadata | IV | F
 """
 RESP_OK = b'\x00'
+RESP_ERROR = b'\x01'
+RESP_NAK = b'\x02'
 FRAME_SIZE = 64
-def send_hash(ser, signed_hash, debug=False):
+MIN_FRAME_SIZE = 16 # one AES block
+MAX_FRAME_SIZE = 1024 # one flash page
+REPLY_LENGTH = 4 # status | sequence | ~status | ~sequence, the response to a sequenced frame
+MAX_RETRIES = 8 # times a sequenced frame is sent again before the update is abandoned
+FRAME_GAP = 0.02 # seconds of idle line that make the bootloader drop a partial sequenced frame
+SESSION_TIMEOUT = 5 # seconds of idle line that make the bootloader put a sequenced transfer aside
+PHASE_DELAY = 3 # seconds to pause between the phases of a 'U' update
+ACK_DELAY = 0.1 # seconds to pause after each write of a 'U' update before reading the OK
+
+
+def now(ser):
+    """
+    Returns: the current time in seconds, on the clock of {ser} if it keeps its own
+    (serial_sim.SimulatedSerial does), otherwise time.monotonic()
+    """
+    return getattr(ser, 'monotonic', time.monotonic)()
+
+
+def sleep(ser, seconds):
+    """
+    Waits for {seconds}, on the clock of {ser} if it keeps its own, otherwise with time.sleep().
+    """
+    getattr(ser, 'sleep', time.sleep)(seconds)
+
+
+def check_frame_size(frame_size):
+    """
+    Returns: {frame_size} if it is a multiple of the AES block size from MIN_FRAME_SIZE to
+    MAX_FRAME_SIZE (the longest frame the bootloader takes). Otherwise throws a ValueError.
+    """
+    if not MIN_FRAME_SIZE <= frame_size <= MAX_FRAME_SIZE or frame_size % MIN_FRAME_SIZE:
+        raise ValueError("the frame size must be a multiple of {} from {} to {}, not {}".format(
+            MIN_FRAME_SIZE, MIN_FRAME_SIZE, MAX_FRAME_SIZE, frame_size))
+    return frame_size
+
+
+def frame_size_arg(value):
+    """argparse type for --frame-size: the size as an int, checked with check_frame_size"""
+    try:
+        return check_frame_size(int(value))
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e)) from None
+
+
+def wait_for_ok(ser, debug=False, timeout=None):
+    """
+    Waits for the bootloader to confirm the last thing that was sent.
+    
+    Returns: the number of reads that timed out before the confirmation (0 on a clean link).
+    Throws an error if the bootloader responds with anything other than OK, or stays silent for
+    longer than {timeout} seconds.
+    
+    Arguments:
+    {ser}: serial read functionality
+    {debug}: print the bootloader's response
+    {timeout}: seconds to wait before giving up (None waits forever)
+    """
+    started = now(ser)
+    timeouts = 0
+    while True:
+        resp = ser.read(1)
+        print(resp)
+        if resp == b'':
+            timeouts += 1
+            if timeout is not None and now(ser) - started > timeout:
+                raise RuntimeError("ERROR: Bootloader did not respond within {} seconds".format(timeout))
+            continue
+        if debug:
+            print("Resp: {}".format(ord(resp))) # if debug is enabled, print the bootloader's response
+        if resp != RESP_OK:
+            raise RuntimeError("ERROR: Bootloader responded with {}".format(repr(resp)))
+        else:
+            return timeouts
+
+
+def send_hash(ser, signed_hash, debug=False, timeout=None):
     """
     Sends signed hash of the firmware, IV, and metadata over serial to the bootloader.
     The data looks like this: signed(hash(metadata | IV | F))
@@ -45,6 +151,7 @@ def send_hash(ser, signed_hash, debug=False):
     {ser}: serial write
     {signed_hash}: the signed hash from the main method to be sent
     {debug}: if this is set to true, it allows us to see the metadata (for debugging purposes)
+    {timeout}: seconds to wait for the confirmation before giving up (None waits forever)
     
     """
     
@@ -54,21 +161,14 @@ def send_hash(ser, signed_hash, debug=False):
     
     ser.write(signed_hash) # actually sends the signed hash
     
-    time.sleep(0.1)
+    sleep(ser, ACK_DELAY)
     
     # Wait for an OK from the bootloader.
-    while True:
-        resp = ser.read(1)
-        print(resp)
-        if resp == b'':
-            continue
-        if resp != RESP_OK:
-            raise RuntimeError("ERROR: Bootloader responded with {}".format(repr(resp)))
-        else:
-            return 0
+    wait_for_ok(ser, timeout=timeout)
+    return 0
 
         
-def send_metadata(ser, metadata, debug=False):
+def send_metadata(ser, metadata, debug=False, timeout=None):
     """
     Prints plaintext metadata and sends it to the bootloader.
     The data looks like this: version | size(f) | size(F)
@@ -81,6 +181,7 @@ def send_metadata(ser, metadata, debug=False):
     {ser}: serial write functionality
     {metadata}: the data to be sent, from the main function
     {debug}: if this is set to true, it allows us to see the metadata (for debugging purposes)
+    {timeout}: seconds to wait for the confirmation before giving up (None waits forever)
     
     """
     
@@ -103,19 +204,12 @@ def send_metadata(ser, metadata, debug=False):
     
     # Wait for an OK from the bootloader.
     
-    time.sleep(0.1)
+    sleep(ser, ACK_DELAY)
     
-    while True:
-        resp = ser.read(1)
-        print(resp)
-        if resp == b'':
-            continue
-        if resp != RESP_OK:
-            raise RuntimeError("ERROR: Bootloader responded with {}".format(repr(resp)))
-        else:
-            return 0
+    wait_for_ok(ser, timeout=timeout)
+    return 0
 
-def send_iv(ser, iv, debug=False):
+def send_iv(ser, iv, debug=False, timeout=None):
     """
     Prints plaintext AES IV and sends it to the bootloader.
     After sending the IV, waits for confirmation from the bootloader
@@ -127,6 +221,7 @@ def send_iv(ser, iv, debug=False):
     {ser}: serial write functionality
     {iv}: the data to be sent, from the main function
     {debug}: if this is set to true, it allows us to see the iv (for debugging purposes)
+    {timeout}: seconds to wait for the confirmation before giving up (None waits forever)
     
     """
     if debug:
@@ -135,26 +230,26 @@ def send_iv(ser, iv, debug=False):
     ser.write(iv)
     
     
-    time.sleep(0.1)
+    sleep(ser, ACK_DELAY)
     
-    while True:
-        resp = ser.read(1)
-        print(resp)
-        if resp == b'':
-            continue
-        if resp != RESP_OK:
-            raise RuntimeError("ERROR: Bootloader responded with {}".format(repr(resp)))
-        else:
-            return 0
+    wait_for_ok(ser, timeout=timeout)
+    return 0
     
-def send_frame(ser, frame, debug=False):
+def send_frame(ser, frame, debug=False, timeout=None):
     """
     Sends a frame of data to the bootloader.
     If the bootloader does not confirm, raises an error.
     The structure of the frames is explained at the top of the page
     
-    Returns: 0 if a confirmation is recieved from the bootloader. Otherwise throws an error.
+    Returns: the number of reads that timed out before the confirmation (0 on a clean link).
+    Otherwise throws an error.
     Outputs: sends a frame over serial
+    
+    Arguments:
+    {ser}: serial write functionality
+    {frame}: the frame to be sent
+    {debug}: print the frame and the bootloader's response
+    {timeout}: seconds to wait for the confirmation before giving up (None waits forever)
     """
     
     ser.write(frame)  # Write the frame...
@@ -162,87 +257,451 @@ def send_frame(ser, frame, debug=False):
     if debug:
         print(frame)
 
-    time.sleep(0.1)
+    sleep(ser, ACK_DELAY)
 
-    if debug:
-        print("Resp: {}".format(ord(resp))) # if debug is enabled, print the bootloader's response
+    return wait_for_ok(ser, debug=debug, timeout=timeout)
+
+
+class FrameSizeController:
+    """
+    Picks the size of the next frame from how the previous frames went.
     
-    while True:
-        resp = ser.read(1)
-        print(resp)
-        if resp == b'':
-            continue
-        if resp != RESP_OK:
-            raise RuntimeError("ERROR: Bootloader responded with {}".format(repr(resp)))
+    Every acknowledged frame is reported with its payload length, the time between writing it and
+    receiving the OK (its round-trip time), and the number of reads that timed out on the way.
+    Timeouts are treated as link errors and halve the frame size, since a large frame is the most
+    expensive thing to lose on a noisy cable. After {window} clean frames the controller compares the
+    measured throughput (bytes per second of round-trip time) against the neighbouring sizes it has
+    already tried, and moves toward the better one, probing upward while the error rate stays low.
+    
+    Sizes stay multiples of the AES block size between MIN_FRAME_SIZE and MAX_FRAME_SIZE.
+    Every change is appended to {decisions} so the update result shows why the size moved.
+    
+    Arguments:
+    {initial}: the frame size to start with
+    {window}: number of clean frames to observe before reconsidering the size
+    {max_error_rate}: the smoothed error rate above which the controller will not grow
+    """
+    
+    def __init__(self, initial=FRAME_SIZE, window=4, max_error_rate=0.05):
+        self.size = self._clamp(initial)
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.error_rate = 0.0 # exponentially weighted fraction of frames that hit a timeout
+        self.throughput = {} # frame size -> smoothed bytes per second
+        self.decisions = []
+        self._streak = 0
+        self._frames = 0
+    
+    @staticmethod
+    def _clamp(size):
+        size = size - size % MIN_FRAME_SIZE
+        return max(MIN_FRAME_SIZE, min(MAX_FRAME_SIZE, size))
+    
+    def _move(self, size, rtt, reason):
+        size = self._clamp(size)
+        if size != self.size:
+            self.decisions.append({'frame': self._frames, 'from': self.size, 'to': size,
+                                   'rtt': rtt, 'error_rate': round(self.error_rate, 4), 'reason': reason})
+            self.size = size
+        self._streak = 0
+    
+    def observe(self, length, rtt, errors=0):
+        """
+        Records the outcome of one frame and adjusts {size} for the next one.
+        
+        Returns: the frame size to use for the next frame
+        
+        Arguments:
+        {length}: payload length of the frame that was acknowledged
+        {rtt}: seconds between writing the frame and reading its OK
+        {errors}: number of timeouts or retransmissions the frame needed
+        """
+        self._frames += 1
+        self.error_rate = 0.8 * self.error_rate + 0.2 * (1 if errors else 0)
+        
+        if errors:
+            self._move(self.size // 2, rtt, 'errors')
+            return self.size
+        
+        if length < self.size or rtt <= 0: # the short last frame says nothing about this size
+            return self.size
+        
+        rate = length / rtt
+        previous = self.throughput.get(self.size)
+        self.throughput[self.size] = rate if previous is None else 0.7 * previous + 0.3 * rate
+        self._streak += 1
+        if self._streak < self.window:
+            return self.size
+        
+        current = self.throughput[self.size]
+        smaller = self.throughput.get(self._clamp(self.size // 2))
+        larger = self.throughput.get(self._clamp(self.size * 2))
+        if smaller is not None and smaller > current:
+            self._move(self.size // 2, rtt, 'smaller frames were faster')
+        elif self.error_rate <= self.max_error_rate and (larger is None or larger > current):
+            self._move(self.size * 2, rtt, 'probing larger frames')
         else:
-            return 0
+            self._streak = 0
+        return self.size
+
+
+def pack_frame(sequence, data):
+    """
+    Returns: the sequenced frame carrying {data}: length | sequence | data | CRC-16
+    """
+    frame = struct.pack('>HH', len(data), sequence & 0xFFFF) + bytes(data)
+    return frame + struct.pack('>H', binascii.crc_hqx(frame, 0xFFFF))
+
+
+def decode_reply(resp):
+    """
+    Returns: (status, ack) of the response {resp} to a sequenced frame, or None if it is short or
+    its complements do not match (it was damaged on the line)
+    """
+    if len(resp) != REPLY_LENGTH or resp[0] ^ resp[2] != 0xFF or resp[1] ^ resp[3] != 0xFF:
+        return None
+    return resp[:1], resp[1:2]
+
+
+def send_sequenced_frame(ser, sequence, data, debug=False, retries=MAX_RETRIES):
+    """
+    Sends a sequenced frame and waits for the bootloader to acknowledge it. A NAK, a damaged
+    response (see decode_reply) or no response at all gets the frame sent again (after leaving the line idle so the
+    bootloader drops whatever part of the frame it has), up to {retries} times.
+    
+    Returns: the number of times the frame had to be sent again (0 on a clean link).
+    Throws an error if the bootloader rejects the update or the frame is never acknowledged.
+    Outputs: sends a frame over serial
+    
+    Arguments:
+    {ser}: serial read/write
+    {sequence}: the frame's sequence number
+    {data}: the data section of the frame
+    {debug}: print the frame and the bootloader's response
+    {retries}: how many times to send the frame again before giving up
+    """
+    frame = pack_frame(sequence, data)
+    ack = bytes([sequence & 0xFF])
+    for attempt in range(retries + 1):
+        if attempt:
+            sleep(ser, FRAME_GAP)
+            ser.reset_input_buffer() # drop any late or duplicated responses
+        
+        ser.write(frame)
+        if debug:
+            print(frame)
+        
+        resp = ser.read(REPLY_LENGTH)
+        if debug:
+            print("Resp: {}".format(resp))
+        if decode_reply(resp) == (RESP_OK, ack):
+            return attempt
+        if decode_reply(resp) == (RESP_ERROR, ack):
+            raise RuntimeError("ERROR: Bootloader rejected frame {}".format(sequence))
+    raise RuntimeError("ERROR: Frame {} was not acknowledged after {} attempts".format(sequence, retries + 1))
 
-def main(ser, infile, debug=True):
+
+def query_page_digests(ser, count, timeout=None):
+    """
+    Asks the bootloader for the digests of the first {count} pages of firmware it has installed.
+    
+    Returns: a list of PAGE_DIGEST_LENGTH byte digests, one per page
+    """
+    handshake(ser, b'D' + struct.pack('>H', count), b'D', timeout=timeout)
+    reply = ser.read(2)
+    if len(reply) != 2:
+        raise RuntimeError("ERROR: Bootloader did not send its page digests")
+    count = struct.unpack('>H', reply)[0]
+    digests = ser.read(count * PAGE_DIGEST_LENGTH)
+    if len(digests) != count * PAGE_DIGEST_LENGTH:
+        raise RuntimeError("ERROR: Bootloader sent {} of {} bytes of page digests".format(
+            len(digests), count * PAGE_DIGEST_LENGTH))
+    return [digests[i: i + PAGE_DIGEST_LENGTH] for i in range(0, len(digests), PAGE_DIGEST_LENGTH)]
+
+
+def changed_pages(manifest, installed):
+    """
+    Returns: the numbers of the pages in {manifest} whose digest is not the one in {installed}
+    """
+    wanted = [bytes.fromhex(digest) for digest in manifest['pages']]
+    return [page for page, digest in enumerate(wanted) if page >= len(installed) or installed[page] != digest]
+
+
+def delta_blob(header, firmware, pages):
+    """
+    Returns: (frame 0, F for the listed {pages}) for a changed-pages update, where frame 0 is
+    {header} followed by a bitmap with a bit set (least significant first) for each page sent
+    """
+    count = (len(firmware) + FLASH_PAGESIZE - 1) // FLASH_PAGESIZE
+    bitmap = bytearray((count + 7) // 8)
+    for page in pages:
+        bitmap[page // 8] |= 1 << (page % 8)
+    data = b''.join(bytes(firmware[page * FLASH_PAGESIZE: (page + 1) * FLASH_PAGESIZE]) for page in pages)
+    return bytes(header) + bytes(bitmap), data
+
+
+def main(ser, infile, debug=True, frame_size=FRAME_SIZE, adaptive=False, timeout=None, sequenced=False,
+         journal=None, device=None, manifest=None):
     """
     Arguments are:
     {ser}: serial read/write
     {infile}: the entire firmware blob (created by fw_protect.py) to be sent to the bootloader
-    {outfile}:
+    {debug}: print the data that is sent
+    {frame_size}: number of firmware bytes per frame (the starting size when {adaptive} is set)
+    {adaptive}: let a FrameSizeController resize the frames as the update goes
+    {timeout}: seconds to wait for any one response from the bootloader (None waits forever)
+    {sequenced}: use sequenced frames with a CRC, so damaged frames are sent again
+    {journal}: a fw_journal.Journal to record progress in and resume from
+    {device}: identity of the device in the {journal}
+    {manifest}: the page manifest of the blob, to send only the pages that changed
+    
+    Returns: the update result from {update}
     """
     
     with open(infile, 'rb') as fp:
         firmware_blob = fp.read() # read firmware blob from {infile}
 
-    # declares a bunch of variables for use in send_hash, send_metadata, and send_iv methods
-    signature_length = 256 # the signature is 256 bytes long
-    metadata_length = 6 # the metadata is 6 bytes long
-    iv_length = 16 # the IV is 16 bytes long
+    return update(ser, firmware_blob, debug=debug, frame_size=frame_size, adaptive=adaptive, timeout=timeout,
+                  sequenced=sequenced, journal=journal, device=device, manifest=manifest)
+
+
+def update(ser, firmware_blob, debug=False, frame_size=FRAME_SIZE, adaptive=False, timeout=None,
+           sequenced=False, retries=MAX_RETRIES, journal=None, device=None, manifest=None):
+    """
+    Sends a firmware blob to the bootloader: handshake, signed hash, metadata, IV and then the
+    encrypted firmware in frames.
+    
+    Returns: a dictionary describing the update:
+        'frames': number of frames sent
+        'bytes': number of encrypted firmware bytes sent
+        'elapsed': seconds spent in the frame loop
+        'frame_sizes': the frame size decisions made by the FrameSizeController (empty if not {adaptive})
+        'retransmissions': number of frames that were sent again (always 0 unless {sequenced})
+        'resumed_from': bytes of F the bootloader already had from an interrupted transfer
+        'pages_skipped': pages of F not sent because the bootloader already had them
+    Outputs: sends the firmware blob over serial
     
+    Arguments:
+    {ser}: serial read/write
+    {firmware_blob}: the firmware blob (created by fw_protect.py), as bytes or a memoryview
+    {debug}: print the data that is sent
+    {frame_size}: number of firmware bytes per frame (the starting size when {adaptive} is set)
+    {adaptive}: let a FrameSizeController resize the frames as the update goes
+    {timeout}: seconds to wait for any one response from the bootloader (None waits forever)
+    {sequenced}: use sequenced frames with a CRC, so damaged frames are sent again
+    {retries}: how many times a sequenced frame may be sent again
+    {journal}: a fw_journal.Journal to record progress in and resume from (sequenced updates only)
+    {device}: identity of the device in the {journal}, such as its port
+    {manifest}: the page manifest fw_protect wrote for this blob; only the pages whose digest differs
+    from the bootloader's are sent (this implies {sequenced})
+    """
+    check_frame_size(frame_size)
     # signed(hash(metadata | IV | F)) | metadata | IV | F
-    metadata_start = signature_length # the metadata begins after the signature
-    iv_start = metadata_start + metadata_length # the IV begins after the metadata
-    firmware_start = iv_start + iv_length # the firmware begins after the IV
-    
-    #assignments to corresponding sections of the {firmware_blob}
-    signed_hash = firmware_blob[0: signature_length] # starts in the beginning
-    metadata = firmware_blob[metadata_start : iv_start]
-    iv = firmware_blob[iv_start : firmware_start]
-    firmware = firmware_blob[firmware_start: ]
+    blob = parse_blob(firmware_blob)
+    signed_hash = bytes(blob.signature)
+    metadata = bytes(blob.metadata)
+    iv = bytes(blob.iv)
+    firmware = blob.firmware # a view if {firmware_blob} is one (of a mapped bundle, say)
+    
+    if manifest is not None:
+        if manifest['blob'] != blob_hash(firmware_blob):
+            raise ValueError("The page manifest belongs to a different firmware blob")
+        if blob.cipher != CIPHER_CBC or blob.segments is not None:
+            raise ValueError("Only CBC blobs of one run from FW_BASE can be sent a page at a time")
+        installed = query_page_digests(ser, len(manifest['pages']), timeout=timeout)
+        pages = changed_pages(manifest, installed)
+        print("Sending {} of {} pages".format(len(pages), len(manifest['pages'])))
+        header, firmware = delta_blob(firmware_blob[:blob.header_length], firmware, pages)
+        result = update_sequenced(ser, header, firmware, debug=debug, frame_size=frame_size, adaptive=adaptive,
+                                  timeout=timeout, retries=retries, journal=journal, device=device)
+        result['pages_skipped'] = len(manifest['pages']) - len(pages)
+        return result
+    if sequenced:
+        return update_sequenced(ser, firmware_blob[:blob.header_length], firmware, debug=debug,
+                                frame_size=frame_size, adaptive=adaptive, timeout=timeout, retries=retries,
+                                journal=journal, device=device)
+    if journal is not None:
+        raise ValueError("Only sequenced updates can be journalled")
+    if blob.prefix:
+        raise ValueError("Only sequenced updates can carry a blob with a typed prefix")
     
     # Handshake for update
     ser.write(b'U')
     
     print('Waiting for bootloader to enter update mode...')
+    started = now(ser)
     k = ser.read(1)
     print(k)
     while k != b'U':
+        if timeout is not None and now(ser) - started > timeout:
+            raise RuntimeError("ERROR: Bootloader did not enter update mode within {} seconds".format(timeout))
         k = ser.read(1)
         print(k)
-    time.sleep(3)
-    send_hash(ser, signed_hash, debug=debug) # send the signed hash
-    time.sleep(3)
-    send_metadata(ser, metadata, debug=debug) # send the metadata
-    time.sleep(3)
-    send_iv(ser, iv, debug=debug) #sends AES IV
-    time.sleep(3)
-    
-    for idx, frame_start in enumerate(range(0, len(firmware), FRAME_SIZE)): 
+    sleep(ser, PHASE_DELAY)
+    send_hash(ser, signed_hash, debug=debug, timeout=timeout) # send the signed hash
+    sleep(ser, PHASE_DELAY)
+    send_metadata(ser, metadata, debug=debug, timeout=timeout) # send the metadata
+    sleep(ser, PHASE_DELAY)
+    send_iv(ser, iv, debug=debug, timeout=timeout) #sends AES IV
+    sleep(ser, PHASE_DELAY)
+    
+    controller = FrameSizeController(frame_size) if adaptive else None
+    started = now(ser)
+    idx = 0
+    frame_start = 0
+    while frame_start < len(firmware):
 
-        # breaks up  data to be sent into 16 byte frames for the bootloader to take in
-        data = firmware[frame_start: frame_start + FRAME_SIZE]
+        # breaks up data to be sent into frames for the bootloader to take in
+        data = firmware[frame_start: frame_start + frame_size]
 
         # Get length of data.
         length = len(data)
         frame_fmt = '>H{}s'.format(length)
 
         # Construct frame.
-        frame = struct.pack(frame_fmt, length, data)
+        frame = struct.pack(frame_fmt, length, bytes(data))
 
         if debug:
             print("Writing frame {} ({} bytes)...".format(idx, len(frame)))
 
-        send_frame(ser, frame, debug=debug) # sends frame
+        sent = now(ser)
+        timeouts = send_frame(ser, frame, debug=debug, timeout=timeout) # sends frame
+        if controller is not None:
+            frame_size = controller.observe(length, now(ser) - sent, timeouts)
+        
+        idx += 1
+        frame_start += length
+    elapsed = now(ser) - started
     print("Done writing firmware.")
     
     # Send a zero length payload to tell the bootlader to finish writing its page.
     ser.write(struct.pack('>H', 0x0000))
 
-    return ser
+    return {
+        'frames': idx,
+        'bytes': len(firmware),
+        'elapsed': elapsed,
+        'frame_sizes': controller.decisions if controller is not None else [],
+        'retransmissions': 0,
+        'resumed_from': 0,
+        'pages_skipped': 0,
+    }
+
+
+def handshake(ser, request, reply, timeout=None):
+    """
+    Sends {request} and waits for the bootloader to answer with {reply}.
+    
+    Throws an error if it has not answered within {timeout} seconds (None waits forever).
+    """
+    ser.write(request)
+    
+    print('Waiting for bootloader to enter update mode...')
+    started = now(ser)
+    while ser.read(1) != reply:
+        if timeout is not None and now(ser) - started > timeout:
+            raise RuntimeError("ERROR: Bootloader did not enter update mode within {} seconds".format(timeout))
+
+
+def resume_handshake(ser, header, timeout=None):
+    """
+    Asks the bootloader to carry on with the transfer whose frame 0 was {header}.
+    
+    Returns: (sequence, offset), the next frame the bootloader expects and the number of bytes of F
+    it already has; (0, 0) if it had nothing to resume and has started a new transfer instead
+    """
+    handshake(ser, b'R' + hashlib.sha256(header).digest(), b'R', timeout=timeout)
+    position = ser.read(6)
+    if len(position) != 6:
+        raise RuntimeError("ERROR: Bootloader did not say where to resume from")
+    return struct.unpack('>HI', position)
+
+
+def update_sequenced(ser, header, firmware, debug=False, frame_size=FRAME_SIZE, adaptive=False, timeout=None,
+                     retries=MAX_RETRIES, journal=None, device=None):
+    """
+    Sends a firmware blob with sequenced frames: the 'S' handshake, then signed hash | metadata | IV
+    as frame 0, then F, then an empty frame. Only a frame that goes wrong is sent again.
+    
+    With a {journal}, every acknowledged frame is recorded against {device}. If the journal shows an
+    unfinished transfer of the same blob to {device}, the update resumes it with the 'R' handshake
+    and only sends what the bootloader does not already have.
+    
+    Returns: the update result, as for {update}
+    Outputs: sends the firmware blob over serial
+    
+    Arguments:
+    {ser}: serial read/write
+    {header}: signed(hash(metadata | IV | F)) | metadata | IV
+    {firmware}: F
+    {debug}, {frame_size}, {adaptive}, {timeout}, {retries}, {journal}, {device}: as for {update}
+    """
+    sequence, frame_start = 0, 0
+    entry = None
+    if journal is not None:
+        blob = blob_hash(bytes(header) + bytes(firmware))
+        entry = journal.load(device)
+        if entry is not None and entry['blob'] != blob: # a different blob: its progress is no use to us
+            journal.clear(device)
+            entry = None
+    
+    if entry is not None:
+        if time.time() - entry['updated'] < SESSION_TIMEOUT:
+            # The bootloader only puts a transfer aside once the line has been quiet for a while.
+            sleep(ser, SESSION_TIMEOUT)
+        sequence, frame_start = resume_handshake(ser, header, timeout=timeout)
+        if frame_start > len(firmware) or (sequence == 0) != (frame_start == 0):
+            raise RuntimeError("ERROR: Bootloader wants to resume from byte {} of {}".format(frame_start, len(firmware)))
+        if sequence:
+            print("Resuming at frame {} ({} of {} bytes already sent)".format(sequence, frame_start, len(firmware)))
+    else:
+        handshake(ser, b'S', b'S', timeout=timeout)
+    resumed_from = frame_start
+    
+    retransmissions = 0
+    if sequence == 0:
+        retransmissions += send_sequenced_frame(ser, 0, header, debug=debug, retries=retries)
+        sequence = 1
+        if journal is not None:
+            journal.record(device, blob, 0, 0)
+    
+    controller = FrameSizeController(frame_size) if adaptive else None
+    started = now(ser)
+    idx = 0
+    while frame_start < len(firmware):
+        data = firmware[frame_start: frame_start + frame_size]
+        
+        if debug:
+            print("Writing frame {} ({} bytes)...".format(sequence, len(data)))
+        
+        sent = now(ser)
+        resent = send_sequenced_frame(ser, sequence, data, debug=debug, retries=retries)
+        retransmissions += resent
+        if controller is not None:
+            frame_size = controller.observe(len(data), now(ser) - sent, resent)
+        
+        idx += 1
+        frame_start += len(data)
+        if journal is not None:
+            journal.record(device, blob, sequence, frame_start)
+        sequence += 1
+    elapsed = now(ser) - started
+    
+    # An empty frame tells the bootloader that F is complete.
+    retransmissions += send_sequenced_frame(ser, sequence, b'', debug=debug, retries=retries)
+    if journal is not None:
+        journal.clear(device)
+    print("Done writing firmware.")
+    
+    return {
+        'frames': idx,
+        'bytes': len(firmware) - resumed_from,
+        'elapsed': elapsed,
+        'frame_sizes': controller.decisions if controller is not None else [],
+        'retransmissions': retransmissions,
+        'resumed_from': resumed_from,
+        'pages_skipped': 0,
+    }
 
 
 if __name__ == '__main__':
@@ -251,15 +710,111 @@ if __name__ == '__main__':
     parser.add_argument("--port", help="Serial port to send update over.",
                         required=True)
     parser.add_argument("--firmware", help="Path to firmware image to load.",
-                        required=True)
+                        default=None)
+    parser.add_argument("--store", help="Artifact store to take the firmware from, by --version.",
+                        default=None)
+    parser.add_argument("--version", help="Version of the firmware to take from the store (or the bundle).",
+                        type=int, default=None)
+    parser.add_argument("--bundle", help="Release bundle to take the firmware from, by --variant.",
+                        default=None)
+    parser.add_argument("--variant", help="Variant of the firmware to take from the bundle (the highest "
+                        "version unless --version is given).", default=None)
     parser.add_argument("--debug", help="Enable debugging messages.",
                         action='store_true')
+    parser.add_argument("--frame-size", help="Number of firmware bytes per frame.",
+                        type=frame_size_arg, default=FRAME_SIZE)
+    parser.add_argument("--adaptive", help="Resize frames to suit the measured link quality.",
+                        action='store_true')
+    parser.add_argument("--timeout", help="Seconds to wait for each response before giving up.",
+                        type=float, default=None)
+    parser.add_argument("--sequenced", help="Number and checksum frames so damaged ones are sent again.",
+                        action='store_true')
+    parser.add_argument("--journal", help="Directory to record progress in, so an interrupted sequenced "
+                        "update can be resumed.", default=None)
+    parser.add_argument("--device-id", help="Identity of the device in the journal (default: the port).",
+                        default=None)
+    parser.add_argument("--public-key", help="Check the blob against this public key (or the bl_build "
+                        "secrets) before opening the port.", default=None)
+    parser.add_argument("--pages", help="Page manifest from fw_protect; only send the pages the device "
+                        "does not already have.", default=None)
+    parser.add_argument("--dry-run", help="Predict how long the update would take instead of sending it.",
+                        action='store_true')
+    parser.add_argument("--calibration", help="File of measured updates: a real update adds its timings, "
+                        "and --dry-run predicts from them.", default=None)
     args = parser.parse_args()
+    if [args.firmware, args.store, args.bundle].count(None) != 2:
+        parser.error("give one of --firmware, --store and --bundle")
+    if args.store is not None and args.version is None:
+        parser.error("--store needs --version")
+    if args.bundle is not None and args.variant is None:
+        parser.error("--bundle needs --variant")
+
+    if args.store is not None:
+        from fw_store import Store
+        store = Store(args.store)
+        key_id = None
+        if args.public_key is not None:
+            from fw_blob import key_fingerprint, load_public_key
+            key_id = key_fingerprint(load_public_key(args.public_key))
+        entry = store.resolve(args.version, key_id=key_id)
+        if entry is None:
+            raise SystemExit("ERROR: No firmware of version {} in {}".format(args.version, args.store))
+        args.firmware = str(store.blob_path(entry.blob_hash))
+        print('Using {} from the store'.format(entry.blob_hash))
+
+    if args.bundle is not None:
+        # Only the selected blob is read, straight out of the mapped bundle
+        from fw_bundle import Bundle
+        bundle = Bundle(args.bundle)
+        entry = bundle.select(args.variant, args.version)
+        if entry is None:
+            raise SystemExit("ERROR: No {} firmware{} in {}".format(
+                args.variant, '' if args.version is None else ' of version {}'.format(args.version), args.bundle))
+        firmware_blob = bundle.blob(entry)
+        source = '{} v{} from {}'.format(entry.variant, entry.version, args.bundle)
+        print('Using {}'.format(source))
+    else:
+        with open(args.firmware, 'rb') as fp:
+            firmware_blob = fp.read()
+        source = args.firmware
+
+    if args.dry_run:
+        import fw_predict
+        model = fw_predict.DEFAULT_MODEL
+        if args.calibration is not None:
+            model = fw_predict.calibrate(fw_predict.load_measurements(args.calibration))
+        prediction = fw_predict.predict(firmware_blob, frame_size=args.frame_size,
+                                        sequenced=args.sequenced or args.journal is not None, model=model)
+        print(fw_predict.format_prediction(prediction))
+        raise SystemExit(0)
+
+    manifest = None
+    if args.pages is not None:
+        with open(args.pages) as fp:
+            manifest = json.load(fp)
+
+    if args.public_key is not None:
+        from fw_blob import load_public_key
+        from fw_preflight import preflight
+        check = preflight(firmware_blob, load_public_key(args.public_key))
+        if not check['ok']:
+            raise SystemExit("ERROR: {} failed pre-flight checks: {}".format(source, '; '.join(check['problems'])))
+        print('Pre-flight checks passed{}.'.format(' (cached)' if check['cached'] else ''))
 
+    from serial import Serial # only needed once there is an update to send
     print('Opening serial port...')
     # Open serial port. Set baudrate to 115200. Set timeout to 2 seconds.
     ser = Serial(args.port, baudrate=115200, timeout=2)
-    main(ser=ser, infile=args.firmware, debug=args.debug)
+    result = update(ser, firmware_blob, debug=args.debug,
+                    frame_size=args.frame_size, adaptive=args.adaptive, timeout=args.timeout,
+                    sequenced=args.sequenced or args.journal is not None,
+                    journal=Journal(args.journal) if args.journal else None, device=args.device_id or args.port,
+                    manifest=manifest)
+    for decision in result['frame_sizes']:
+        print("Frame {frame}: {from} -> {to} bytes ({reason})".format(**decision))
+    if args.calibration is not None and not args.adaptive and manifest is None and not result['resumed_from']:
+        import fw_predict
+        fw_predict.record_measurement(args.calibration, result, args.sequenced or args.journal is not None)
 
 
 
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+"""
+Device Key Database
+
+The keys bl_build provisions for each device (see bl_build.provision), kept in one SQLite file so
+that fw_protect can encrypt a release for a whole fleet and a device's keys can be looked up by
+its ID or by the fingerprint of its public key:
+
+    device_id    the ID the device was provisioned under
+    signature    the signing scheme ('rsa', 'ed25519' or 'p256')
+    key_id       fw_blob.key_fingerprint of the public key (indexed)
+    aes_key      the 16 byte AES key
+    private_key  the signing key, PEM
+    public_key   the public key, PEM
+    image        the device's bootloader image, or NULL if none was built
+    created      when the record was written (seconds since the epoch)
+
+The file holds private keys, so it must be kept as carefully as secret_build_output.txt: it is
+created with mode 0600, as are the secrets files export_secrets writes.
+"""
+import argparse
+import collections
+import os
+import sqlite3
+import time
+
+KEY_DB = 'device_keys.db'
+
+Device = collections.namedtuple('Device', ['device_id', 'signature', 'key_id', 'aes_key', 'private_key',
+                                           'public_key', 'image', 'created'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    device_id TEXT PRIMARY KEY,
+    signature TEXT NOT NULL,
+    key_id TEXT NOT NULL,
+    aes_key BLOB NOT NULL,
+    private_key BLOB NOT NULL,
+    public_key BLOB NOT NULL,
+    image TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS devices_key_id ON devices (key_id);
+"""
+
+
+def private_file(path, truncate=False):
+    """
+    Returns: a file descriptor of {path} open for writing, creating the file readable and writable
+    by this user alone (an existing file is made so too)
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | (os.O_TRUNC if truncate else 0), 0o600)
+    os.fchmod(fd, 0o600)
+    return fd
+
+
+class KeyDatabase:
+    """
+    A device key database.
+
+    Arguments:
+    {path}: the database file (created with mode 0600 if it does not exist)
+    """
+
+    def __init__(self, path=KEY_DB):
+        self.path = path
+        if str(path) != ':memory:':
+            # SQLite gives its journal the database's mode
+            os.close(private_file(path))
+        self.db = sqlite3.connect(str(path))
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def put(self, devices):
+        """
+        Writes the records {devices} (Device tuples, whose 'created' may be None) in one
+        transaction, replacing any record with the same device ID.
+        """
+        now = time.time()
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                [device._replace(created=device.created or now) for device in devices])
+
+    def set_image(self, device_id, image):
+        """Records {image} as the path of the bootloader image built for {device_id}."""
+        with self.db:
+            self.db.execute('UPDATE devices SET image = ? WHERE device_id = ?', (str(image), device_id))
+
+    def get(self, device_id):
+        """
+        Returns: the Device record for {device_id}, or None if it has not been provisioned
+        """
+        row = self.db.execute('SELECT * FROM devices WHERE device_id = ?', (device_id,)).fetchone()
+        return Device(*row) if row is not None else None
+
+    def by_key_id(self, key_id):
+        """
+        Returns: the Device record whose public key has the fingerprint {key_id}, or None
+        """
+        row = self.db.execute('SELECT * FROM devices WHERE key_id = ?', (key_id,)).fetchone()
+        return Device(*row) if row is not None else None
+
+    def devices(self, device_ids=None):
+        """
+        Returns: the Device records for {device_ids} in that order, or every record (by device ID)
+        if it is None
+
+        Throws a KeyError naming a device that has not been provisioned.
+        """
+        if device_ids is None:
+            return [Device(*row) for row in self.db.execute('SELECT * FROM devices ORDER BY device_id')]
+        devices = []
+        for device_id in device_ids:
+            device = self.get(device_id)
+            if device is None:
+                raise KeyError("Device {} has not been provisioned".format(device_id))
+            devices.append(device)
+        return devices
+
+    def keys(self, device_id):
+        """
+        Returns: (aes_key, signing_key) for {device_id}, as fw_protect.load_secrets returns them
+        """
+        from fw_blob import import_key
+        device = self.devices([device_id])[0]
+        return device.aes_key, import_key(device.private_key)
+
+    def export_secrets(self, device_id, path):
+        """
+        Writes the keys of {device_id} to {path} in the format of secret_build_output.txt, for the
+        tools that take a secrets file. The file is made readable by this user alone.
+        """
+        device = self.devices([device_id])[0]
+        with open(private_file(path, truncate=True), 'wb') as fh:
+            fh.write(device.aes_key)
+            fh.write(device.private_key)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Device Key Database')
+    parser.add_argument("--db", help="The key database.", default=KEY_DB)
+    parser.add_argument("--export", help="Write the secrets file of this device ...", default=None)
+    parser.add_argument("--secrets", help="... to this path.", default='secret_build_output.txt')
+    args = parser.parse_args()
+
+    with KeyDatabase(args.db) as db:
+        if args.export is not None:
+            db.export_secrets(args.export, args.secrets)
+        else:
+            for device in db.devices():
+                print('{:<24} {:<8} {} {}'.format(device.device_id, device.signature, device.key_id,
+                                                  device.image or '(no image)'))
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+"""
+RSA Montgomery Constants
+
+Computes the constants a Montgomery-form RSA verifier needs for the bootloader's public key, writes
+them into a C header that bl_build generates next to the bootloader sources, and checks blob
+signatures with them the way a device would, so the constants can be cross-checked on the host.
+
+With the modulus n held as WORDS little-endian 32-bit words and R = 2^(32 * WORDS):
+
+    RSA_N        n, least significant word first
+    RSA_N0I      -n^-1 mod 2^32, the factor each Montgomery reduction step multiplies by
+    RSA_R2       R^2 mod n, which takes a number into Montgomery form with one multiplication
+    RSA_E        the public exponent
+
+so verifying a signature costs the multiplications of the exponentiation and nothing else. No
+bootloader source includes the header yet; it is generated for a Montgomery-form verifier to come.
+"""
+import argparse
+import re
+
+WORD_BITS = 32
+WORD_MASK = (1 << WORD_BITS) - 1
+MODULUS_SIZE = 256 # bytes, as in snakessl.h
+WORDS = MODULUS_SIZE * 8 // WORD_BITS
+
+# DER prefix of the DigestInfo for SHA-256 in a PKCS#1 v1.5 signature
+SHA256_DIGEST_INFO = bytes.fromhex('3031300d060960864801650304020105000420')
+
+
+def constants(n, e):
+    """
+    Returns: the Montgomery constants for the public key ({n}, {e}), as a dictionary with 'n',
+    'n0i', 'r2' and 'e'
+    """
+    if n % 2 == 0:
+        raise ValueError("The modulus must be odd")
+    return {
+        'n': n,
+        'n0i': -pow(n, -1, 1 << WORD_BITS) & WORD_MASK,
+        'r2': pow(2, 2 * WORD_BITS * WORDS, n),
+        'e': e,
+    }
+
+
+def to_words(value):
+    """
+    Returns: {value} as WORDS 32-bit words, least significant first
+    """
+    return [(value >> (WORD_BITS * i)) & WORD_MASK for i in range(WORDS)]
+
+
+def from_words(words):
+    """
+    Returns: the number held in {words}, least significant first
+    """
+    return sum(word << (WORD_BITS * i) for i, word in enumerate(words))
+
+
+def mont_mul(a, b, n, n0i):
+    """
+    Returns: a * b * R^-1 mod {n} for word lists {a} and {b}, by word-serial Montgomery
+    multiplication (CIOS), the way a 32-bit device computes it
+    """
+    t = [0] * (WORDS + 2)
+    for i in range(WORDS):
+        carry = 0
+        for j in range(WORDS):
+            total = t[j] + a[j] * b[i] + carry
+            t[j], carry = total & WORD_MASK, total >> WORD_BITS
+        total = t[WORDS] + carry
+        t[WORDS], t[WORDS + 1] = total & WORD_MASK, total >> WORD_BITS
+
+        m = (t[0] * n0i) & WORD_MASK
+        carry = (t[0] + m * n[0]) >> WORD_BITS
+        for j in range(1, WORDS):
+            total = t[j] + m * n[j] + carry
+            t[j - 1], carry = total & WORD_MASK, total >> WORD_BITS
+        total = t[WORDS] + carry
+        t[WORDS - 1], carry = total & WORD_MASK, total >> WORD_BITS
+        t[WORDS], t[WORDS + 1] = t[WORDS + 1] + carry, 0
+
+    result = from_words(t[:WORDS + 1])
+    modulus = from_words(n)
+    return to_words(result - modulus if result >= modulus else result)
+
+
+def mont_pow(base, consts):
+    """
+    Returns: {base} ^ e mod n using only Montgomery multiplications and the precomputed {consts}
+    """
+    n = to_words(consts['n'])
+    n0i = consts['n0i']
+    x = mont_mul(to_words(base), to_words(consts['r2']), n, n0i) # base * R mod n
+    acc = x
+    for bit in bin(consts['e'])[3:]: # left to right, after the leading 1
+        acc = mont_mul(acc, acc, n, n0i)
+        if bit == '1':
+            acc = mont_mul(acc, x, n, n0i)
+    one = [1] + [0] * (WORDS - 1)
+    return from_words(mont_mul(acc, one, n, n0i)) # out of Montgomery form
+
+
+def verify(signature, digest, consts):
+    """
+    Returns: True if {signature} is a PKCS#1 v1.5 signature of the SHA-256 {digest} under the key
+    the Montgomery {consts} were computed for
+    """
+    s = int.from_bytes(bytes(signature), 'big')
+    if len(signature) != MODULUS_SIZE or s >= consts['n']:
+        return False
+    encoded = mont_pow(s, consts).to_bytes(MODULUS_SIZE, 'big')
+    suffix = b'\x00' + SHA256_DIGEST_INFO + digest
+    expected = b'\x00\x01' + b'\xff' * (MODULUS_SIZE - 2 - len(suffix)) + suffix
+    return encoded == expected
+
+
+def c_words(words):
+    """Returns: a C array initializer for {words}"""
+    return '{' + ', '.join('0x{:08x}'.format(word) for word in words) + '}'
+
+
+def write_header(path, public_key):
+    """Writes the Montgomery constants of the RSA {public_key} to the C header at {path}."""
+    consts = constants(public_key.n, public_key.e)
+    with open(path, 'w') as fh:
+        fh.write('/* Generated by tools/bl_build.py from the RSA public key. Do not edit. */\n')
+        fh.write('#ifndef RSA_CONSTANTS_H\n#define RSA_CONSTANTS_H\n\n')
+        fh.write('#define RSA_WORDS {}\n'.format(WORDS))
+        fh.write('#define RSA_N {}\n'.format(c_words(to_words(consts['n']))))
+        fh.write('#define RSA_N0I 0x{:08x}\n'.format(consts['n0i']))
+        fh.write('#define RSA_R2 {}\n'.format(c_words(to_words(consts['r2']))))
+        fh.write('#define RSA_E 0x{:x}\n'.format(consts['e']))
+        fh.write('\n#endif\n')
+
+
+def read_header(path):
+    """
+    Returns: the constants in a header written by write_header(), in the form constants() returns
+    """
+    with open(path) as fh:
+        defines = dict(re.findall(r'#define (RSA_\w+) (.+)', fh.read()))
+    words = {name: [int(word, 16) for word in re.findall(r'0x[0-9a-f]+', defines[name])]
+             for name in ('RSA_N', 'RSA_R2')}
+    return {
+        'n': from_words(words['RSA_N']),
+        'n0i': int(defines['RSA_N0I'], 16),
+        'r2': from_words(words['RSA_R2']),
+        'e': int(defines['RSA_E'], 16),
+    }
+
+
+def check_constants(consts):
+    """
+    Returns: a list of the constants in {consts} that are not what the modulus and exponent imply
+    (empty if all of them are right)
+    """
+    expected = constants(consts['n'], consts['e'])
+    return [name for name in ('n0i', 'r2') if consts[name] != expected[name]]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='RSA Montgomery Constants')
+    parser.add_argument("--header", help="The generated header to check.", required=True)
+    parser.add_argument("--firmware", help="A firmware blob to verify with the header's constants.", default=None)
+    parser.add_argument("--public-key", help="Public key (or bl_build secrets) the header should match.",
+                        default=None)
+    args = parser.parse_args()
+
+    consts = read_header(args.header)
+    bad = check_constants(consts)
+    print('Constants: {}'.format('consistent' if not bad else 'WRONG ' + ', '.join(bad)))
+    if args.public_key is not None:
+        from fw_blob import load_public_key
+        public_key = load_public_key(args.public_key)
+        matches = (public_key.n, public_key.e) == (consts['n'], consts['e'])
+        print('Public key: {}'.format('matches' if matches else 'DIFFERENT'))
+    if args.firmware is not None:
+        from fw_blob import SIG_RSA, parse_blob, signed_digest
+        with open(args.firmware, 'rb') as fp:
+            blob = parse_blob(fp.read())
+        if blob.sig_type != SIG_RSA:
+            raise SystemExit("ERROR: {} is not signed with RSA".format(args.firmware))
+        valid = verify(blob.signature, signed_digest(blob).digest(), consts)
+        print('Signature: {}'.format('valid' if valid else 'INVALID'))
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""
+Serial Link Simulator
+
+Wraps a simulated device (a bl_model.BootloaderModel) in a simulated cable, so the update protocol can be run against the problems production cables have: a slow baud rate,
+latency and jitter, dropped bytes, flipped bits and stalls.
+
+The link keeps its own clock instead of sleeping. Writing bytes and waiting for responses move the
+clock forward by the time they would take on a real cable, and fw_update reads the clock through
+monotonic() and sleep() so that its own delays and timings use simulated time as well. This lets a
+transfer that would take minutes on a real link run in well under a second.
+
+Because nothing waits in real time, the device must run on the same clock: it has to keep time
+through a clock attribute, which the link points at its own. A real port (a pyserial Serial) cannot
+be wrapped, as read() would give up on bytes that are still on their way.
+
+Every random decision comes from a random.Random seeded with {seed}, so a scenario can be replayed
+exactly.
+"""
+import collections
+import random
+
+
+class SimulatedSerial:
+    """
+    A serial port with configurable faults on both directions of the link.
+
+    Arguments:
+    {transport}: the device end of the link; needs write(data), read(size), in_waiting and a clock
+        attribute (bl_model.BootloaderModel has them all)
+    {baudrate}: line rate used to pace bytes (10 bits per byte: start, 8 data, stop)
+    {latency}: seconds from a byte leaving one end until it starts to arrive at the other
+    {jitter}: up to this many extra seconds of latency, chosen at random per write
+    {drop}: probability that any one byte is lost
+    {corrupt}: probability that any one byte has a bit flipped
+    {stall}: probability that a write stalls the link
+    {stall_time}: seconds that a stall holds the link up for
+    {timeout}: seconds read() waits for data before returning b'' (as in Serial(timeout=...))
+    {seed}: seed for the fault generator
+
+    {stats} counts the bytes sent each way and the faults that were injected.
+    The transport's clock is pointed at the simulated clock.
+
+    Throws a TypeError if the transport has no clock to point (see the module docstring).
+    """
+
+    def __init__(self, transport, baudrate=115200, latency=0.0, jitter=0.0, drop=0.0, corrupt=0.0,
+                 stall=0.0, stall_time=1.0, timeout=2, seed=None):
+        if not hasattr(transport, 'clock'):
+            raise TypeError("SimulatedSerial needs a simulated device with a clock, not {}".format(
+                type(transport).__name__))
+        self.transport = transport
+        self.baudrate = baudrate
+        self.latency = latency
+        self.jitter = jitter
+        self.drop = drop
+        self.corrupt = corrupt
+        self.stall = stall
+        self.stall_time = stall_time
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.stats = collections.Counter()
+        self._now = 0.0
+        self._line_free = 0.0 # when the device-to-host direction has finished sending its queue
+        self._rx = collections.deque() # (arrival time, byte) pairs heading to the host
+        transport.clock = self.monotonic
+
+    # Clock
+
+    def monotonic(self):
+        """Returns: the current simulated time in seconds"""
+        return self._now
+
+    def sleep(self, seconds):
+        """Moves the simulated clock forward by {seconds}."""
+        self._now += max(seconds, 0)
+
+    def _byte_time(self):
+        return 10.0 / self.baudrate
+
+    # Faults
+
+    def _inject(self, data, direction):
+        """
+        Applies drops and bit flips to {data}.
+
+        Returns: the bytes that make it across the link
+        """
+        out = bytearray()
+        for byte in data:
+            if self.drop and self.rng.random() < self.drop:
+                self.stats[direction + '_dropped'] += 1
+                continue
+            if self.corrupt and self.rng.random() < self.corrupt:
+                byte ^= 1 << self.rng.randrange(8)
+                self.stats[direction + '_corrupted'] += 1
+            out.append(byte)
+        return bytes(out)
+
+    def _delay(self):
+        delay = self.latency
+        if self.jitter:
+            delay += self.rng.uniform(0, self.jitter)
+        if self.stall and self.rng.random() < self.stall:
+            delay += self.stall_time
+            self.stats['stalls'] += 1
+        return delay
+
+    # Serial interface
+
+    @property
+    def in_waiting(self):
+        self._pull()
+        return sum(1 for ready, _ in self._rx if ready <= self._now)
+
+    def write(self, data):
+        """
+        Sends {data} to the device, taking as long as the bytes take to clock out at {baudrate}.
+
+        Returns: the number of bytes written
+        """
+        data = bytes(data)
+        self.stats['tx_bytes'] += len(data)
+        self._now += len(data) * self._byte_time()
+        arrival = self._now + self._delay() # when the device has the bytes and starts answering
+        self.transport.write(self._inject(data, 'tx'))
+        self._pull(arrival)
+        return len(data)
+
+    def _pull(self, sent=None):
+        """
+        Collects whatever the device has sent and schedules it to arrive at the host.
+
+        Arguments:
+        {sent}: the time the device sent it (defaults to now)
+        """
+        waiting = self.transport.in_waiting
+        if not waiting:
+            return
+        data = self._inject(self.transport.read(waiting), 'rx')
+        ready = max(self._now if sent is None else sent, self._line_free) + self._delay()
+        for byte in data:
+            ready += self._byte_time()
+            self._rx.append((ready, byte))
+        self._line_free = ready
+
+    def read(self, size=1):
+        """
+        Waits up to {timeout} seconds of simulated time for data from the device.
+
+        Returns: up to {size} bytes, or b'' if the read timed out
+        """
+        self._pull()
+        deadline = self._now + (self.timeout if self.timeout is not None else float('inf'))
+        out = bytearray()
+        while self._rx and len(out) < size and self._rx[0][0] <= deadline:
+            ready, byte = self._rx.popleft()
+            self._now = max(self._now, ready)
+            out.append(byte)
+        if not out:
+            if deadline == float('inf'):
+                raise RuntimeError("ERROR: read with no timeout on a link that will never answer")
+            self._now = deadline
+        self.stats['rx_bytes'] += len(out)
+        return bytes(out)
+
+    def reset_input_buffer(self):
+        self._pull()
+        self._rx.clear()
+
+    def close(self):
+        pass
@@ -0,0 +1,42 @@
+"""
+Fixtures shared by the host tool tests.
+
+The tools import each other as top-level modules (they are run from the tools directory), so the
+directory is put on the path here. Keys are generated once per test session; no test reads or
+writes secret_build_output.txt.
+"""
+import os
+import random
+import sys
+
+import pytest
+from Crypto.PublicKey import ECC, RSA
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FIRMWARE_SIZE = 20000 # bytes; a little under 20 flash pages
+
+
+@pytest.fixture(scope='session')
+def aes_key():
+    return bytes(random.Random(1).getrandbits(8) for _ in range(16))
+
+
+@pytest.fixture(scope='session')
+def signing_keys():
+    """(signature type -> signing key) for every scheme the bootloader checks"""
+    return {
+        'rsa': RSA.generate(2048),
+        'ed25519': ECC.generate(curve='ed25519'),
+        'p256': ECC.generate(curve='P-256'),
+    }
+
+
+@pytest.fixture(scope='session')
+def rsa_key(signing_keys):
+    return signing_keys['rsa']
+
+
+@pytest.fixture(scope='session')
+def firmware():
+    return random.Random(0).randbytes(FIRMWARE_SIZE)
@@ -0,0 +1,96 @@
+"""
+Provisioning devices into the key database, with the file modes that keep their keys private. The
+bootloader build itself (make) is replaced, so no test touches the bootloader sources.
+"""
+import os
+import stat
+
+import pytest
+
+import bl_build
+from fw_blob import key_fingerprint
+from key_db import KeyDatabase
+
+
+def mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+@pytest.fixture
+def db(tmp_path):
+    with KeyDatabase(tmp_path / 'device_keys.db') as db:
+        yield db
+
+
+@pytest.fixture
+def fake_build(tmp_path, monkeypatch):
+    """Replaces compile_bootloader; returns the keys each build was given."""
+    image = tmp_path / 'main.bin'
+    image.write_bytes(b'bootloader image')
+    os.chmod(image, 0o644)
+    monkeypatch.setattr(bl_build, 'BOOTLOADER_IMAGE', image)
+    builds = []
+
+    def compile_bootloader(aes_key, rsa_key, clean=True):
+        builds.append((aes_key, rsa_key.public_key(), clean))
+        return True
+    monkeypatch.setattr(bl_build, 'compile_bootloader', compile_bootloader)
+    return builds
+
+
+def test_key_database_is_private(tmp_path, db):
+    assert mode(tmp_path / 'device_keys.db') == 0o600
+    loose = tmp_path / 'loose.db'
+    loose.touch(mode=0o644)
+    KeyDatabase(loose).close()
+    assert mode(loose) == 0o600
+
+
+@pytest.mark.parametrize('signature', ['ed25519', 'p256'])
+def test_provision_without_images(tmp_path, db, signature):
+    assert bl_build.provision(['dev-1', 'dev-2', 'dev-3'], db, signature=signature, workers=2)
+    devices = db.devices()
+    assert [device.device_id for device in devices] == ['dev-1', 'dev-2', 'dev-3']
+    assert len({device.aes_key for device in devices}) == 3
+    for device in devices:
+        aes_key, signing_key = db.keys(device.device_id)
+        assert device.signature == signature and len(aes_key) == 16
+        assert device.key_id == key_fingerprint(signing_key.public_key())
+        assert db.by_key_id(device.key_id).device_id == device.device_id
+        assert device.image is None
+
+    secrets = tmp_path / 'secrets.txt'
+    secrets.touch(mode=0o644)
+    db.export_secrets('dev-2', secrets)
+    assert mode(secrets) == 0o600
+    assert secrets.read_bytes()[:16] == db.get('dev-2').aes_key
+
+
+def test_provision_writes_private_images(tmp_path, db, fake_build):
+    image_dir = tmp_path / 'images'
+    image_dir.mkdir(mode=0o755)
+    os.chmod(image_dir, 0o755)
+    assert bl_build.provision(['dev-1', 'dev-2'], db, image_dir=image_dir, workers=2)
+
+    assert mode(image_dir) == 0o700
+    assert [clean for _, _, clean in fake_build] == [True, False]
+    for device, (aes_key, public_key, _) in zip(db.devices(), fake_build):
+        assert (device.aes_key, device.key_id) == (aes_key, key_fingerprint(public_key))
+        image = image_dir / '{}.bin'.format(device.device_id)
+        assert device.image == str(image)
+        assert image.read_bytes() == b'bootloader image'
+        assert mode(image) == 0o600
+
+
+def test_failed_build_keeps_the_keys(tmp_path, db, monkeypatch):
+    monkeypatch.setattr(bl_build, 'compile_bootloader', lambda *args, **kwargs: False)
+    assert not bl_build.provision(['dev-1', 'dev-2'], db, image_dir=tmp_path / 'images', workers=1)
+    assert [device.device_id for device in db.devices()] == ['dev-1']
+    assert not list((tmp_path / 'images').iterdir())
+
+
+@pytest.mark.parametrize('device_ids', [['dev/1'], ['dev 1'], ['dev-1', 'dev-1']])
+def test_bad_device_ids_are_refused(db, device_ids):
+    with pytest.raises(ValueError):
+        bl_build.provision(device_ids, db)
+    assert db.devices() == []
@@ -0,0 +1,93 @@
+"""
+The bootloader fuzzer: seed cases install, mutations are reproducible from the seed, and failures
+are minimised and replayed under the checks they were found with.
+"""
+import hashlib
+import os
+import random
+import subprocess
+import sys
+
+import pytest
+
+import bl_fuzz
+from fw_blob import parse_blob
+from fw_protect import protect_image
+
+FRAME_SIZE = 256
+
+
+@pytest.fixture(scope='module')
+def blob(firmware, aes_key, rsa_key):
+    return protect_image(firmware[:2048], 3, 'fuzz', aes_key, rsa_key)[0]
+
+
+@pytest.fixture(scope='module')
+def accepted(blob):
+    return {hashlib.sha256(bytes(parse_blob(blob).firmware)).hexdigest()}
+
+
+def test_seed_cases_install(blob, rsa_key, accepted):
+    cases = bl_fuzz.seed_cases(blob, FRAME_SIZE)
+    assert [case[0]['data'] for case in cases] == [b'U', b'S']
+    frames = -(-len(parse_blob(blob).firmware) // FRAME_SIZE)
+    assert [item['sequence'] for item in cases[1][1:]] == list(range(frames + 2))
+    for case in cases:
+        failure, result = bl_fuzz.run_case(case, rsa_key.public_key(), accepted)
+        assert failure is None
+        assert result[0] == 'installed'
+
+
+def test_prefixed_blob_has_no_plain_update(firmware, aes_key, signing_keys):
+    blob, _ = protect_image(firmware[:2048], 3, 'fuzz', aes_key, signing_keys['ed25519'])
+    assert [case[0]['data'] for case in bl_fuzz.seed_cases(blob, FRAME_SIZE)] == [b'S']
+
+
+def test_mutate_is_seeded(blob):
+    seed = bl_fuzz.seed_cases(blob, FRAME_SIZE)[1]
+    original = [dict(item) for item in seed]
+
+    def mutations(seed_value):
+        rng = random.Random(seed_value)
+        return [bl_fuzz.mutate(seed, rng) for _ in range(200)]
+
+    first = mutations(7)
+    assert first == mutations(7)
+    assert first != mutations(8)
+    assert seed == original # mutate() works on a copy
+    assert sum(case != seed for case in first) > 150
+    for case in first:
+        bl_fuzz.run_case(case)
+
+
+def test_minimise_keeps_the_failure(blob):
+    # Every installed firmware counts as unexpected, so the seed case itself fails
+    case = bl_fuzz.seed_cases(blob, FRAME_SIZE)[1]
+    case = case + [bl_fuzz.unit('raw', b'\x00' * 8, gap=bl_fuzz.IDLE_GAP)]
+    failure, _ = bl_fuzz.run_case(case, accepted=set())
+    assert failure == "installed firmware that no seed blob carries"
+
+    smallest = bl_fuzz.minimise(case, failure, accepted=set(), budget=300)
+    assert bl_fuzz.run_case(smallest, accepted=set())[0] == failure
+    assert len(smallest) < len(case)
+    assert sum(len(bl_fuzz.encode(item)) for item in smallest) < sum(len(bl_fuzz.encode(item)) for item in case)
+    assert smallest[0] == case[0] # the instruction stays
+
+
+def test_replay_uses_the_saved_digests(tmp_path, blob, rsa_key, accepted):
+    # Firmware signed with this key but not among the seeds: only the saved digests make it a failure
+    other, _ = protect_image(bytes(2048), 3, 'other', bytes(16), rsa_key)
+    case = bl_fuzz.seed_cases(other, FRAME_SIZE)[1]
+    failure, _ = bl_fuzz.run_case(case, rsa_key.public_key(), accepted)
+    assert failure == "installed firmware that no seed blob carries"
+
+    path = tmp_path / 'failures.json'
+    bl_fuzz.save_failures(path, {failure: case}, accepted)
+    assert bl_fuzz.load_failures(path) == ({failure: case}, accepted)
+
+    key_path = tmp_path / 'key.pem'
+    key_path.write_bytes(rsa_key.public_key().export_key(format='PEM'))
+    done = subprocess.run([sys.executable, 'bl_fuzz.py', '--replay', str(path), '--public-key', str(key_path)],
+                          cwd=os.path.dirname(bl_fuzz.__file__), stdout=subprocess.PIPE, universal_newlines=True,
+                          check=True)
+    assert '  now: ' + failure in done.stdout
@@ -0,0 +1,63 @@
+"""
+The embsec entry point: the quick commands start within the budget and import no heavy module.
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+import embsec
+from fw_protect import protect_image
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(embsec.__file__))
+
+# Runs embsec in this interpreter, then prints the heavy packages that ended up in sys.modules
+IMPORTED = '''
+import runpy, sys
+sys.argv = [{embsec!r}] + {args!r}
+try:
+    runpy.run_path({embsec!r}, run_name='__main__')
+except SystemExit:
+    pass
+print(sorted({{name.split('.')[0] for name in sys.modules}} & set({heavy!r})), file=sys.stderr)
+'''
+
+
+def heavy_imports(args):
+    """
+    Returns: the packages in HEAVY_MODULES that `embsec {args}` imported
+    """
+    script = IMPORTED.format(embsec=embsec.__file__, args=list(args), heavy=embsec.HEAVY_MODULES)
+    done = subprocess.run([sys.executable, '-c', script], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          universal_newlines=True, cwd=TOOLS_DIR, check=True)
+    return done.stderr.splitlines()[-1]
+
+
+@pytest.fixture(scope='module')
+def blob_path(tmp_path_factory, firmware, aes_key, rsa_key):
+    path = tmp_path_factory.mktemp('embsec') / 'fw.blob'
+    path.write_bytes(protect_image(firmware, 3, 'release', aes_key, rsa_key)[0])
+    return str(path)
+
+
+@pytest.mark.parametrize('args', [['--help'], ['update', '--help'], ['inspect', '--help'], ['audit', '--help']],
+                         ids=' '.join)
+def test_help_imports_no_heavy_module(args):
+    assert heavy_imports(args) == '[]'
+
+
+def test_inspect_imports_no_heavy_module(blob_path):
+    assert heavy_imports(['inspect', '--firmware', blob_path]) == '[]'
+
+
+def test_quick_commands_start_within_the_budget(blob_path):
+    for args in (['--help'], ['update', '--help'], ['inspect', '--firmware', blob_path]):
+        elapsed, heavy = embsec.startup_time(args, runs=3)
+        assert heavy == []
+        assert elapsed <= embsec.STARTUP_BUDGET, (args, elapsed)
+
+
+def test_startup_command(blob_path, capsys):
+    assert embsec.main(['startup', '--runs', '1', '--budget', '10', '--firmware', blob_path]) == 0
+    assert capsys.readouterr().out.count('ok   embsec') == 3
@@ -0,0 +1,62 @@
+"""
+The flash model: erase and program semantics, and the time and wear it accounts for.
+"""
+import pytest
+
+import fw_update
+from bl_model import BootloaderModel
+from flash_model import FLASH_PAGESIZE, FW_BASE, FlashModel
+from fw_protect import protect_image
+from serial_sim import SimulatedSerial
+
+
+def test_erase_and_program_costs():
+    flash = FlashModel(erase_time=0.01, program_time=0.001)
+    flash.erase(FW_BASE)
+    flash.program(b'\x12\x34\x56\x78' * 4, FW_BASE)
+    assert flash.read(FW_BASE, 20) == b'\x12\x34\x56\x78' * 4 + b'\xff' * 4
+    assert flash.time == pytest.approx(0.01 + 4 * 0.001)
+    assert flash.report() == {'time': pytest.approx(0.014), 'erases': 1, 'words': 4, 'pages': 1,
+                              'max_page_erases': 1}
+
+
+def test_program_flash_pads_to_a_word_and_erases_first():
+    flash = FlashModel(fill=0x00)
+    flash.program_flash(FW_BASE, b'abcde', 5)
+    assert flash.read(FW_BASE, 8) == b'abcde\x00\x00\x00'
+    assert flash.read(FW_BASE + 8, FLASH_PAGESIZE - 8) == b'\xff' * (FLASH_PAGESIZE - 8)
+    assert flash.erases[FW_BASE // FLASH_PAGESIZE] == 1
+    assert flash.programs[FW_BASE // FLASH_PAGESIZE] == 2
+
+
+def test_overwrites_without_an_erase_are_counted():
+    flash = FlashModel()
+    flash.program(b'\x00\x00\x00\x00', FW_BASE)
+    flash.program(b'\xff\x00\x00\x00', FW_BASE) # cannot set bits back to 1
+    assert flash.overwrites == 1
+    assert flash.read(FW_BASE, 4) == b'\x00\x00\x00\x00'
+
+
+@pytest.mark.parametrize('page_addr', [FW_BASE + 4, -FLASH_PAGESIZE, 256 * 1024])
+def test_bad_erase_is_refused(page_addr):
+    with pytest.raises(ValueError):
+        FlashModel().erase(page_addr)
+
+
+def test_report_since_a_snapshot(firmware, aes_key, rsa_key):
+    flash = FlashModel()
+    dev = BootloaderModel(aes_key=aes_key, public_key=rsa_key.public_key(), flash=flash)
+    link = SimulatedSerial(dev, seed=1)
+    first, _ = protect_image(firmware, 3, 'one', aes_key, rsa_key)
+    second, _ = protect_image(firmware, 4, 'one', aes_key, rsa_key)
+    fw_update.update(link, first, sequenced=True, timeout=5)
+    pages = -(-len(dev.firmware) // FLASH_PAGESIZE)
+    after_first = flash.report()
+    assert after_first['pages'] >= pages
+    snapshot = flash.snapshot()
+
+    fw_update.update(link, second, sequenced=True, timeout=5)
+    second_update = flash.report(since=snapshot)
+    assert second_update['erases'] == after_first['erases']
+    assert second_update['time'] == pytest.approx(after_first['time'])
+    assert flash.report()['max_page_erases'] == 2
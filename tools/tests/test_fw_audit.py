@@ -0,0 +1,60 @@
+"""
+The archive auditor over good and bad blobs, in a directory tree and in an artifact store.
+"""
+import json
+
+import fw_audit
+from fw_blob import parse_blob
+from fw_protect import protect_image
+from fw_store import Store
+
+
+def test_audit_directory(tmp_path, firmware, aes_key, signing_keys):
+    rsa_key = signing_keys['rsa']
+    good, _ = protect_image(firmware, 3, 'release', aes_key, rsa_key)
+    tampered = bytearray(good)
+    tampered[parse_blob(good).header_length + 100] ^= 1
+    other_key, _ = protect_image(firmware, 3, 'release', aes_key, signing_keys['p256'])
+    (tmp_path / 'old').mkdir()
+    blobs = {
+        'good.blob': good,
+        'old/gcm.blob': protect_image(firmware, 2, 'old', aes_key, rsa_key, cipher='gcm')[0],
+        'tampered.blob': bytes(tampered),
+        'other_key.blob': other_key,
+        'truncated.blob': good[:100],
+        'empty.blob': b'',
+    }
+    for name, blob in blobs.items():
+        (tmp_path / name).write_bytes(blob)
+    (tmp_path / 'notes.txt').write_text('not a blob')
+
+    found = fw_audit.find_blobs(tmp_path)
+    assert sorted(path for path, _ in found) == sorted(str(tmp_path / name) for name in blobs)
+    report = fw_audit.audit(found, rsa_key.public_key(), workers=2)
+    results = {result['path'][len(str(tmp_path)) + 1:]: result for result in report['blobs']}
+
+    assert (report['checked'], report['failed']) == (6, 4)
+    assert results['good.blob']['ok'] and results['old/gcm.blob']['ok']
+    assert results['good.blob']['version'] == 3 and results['good.blob']['signature'] == 'rsa'
+    assert results['tampered.blob']['problems'] == ["signature does not verify against the public key"]
+    assert results['other_key.blob']['signature'] == 'p256' and not results['other_key.blob']['ok']
+    assert not results['truncated.blob']['ok'] and 'version' not in results['truncated.blob']
+    assert results['empty.blob']['problems'] == ["file is empty"]
+
+    report_path = tmp_path / 'report.json'
+    fw_audit.write_report(report_path, report)
+    assert json.loads(report_path.read_text())['failed'] == 4
+
+
+def test_audit_store_checks_the_hash(tmp_path, firmware, aes_key, rsa_key):
+    store = Store(tmp_path)
+    blob_hashes = [store.publish(protect_image(firmware, version, 'release', aes_key, rsa_key)[0], '01' * 8,
+                                 version, '{:064x}'.format(version)) for version in (3, 4)]
+    store.blob_path(blob_hashes[1]).write_bytes(protect_image(firmware, 5, 'release', aes_key, rsa_key)[0])
+
+    found = fw_audit.find_blobs(tmp_path)
+    assert sorted(expected for _, expected in found) == sorted(blob_hashes)
+    results = {result['path']: result for result in fw_audit.audit(found, rsa_key.public_key(), workers=1)['blobs']}
+    assert results[str(store.blob_path(blob_hashes[0]))]['ok']
+    assert results[str(store.blob_path(blob_hashes[1]))]['problems'] == [
+        "contents do not match the hash it is stored under"]
@@ -0,0 +1,131 @@
+"""
+Protected blobs: every signature scheme and cipher round-tripped on the host and through the
+bootloader model, tampering, and segment maps.
+"""
+import struct
+
+import pytest
+
+import fw_blob
+import fw_image
+import fw_update
+from bl_model import BootloaderModel
+from flash_model import FlashModel
+from fw_protect import protect_image
+from serial_sim import SimulatedSerial
+
+SCHEMES = ['rsa', 'ed25519', 'p256']
+CIPHERS = ['cbc', 'gcm']
+
+
+def install(blob, aes_key, signing_key, flash=None, frame_size=fw_update.FRAME_SIZE):
+    """
+    Returns: the bootloader model after {blob} was sent to it, and the error fw_update raised, if any
+    """
+    dev = BootloaderModel(aes_key=aes_key, public_key=signing_key.public_key(), flash=flash or FlashModel())
+    try:
+        fw_update.update(SimulatedSerial(dev, seed=1), blob, sequenced=True, frame_size=frame_size, timeout=5)
+    except RuntimeError as e:
+        return dev, e
+    return dev, None
+
+
+@pytest.mark.parametrize('cipher', CIPHERS)
+@pytest.mark.parametrize('scheme', SCHEMES)
+def test_round_trip(firmware, aes_key, signing_keys, scheme, cipher):
+    key = signing_keys[scheme]
+    blob, _ = protect_image(firmware, 3, 'release', aes_key, key, cipher=cipher)
+    parsed = fw_blob.parse_blob(blob)
+    assert parsed.sig_type == fw_blob.signature_type(key)
+    assert parsed.cipher == {'cbc': fw_blob.CIPHER_CBC, 'gcm': fw_blob.CIPHER_GCM}[cipher]
+    assert fw_blob.check_blob(blob) == []
+    assert fw_blob.verify_signature(blob, key.public_key())
+    assert fw_blob.decrypt_blob(blob, aes_key)[:len(firmware)] == firmware
+
+    dev, error = install(blob, aes_key, key)
+    assert error is None
+    assert dev.status == 'installed'
+    assert dev.firmware[:len(firmware)] == firmware
+
+
+def test_elliptic_curve_headers_are_smaller(firmware, aes_key, signing_keys):
+    lengths = {scheme: fw_blob.parse_blob(protect_image(firmware, 3, 'release', aes_key, key)[0]).header_length
+               for scheme, key in signing_keys.items()}
+    assert lengths['ed25519'] == lengths['p256'] < lengths['rsa']
+
+
+@pytest.mark.parametrize('cipher', CIPHERS)
+@pytest.mark.parametrize('scheme', SCHEMES)
+def test_tampered_blob_is_rejected(firmware, aes_key, signing_keys, scheme, cipher):
+    key = signing_keys[scheme]
+    blob, _ = protect_image(firmware, 3, 'release', aes_key, key, cipher=cipher)
+    tampered = bytearray(blob)
+    tampered[fw_blob.parse_blob(blob).header_length + 3000] ^= 1
+    tampered = bytes(tampered)
+    assert not fw_blob.verify_signature(tampered, key.public_key())
+
+    dev, error = install(tampered, aes_key, key)
+    if cipher == 'gcm':
+        # each frame carries its own tag, so the bad frame is refused as it arrives
+        with pytest.raises(ValueError):
+            fw_blob.decrypt_blob(tampered, aes_key)
+        assert dev.status == 'rejected' and error is not None
+    else:
+        assert dev.status == 'unauthenticated'
+    assert dev.firmware == b''
+
+
+def test_wrong_key_type_is_rejected(firmware, aes_key, signing_keys):
+    blob, _ = protect_image(firmware, 3, 'release', aes_key, signing_keys['ed25519'])
+    assert not fw_blob.verify_signature(blob, signing_keys['p256'].public_key())
+    dev, _ = install(blob, aes_key, signing_keys['p256'])
+    assert dev.status == 'unauthenticated'
+
+
+def write_hex(path, pieces):
+    """Writes the (address, data) {pieces} to {path} as Intel HEX, 16 bytes to a record."""
+    records = []
+    for address, data in pieces:
+        records.append((0x04, 0, struct.pack('>H', address >> 16)))
+        for i in range(0, len(data), 16):
+            records.append((0x00, (address + i) & 0xFFFF, data[i: i + 16]))
+    records.append((0x01, 0, b''))
+    with open(path, 'w') as fp:
+        for kind, address, data in records:
+            record = bytes([len(data)]) + struct.pack('>H', address) + bytes([kind]) + data
+            fp.write(':' + (record + bytes([-sum(record) & 0xFF])).hex().upper() + '\n')
+
+
+def test_segment_map_layout(tmp_path, firmware, aes_key, rsa_key):
+    first, second = firmware[:4000], firmware[4000:7000]
+    path = tmp_path / 'sparse.hex'
+    write_hex(path, [(0x10000, first), (0x18010, second)])
+
+    f, segments = fw_image.layout(path)
+    # The first run is padded to its last page; the second starts on the page holding 0x18010
+    assert segments == [(0x10000, 4000), (0x18000, 16 + 3000)]
+    assert f == first + b'\xff' * 16 + second
+
+    blob, _ = protect_image(f, 3, 'sparse', aes_key, rsa_key, segments=segments)
+    assert fw_blob.parse_blob(blob).segments == segments
+    assert fw_blob.check_blob(blob) == []
+
+    flash = FlashModel()
+    dev, error = install(blob, aes_key, rsa_key, flash=flash, frame_size=1024)
+    assert error is None and dev.status == 'installed'
+    assert flash.read(0x10000, 4000) == first
+    assert flash.read(0x18010, 3000) == second
+    assert flash.read(0x18000, 16) == b'\xff' * 16
+
+
+def test_flat_image_has_no_segment_map(tmp_path, firmware):
+    path = tmp_path / 'fw.bin'
+    path.write_bytes(firmware)
+    assert fw_image.layout(path) == (firmware, None)
+
+
+def test_overlapping_pieces_are_refused():
+    with pytest.raises(ValueError):
+        fw_image.coalesce([(0x10000, bytes(100)), (0x10010, bytes(100))])
+    with pytest.raises(ValueError):
+        fw_image.coalesce([(0x8000, bytes(100))])
@@ -0,0 +1,67 @@
+"""
+The build cache: keys, hits through fw_protect, and least recently used eviction.
+"""
+import os
+
+import pytest
+
+import fw_protect
+from fw_blob import key_fingerprint
+from fw_build_cache import BuildCache, cache_key
+
+KEY = dict(image=b'image', version=3, message='release', key_id='01' * 8, aes_key=bytes(16), cipher='cbc')
+
+
+@pytest.mark.parametrize('field, value', [('image', b'other image'), ('version', 4), ('message', 'other'),
+                                          ('key_id', '02' * 8), ('aes_key', bytes(15) + b'\x01'),
+                                          ('cipher', 'gcm')])
+def test_every_field_changes_the_key(field, value):
+    assert cache_key(**dict(KEY, **{field: value})) != cache_key(**KEY)
+
+
+@pytest.fixture
+def secrets(tmp_path, aes_key, rsa_key):
+    path = tmp_path / 'secrets'
+    path.write_bytes(aes_key + rsa_key.export_key('PEM'))
+    return str(path)
+
+
+def test_protect_hits_the_cache(tmp_path, firmware, secrets, capsys):
+    infile, cache = tmp_path / 'fw.bin', BuildCache(tmp_path / 'cache')
+    infile.write_bytes(firmware)
+    outfiles = [str(tmp_path / name) for name in ('one.blob', 'two.blob', 'three.blob')]
+    fw_protect.protect_firmware(str(infile), outfiles[0], 3, 'release', cache=cache, secrets=secrets)
+    fw_protect.protect_firmware(str(infile), outfiles[1], 3, 'release', cache=cache, secrets=secrets)
+    fw_protect.protect_firmware(str(infile), outfiles[2], 4, 'release', cache=cache, secrets=secrets)
+    one, two, three = (open(path, 'rb').read() for path in outfiles)
+    assert one == two # the IV is random, so only a hit gives the same blob
+    assert three != one
+    assert len(list(cache.path.glob('*.blob'))) == 2
+
+
+def test_a_cached_blob_that_no_longer_verifies_is_discarded(tmp_path, firmware, aes_key, rsa_key):
+    cache = BuildCache(tmp_path)
+    key = cache_key(firmware, 3, 'release', key_fingerprint(rsa_key.public_key()), aes_key)
+    blob, manifest = fw_protect.protect_image(firmware, 3, 'release', aes_key, rsa_key)
+    cache.put(key, blob[:-1] + bytes([blob[-1] ^ 1]), manifest)
+    assert fw_protect.cached_blob(cache, key, 3, rsa_key.public_key()) is None
+    assert cache.get(key) is None
+    cache.put(key, blob, manifest)
+    assert fw_protect.cached_blob(cache, key, 4, rsa_key.public_key()) is None
+    cache.put(key, blob, manifest)
+    assert fw_protect.cached_blob(cache, key, 3, rsa_key.public_key()) == (blob, manifest)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = BuildCache(tmp_path, max_bytes=1 << 20)
+    for n, key in enumerate(('a', 'b', 'c')):
+        cache.put(key, bytes(1000), {})
+        os.utime(tmp_path / (key + '.blob'), (1000 + n, 1000 + n))
+    assert cache.get('a') == (bytes(1000), {}) # now the most recently used
+    cache.max_bytes = 2100
+    assert cache.evict() == ['b']
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    cache.max_bytes = 0
+    assert sorted(cache.evict()) == ['a', 'c']
+    assert list(tmp_path.iterdir()) == []
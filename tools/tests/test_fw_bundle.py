@@ -0,0 +1,61 @@
+"""
+Release bundles: picking a blob by variant and version, and checking blobs against their digests.
+"""
+import pytest
+
+import fw_bundle
+from fw_blob import verify_signature
+from fw_protect import protect_image
+
+
+@pytest.fixture
+def bundle_path(tmp_path, firmware, aes_key, rsa_key):
+    blobs = [
+        ('prod', protect_image(firmware, 3, 'prod 3', aes_key, rsa_key)[0]),
+        ('prod', protect_image(firmware, 4, 'prod 4', aes_key, rsa_key)[0]),
+        ('debug', protect_image(firmware, 0, 'debug', aes_key, rsa_key, 'gcm')[0]),
+    ]
+    path = tmp_path / 'release.bundle'
+    fw_bundle.write_bundle(path, blobs)
+    return path, blobs
+
+
+def test_select(bundle_path):
+    path, _ = bundle_path
+    with fw_bundle.Bundle(path) as bundle:
+        assert [(entry.variant, entry.version) for entry in bundle.entries] == [('prod', 3), ('prod', 4), ('debug', 0)]
+        assert bundle.select('prod').version == 4
+        assert bundle.select('prod', 3).version == 3
+        assert bundle.select('prod', 5) is None
+        assert bundle.select('bench') is None
+        assert all(entry.offset % fw_bundle.ALIGNMENT == 0 for entry in bundle.entries)
+
+
+def test_blob_matches_what_was_bundled(bundle_path, rsa_key):
+    path, blobs = bundle_path
+    with fw_bundle.Bundle(path) as bundle:
+        for entry, (_, blob) in zip(bundle.entries, blobs):
+            view = bundle.blob(entry)
+            assert bytes(view) == blob
+            assert verify_signature(view, rsa_key.public_key())
+            view.release()
+
+
+def test_corrupted_blob_fails_verification(bundle_path):
+    path, _ = bundle_path
+    with fw_bundle.Bundle(path) as bundle:
+        entry = bundle.select('prod')
+    data = bytearray(path.read_bytes())
+    data[entry.offset + entry.length - 1] ^= 1
+    path.write_bytes(data)
+    with fw_bundle.Bundle(path) as bundle:
+        with pytest.raises(ValueError):
+            bundle.blob(entry)
+        bundle.blob(entry, verify=False).release()
+
+
+def test_not_a_bundle(tmp_path):
+    path = tmp_path / 'junk'
+    path.write_bytes(b'\x00' * 64)
+    with pytest.raises(ValueError):
+        fw_bundle.Bundle(path)
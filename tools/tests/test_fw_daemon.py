@@ -0,0 +1,168 @@
+"""
+The update daemon: port leases, job timeouts and paths, and who may send jobs.
+"""
+import os
+import socket
+import stat
+import threading
+
+import pytest
+
+import fw_daemon
+from bl_model import BootloaderModel
+from flash_model import FlashModel
+from fw_client import request
+from fw_protect import protect_image
+from serial_sim import SimulatedSerial
+
+
+class Port:
+    """A port that remembers whether it was closed."""
+
+    def __init__(self, name):
+        self.name = name
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+
+@pytest.fixture
+def pool():
+    opened = []
+
+    def opener(name):
+        opened.append(Port(name))
+        return opened[-1]
+
+    pool = fw_daemon.PortPool(opener=opener, healthy=lambda name, port: port.is_open)
+    pool.opened = opened
+    return pool
+
+
+def test_a_port_is_opened_once_and_kept(pool):
+    with pool.lease('a') as first:
+        pass
+    with pool.lease('a') as second:
+        pass
+    assert first is second and len(pool.opened) == 1
+    status = pool.status()['a']
+    assert status['open'] and not status['leased']
+    assert (status['jobs'], status['failures']) == (2, 0)
+
+
+def test_a_lease_is_exclusive(pool):
+    with pool.lease('a'):
+        assert pool.status()['a']['leased']
+        with pytest.raises(TimeoutError):
+            with pool.lease('a', timeout=0.1):
+                pass
+        with pool.lease('b'): # other ports are not held up
+            pass
+
+
+def test_a_serial_error_closes_the_port(pool):
+    with pytest.raises(OSError):
+        with pool.lease('a'):
+            raise OSError("device unplugged")
+    assert not pool.opened[0].is_open
+    assert pool.status()['a']['failures'] == 1
+    with pool.lease('a') as port:
+        assert port is pool.opened[1]
+
+
+def test_health_check_closes_idle_ports_that_went_away(pool):
+    with pool.lease('a'):
+        pass
+    with pool.lease('b'):
+        pass
+    pool.opened[0].is_open = False
+    assert pool.check() == ['a']
+    assert not pool.status()['a']['open'] and pool.status()['b']['open']
+
+
+@pytest.mark.parametrize('asked, used', [(None, fw_daemon.JOB_TIMEOUT), (3, 3), (0.5, 0.5),
+                                         (1e9, fw_daemon.MAX_JOB_TIMEOUT)])
+def test_job_timeout(asked, used):
+    assert fw_daemon.job_timeout(asked) == used
+
+
+@pytest.mark.parametrize('timeout', [0, -1, float('nan'), '10', True])
+def test_bad_job_timeouts_are_refused(timeout):
+    with pytest.raises(ValueError):
+        fw_daemon.job_timeout(timeout)
+
+
+def test_run_job_updates_over_a_leased_port(tmp_path, firmware, aes_key, rsa_key):
+    blob, _ = protect_image(firmware, 3, 'release', aes_key, rsa_key)
+    path = tmp_path / 'fw.blob'
+    path.write_bytes(blob)
+    dev = BootloaderModel(aes_key=aes_key, public_key=rsa_key.public_key(), flash=FlashModel())
+    links = []
+
+    def opener(name):
+        links.append(SimulatedSerial(dev, seed=1))
+        return links[-1]
+
+    pool = fw_daemon.PortPool(opener=opener)
+    result = fw_daemon.run_job(pool, {'op': 'update', 'port': 'sim', 'firmware': str(path), 'sequenced': True,
+                                      'timeout': None})
+    assert result['frames'] > 0
+    assert dev.status == 'installed'
+    assert dev.firmware[:len(firmware)] == firmware
+    with pytest.raises(ValueError):
+        fw_daemon.run_job(pool, {'op': 'update', 'port': 'sim', 'firmware': str(path), 'timeout': 0})
+
+
+def test_job_paths_must_be_allowed(tmp_path):
+    allowed = [os.path.realpath(tmp_path)]
+    fw_daemon.check_paths({'firmware': str(tmp_path / 'fw.blob'), 'pages': None}, allowed)
+    fw_daemon.check_paths({'firmware': '/etc/passwd'}, None)
+    for job in ({'firmware': '/etc/passwd'}, {'firmware': str(tmp_path / '..' / 'fw.blob')},
+                {'firmware': str(tmp_path / 'fw.blob'), 'journal': '/var/tmp'}):
+        with pytest.raises(PermissionError):
+            fw_daemon.check_paths(job, allowed)
+
+
+def test_private_dir(tmp_path):
+    path = tmp_path / 'run'
+    fw_daemon.private_dir(path)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o700
+    os.chmod(path, 0o755)
+    with pytest.raises(PermissionError):
+        fw_daemon.private_dir(path)
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    path = str(tmp_path / 'daemon.sock')
+    daemon = fw_daemon.Daemon(path, pool=fw_daemon.PortPool(opener=Port), allowed=[tmp_path])
+    thread = threading.Thread(target=daemon.serve_forever, daemon=True)
+    thread.start()
+    yield daemon
+    daemon.shutdown()
+    daemon.server_close()
+    thread.join(5)
+
+
+def test_socket_is_private(daemon):
+    assert stat.S_IMODE(os.stat(daemon.server_address).st_mode) == 0o600
+    assert request({'op': 'status'}, path=daemon.server_address, timeout=5) == {'ok': True, 'result': {}}
+
+
+def test_jobs_from_another_user_are_refused(daemon, monkeypatch):
+    monkeypatch.setattr(fw_daemon, 'peer_uid', lambda sock: os.getuid() + 1)
+    reply = request({'op': 'status'}, path=daemon.server_address, timeout=5)
+    assert not reply['ok'] and reply['error'].startswith('PermissionError')
+
+
+def test_jobs_outside_the_allowed_directories_are_refused(daemon):
+    reply = request({'op': 'update', 'port': 'a', 'firmware': '/etc/passwd'}, path=daemon.server_address, timeout=5)
+    assert reply == {'ok': False, 'error': 'PermissionError: firmware /etc/passwd is not under an allowed directory'}
+
+
+@pytest.mark.skipif(not hasattr(socket, 'SO_PEERCRED'), reason="the platform does not give peer credentials")
+def test_peer_uid():
+    left, right = socket.socketpair(socket.AF_UNIX)
+    with left, right:
+        assert fw_daemon.peer_uid(left) == os.getuid()
@@ -0,0 +1,114 @@
+"""
+The fleet scheduler: retries with doubling backoff, giving up after the last attempt, and skipping
+devices the progress log records as done.
+"""
+import threading
+import time
+
+import pytest
+
+from fw_fleet import ProgressLog, Scheduler
+
+BACKOFF = 0.05
+
+
+@pytest.fixture
+def firmware_path(tmp_path):
+    path = tmp_path / 'fw.blob'
+    path.write_bytes(b'blob')
+    return str(path)
+
+
+def inventory(firmware_path, count=1):
+    return [{'port': 'port{}'.format(i), 'firmware': firmware_path, 'hub': '', 'group': ''} for i in range(count)]
+
+
+class FlakyRunner:
+    """Fails the first {failures} updates of every port, recording when each attempt started."""
+
+    def __init__(self, failures):
+        self.failures = failures
+        self.starts = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, port, firmware, **options):
+        with self._lock:
+            starts = self.starts.setdefault(port, [])
+            starts.append(time.monotonic())
+            if len(starts) <= self.failures:
+                raise RuntimeError("attempt {} failed".format(len(starts)))
+        return {'frames': 1}
+
+
+def test_retries_with_doubling_backoff(firmware_path):
+    runner = FlakyRunner(failures=2)
+    results = Scheduler(inventory(firmware_path), runner=runner, attempts=3, backoff=BACKOFF).run()
+    assert results['port0']['ok'] and results['port0']['attempts'] == 3
+    first, second, third = runner.starts['port0']
+    assert second - first >= BACKOFF
+    assert third - second >= 2 * BACKOFF
+
+
+def test_backoff_is_capped(firmware_path):
+    runner = FlakyRunner(failures=3)
+    Scheduler(inventory(firmware_path), runner=runner, attempts=4, backoff=BACKOFF, max_backoff=BACKOFF).run()
+    starts = runner.starts['port0']
+    # uncapped, the last wait would be 4 * BACKOFF
+    assert all(BACKOFF <= later - earlier < 3 * BACKOFF for earlier, later in zip(starts, starts[1:]))
+
+
+def test_gives_up_after_the_last_attempt(firmware_path):
+    runner = FlakyRunner(failures=5)
+    results = Scheduler(inventory(firmware_path, 2), runner=runner, attempts=2, backoff=BACKOFF).run()
+    for port in ('port0', 'port1'):
+        assert not results[port]['ok']
+        assert results[port]['attempts'] == 2
+        assert results[port]['error'] == 'RuntimeError: attempt 2 failed'
+        assert len(runner.starts[port]) == 2
+
+
+def test_log_skips_devices_already_done(tmp_path, firmware_path):
+    devices = inventory(firmware_path, 2)
+    log = ProgressLog(tmp_path / 'progress.log')
+    Scheduler(devices[:1], runner=FlakyRunner(failures=0), log=log).run()
+
+    runner = FlakyRunner(failures=0)
+    results = Scheduler(devices, runner=runner, log=ProgressLog(tmp_path / 'progress.log')).run()
+    assert results['port0'] == {'ok': True, 'skipped': True, 'attempts': 0}
+    assert results['port1']['ok']
+    assert list(runner.starts) == ['port1']
+
+
+def test_failed_log_write_fails_the_attempt(tmp_path, firmware_path):
+    class BrokenLog(ProgressLog):
+        def write(self, **event):
+            if event['event'] == 'start':
+                raise OSError("disk full")
+            super().write(**event)
+
+    runner = FlakyRunner(failures=0)
+    scheduler = Scheduler(inventory(firmware_path), runner=runner, log=BrokenLog(tmp_path / 'progress.log'),
+                          attempts=1)
+    results = {}
+    thread = threading.Thread(target=lambda: results.update(scheduler.run()), daemon=True)
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive(), "the scheduler hung"
+    assert results['port0'] == {'ok': False, 'attempts': 1, 'error': 'OSError: disk full'}
+    assert runner.starts == {}
+
+
+def test_failed_outcome_write_is_reported(tmp_path, firmware_path):
+    class FullLog(ProgressLog):
+        def write(self, **event):
+            if event['event'] != 'start':
+                raise OSError("disk full")
+            super().write(**event)
+
+    log = FullLog(tmp_path / 'progress.log')
+    results = Scheduler(inventory(firmware_path, 2), runner=FlakyRunner(failures=1), log=log, attempts=2,
+                        backoff=BACKOFF).run()
+    for port in ('port0', 'port1'):
+        assert results[port]['ok'] and results[port]['attempts'] == 2
+        assert results[port]['log_error'] == 'OSError: disk full'
+    assert log.completed() == set() # so a rerun updates them again
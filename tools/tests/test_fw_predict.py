@@ -0,0 +1,59 @@
+"""
+The update-time predictor and its least-squares calibration.
+"""
+import pytest
+
+import fw_predict
+import fw_update
+from bl_model import BootloaderModel
+from fw_protect import protect_image
+from serial_sim import SimulatedSerial
+
+
+def loop(frames, payload, model, sequenced=True):
+    """Returns: the measurement of a frame loop that took exactly what {model} says"""
+    overhead = fw_predict.SEQUENCED_OVERHEAD if sequenced else fw_predict.FRAME_OVERHEAD
+    elapsed = frames * model.rtt + (payload + frames * overhead) * model.byte_time
+    if not sequenced:
+        elapsed += frames * fw_update.ACK_DELAY
+    return {'sequenced': sequenced, 'frames': frames, 'bytes': payload, 'elapsed': elapsed}
+
+
+def test_calibrate_recovers_the_model():
+    model = fw_predict.Model(byte_time=2e-4, rtt=0.003)
+    fitted = fw_predict.calibrate([loop(313, 20000, model), loop(20, 20000, model),
+                                   loop(79, 20000, model, sequenced=False)])
+    assert fitted.byte_time == pytest.approx(model.byte_time)
+    assert fitted.rtt == pytest.approx(model.rtt)
+
+
+def test_calibrate_with_one_frame_size_fits_only_the_rtt():
+    model = fw_predict.Model(byte_time=fw_predict.DEFAULT_MODEL.byte_time, rtt=0.01)
+    fitted = fw_predict.calibrate([loop(313, 20000, model), loop(626, 40000, model)])
+    assert fitted.byte_time == model.byte_time
+    assert fitted.rtt == pytest.approx(model.rtt)
+
+
+def test_calibrate_without_measurements():
+    assert fw_predict.calibrate([]) == fw_predict.DEFAULT_MODEL
+    assert fw_predict.calibrate([{'sequenced': True, 'frames': 0, 'bytes': 0, 'elapsed': 1.0}]) == \
+        fw_predict.DEFAULT_MODEL
+
+
+def test_calibrated_prediction_matches_the_link(tmp_path, firmware, aes_key, rsa_key):
+    blob, _ = protect_image(firmware, 3, 'release', aes_key, rsa_key)
+    path = tmp_path / 'measurements.jsonl'
+    for frame_size in (64, 512):
+        link = SimulatedSerial(BootloaderModel(aes_key=aes_key, public_key=rsa_key.public_key()), latency=0.002,
+                               baudrate=57600, seed=1)
+        result = fw_update.update(link, blob, sequenced=True, frame_size=frame_size, timeout=5)
+        fw_predict.record_measurement(path, result, sequenced=True)
+    model = fw_predict.calibrate(fw_predict.load_measurements(path))
+    assert model.byte_time == pytest.approx(10 / 57600, rel=0.05)
+
+    link = SimulatedSerial(BootloaderModel(aes_key=aes_key, public_key=rsa_key.public_key()), latency=0.002,
+                           baudrate=57600, seed=1)
+    result = fw_update.update(link, blob, sequenced=True, frame_size=256, timeout=5)
+    prediction = fw_predict.predict(blob, frame_size=256, sequenced=True, model=model)
+    assert prediction['frames_sent'] == result['frames']
+    assert prediction['frames'] == pytest.approx(result['elapsed'], rel=0.05)
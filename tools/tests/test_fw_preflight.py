@@ -0,0 +1,42 @@
+"""
+The pre-flight check and its cache of results.
+"""
+import pytest
+from Crypto.PublicKey import RSA
+
+from fw_preflight import preflight
+from fw_protect import protect_image
+
+
+@pytest.fixture(scope='module')
+def blob(firmware, aes_key, rsa_key):
+    return protect_image(firmware, 3, 'release', aes_key, rsa_key)[0]
+
+
+def test_result_is_cached(tmp_path, blob, rsa_key):
+    assert preflight(blob, rsa_key.public_key(), cache_dir=tmp_path) == {'ok': True, 'problems': [],
+                                                                         'cached': False}
+    assert preflight(blob, rsa_key.public_key(), cache_dir=tmp_path) == {'ok': True, 'problems': [],
+                                                                         'cached': True}
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_a_changed_blob_is_checked_again(tmp_path, blob, rsa_key):
+    preflight(blob, rsa_key.public_key(), cache_dir=tmp_path)
+    tampered = blob[:-1] + bytes([blob[-1] ^ 1])
+    result = preflight(tampered, rsa_key.public_key(), cache_dir=tmp_path)
+    assert not result['ok'] and not result['cached']
+    assert preflight(tampered, rsa_key.public_key(), cache_dir=tmp_path)['cached']
+    assert preflight(blob, rsa_key.public_key(), cache_dir=tmp_path)['ok']
+
+
+def test_another_key_is_checked_again(tmp_path, blob, rsa_key):
+    preflight(blob, rsa_key.public_key(), cache_dir=tmp_path)
+    result = preflight(blob, RSA.generate(2048).public_key(), cache_dir=tmp_path)
+    assert result == {'ok': False, 'problems': ["signature does not verify against the provisioned public key"],
+                      'cached': False}
+
+
+def test_structural_problems_are_reported(blob, rsa_key):
+    result = preflight(blob[:300], rsa_key.public_key(), cache_dir=None)
+    assert not result['ok'] and result['problems']
@@ -0,0 +1,74 @@
+"""
+The artifact store: publishing, lookups through the mapped index, gc, and the index lock.
+"""
+import concurrent.futures
+import hashlib
+import threading
+
+from fw_store import Store
+
+KEY_ID = '01' * 8
+
+
+def input_hash(n):
+    return hashlib.sha256(str(n).encode()).hexdigest()
+
+
+def publish(path, n, size=64):
+    blob = bytes([n % 256]) * size + str(n).encode()
+    return Store(path).publish(blob, KEY_ID, n, input_hash(n))
+
+
+def test_publish_and_lookup(tmp_path):
+    store = Store(tmp_path)
+    blob_hash = store.publish(b'blob', KEY_ID, 3, input_hash(3), manifest={'pages': []})
+    assert blob_hash == hashlib.sha256(b'blob').hexdigest()
+    assert store.blob_path(blob_hash).read_bytes() == b'blob'
+    assert store.manifest_path(blob_hash).exists()
+
+    entry = store.lookup(KEY_ID, 3, input_hash(3))
+    assert (entry.blob_hash, entry.size) == (blob_hash, 4)
+    assert store.lookup(KEY_ID, 3, input_hash(4)) is None
+    assert store.lookup('02' * 8, 3, input_hash(3)) is None
+    assert store.resolve(3) == entry
+    assert store.resolve(3, key_id=KEY_ID) == entry
+    assert store.resolve(4) is None
+
+
+def test_republishing_replaces_the_record(tmp_path):
+    store = Store(tmp_path)
+    store.publish(b'old', KEY_ID, 3, input_hash(3))
+    new = store.publish(b'new', KEY_ID, 3, input_hash(3))
+    assert [entry.blob_hash for entry in store.entries()] == [new]
+    assert store.gc(1 << 20) == [hashlib.sha256(b'old').hexdigest()]
+    assert store.size() == 3
+
+
+def test_gc_drops_the_oldest_blobs(tmp_path):
+    hashes = [publish(tmp_path, n) for n in range(5)]
+    store = Store(tmp_path)
+    one = store.blob_path(hashes[0]).stat().st_size
+    assert store.gc(2 * one) == sorted(hashes[:3])
+    assert sorted(entry.version for entry in store.entries()) == [3, 4]
+    assert store.size() == 2 * one
+
+
+def test_concurrent_publishes_keep_every_record(tmp_path):
+    with concurrent.futures.ProcessPoolExecutor(8) as pool:
+        list(pool.map(publish, [tmp_path] * 100, range(100)))
+    store = Store(tmp_path)
+    assert sorted(entry.version for entry in store.entries()) == list(range(100))
+    assert all(store.lookup(KEY_ID, n, input_hash(n)) is not None for n in range(100))
+
+
+def test_publish_waits_for_the_lock(tmp_path):
+    store = Store(tmp_path)
+    done = threading.Event()
+    with store._locked():
+        thread = threading.Thread(target=lambda: (publish(tmp_path, 1), done.set()))
+        thread.start()
+        assert not done.wait(0.2)
+        assert store.entries() == []
+    thread.join(5)
+    assert done.is_set()
+    assert [entry.version for entry in store.entries()] == [1]
@@ -0,0 +1,22 @@
+"""
+The stress harness, unpaced (--baudrate 0), and the distribution it reports.
+"""
+from fw_protect import protect_image
+from fw_scenario import distribution
+from fw_stress import format_report, stress
+
+
+def test_unpaced_stress(firmware, aes_key, rsa_key):
+    blob, _ = protect_image(firmware[:4096], 3, 'stress', aes_key, rsa_key)
+    report = stress(blob, 8, concurrency=4, keys=(aes_key, rsa_key), link_args={'baudrate': 0, 'latency': 0},
+                    options={'sequenced': True, 'timeout': 5})
+    assert (report['sessions'], report['succeeded'], report['failures']) == (8, 8, [])
+    assert report['throughput'] > 0 and report['updates_per_second'] > 0
+    assert 0 < report['latency']['p50'] <= report['latency']['p99'] <= report['latency']['max']
+    assert report['device_cpu']['mean'] > 0
+    assert format_report(report).split()[:2] == ['8', '8']
+
+
+def test_distribution():
+    assert distribution([3, 1, 2, 4]) == {'mean': 2.5, 'p50': 3, 'p90': 4, 'p99': 4, 'max': 4}
+    assert distribution([]) == {'mean': None, 'p50': None, 'p90': None, 'p99': None, 'max': None}
@@ -0,0 +1,230 @@
+"""
+fw_update against the bootloader model over a simulated link.
+"""
+import pytest
+
+import fw_update
+from bl_model import BootloaderModel
+from flash_model import FlashModel
+from fw_blob import parse_blob
+from fw_journal import Journal
+from fw_protect import protect_image
+from fw_scenario import run_trial
+from serial_sim import SimulatedSerial
+
+STALL = {'stall': 0.05, 'stall_time': 3}
+NOISE = {'corrupt': 1e-3, 'drop': 1e-3}
+HEAVY_NOISE = {'corrupt': 3e-3, 'drop': 1e-3}
+
+
+@pytest.fixture(scope='module')
+def blob(firmware, aes_key, rsa_key):
+    return protect_image(firmware, 3, 'release', aes_key, rsa_key)[0]
+
+
+def device(aes_key, signing_key):
+    return BootloaderModel(aes_key=aes_key, public_key=signing_key.public_key(), flash=FlashModel())
+
+
+class LostEndReply(SimulatedSerial):
+    """A link that loses the bootloader's response to the first end frame (the final OK)."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lost = False
+        self._end_sent = False
+
+    def write(self, data):
+        self._end_sent = not self.lost and bytes(data[:2]) == b'\x00\x00'
+        return super().write(data)
+
+    def read(self, size=1):
+        if self._end_sent:
+            self._end_sent, self.lost = False, True
+            super().read(size)
+            return super().read(size) # nothing more comes: the host times out
+        return super().read(size)
+
+
+class DamagedReply(SimulatedSerial):
+    """A link that flips the low bit of the status of the response to frame {sequence}."""
+
+    def __init__(self, *args, sequence=1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sequence = sequence
+        self.damaged = False
+        self._target = False
+
+    def write(self, data):
+        self._target = not self.damaged and len(data) > 4 and int.from_bytes(data[2:4], 'big') == self.sequence
+        return super().write(data)
+
+    def read(self, size=1):
+        resp = super().read(size)
+        if self._target and resp:
+            self._target, self.damaged = False, True
+            resp = bytes([resp[0] ^ 1]) + resp[1:] # OK now reads as ERROR
+        return resp
+
+
+def test_adaptive_frames_grow_on_a_clean_link(blob, firmware, aes_key, rsa_key):
+    dev = device(aes_key, rsa_key)
+    result = fw_update.update(SimulatedSerial(dev, seed=1), blob, adaptive=True, timeout=5)
+    assert [(d['from'], d['to']) for d in result['frame_sizes']] == [(64, 128), (128, 256), (256, 512), (512, 1024)]
+    assert {d['reason'] for d in result['frame_sizes']} == {'probing larger frames'}
+    assert dev.status == 'installed'
+    assert dev.firmware[:len(firmware)] == firmware
+
+
+def test_adaptive_frames_shrink_on_errors(blob, firmware, aes_key, rsa_key):
+    dev = device(aes_key, rsa_key)
+    result = fw_update.update(SimulatedSerial(dev, seed=3, **STALL), blob, adaptive=True, timeout=5)
+    shrinks = [d for d in result['frame_sizes'] if d['reason'] == 'errors']
+    assert shrinks and all(d['to'] == d['from'] // 2 for d in shrinks)
+    for decision in result['frame_sizes']:
+        fw_update.check_frame_size(decision['to'])
+    assert dev.status == 'installed'
+    assert dev.firmware[:len(firmware)] == firmware
+
+
+def test_controller_stays_within_the_frame_size_limits():
+    controller = fw_update.FrameSizeController(fw_update.MAX_FRAME_SIZE, window=1)
+    for _ in range(10):
+        fw_update.check_frame_size(controller.observe(controller.size, 0.01))
+    assert controller.size == fw_update.MAX_FRAME_SIZE
+    for _ in range(10):
+        fw_update.check_frame_size(controller.observe(controller.size, 0.01, errors=1))
+    assert controller.size == fw_update.MIN_FRAME_SIZE
+    assert fw_update.FrameSizeController(5000).size == fw_update.MAX_FRAME_SIZE
+    assert fw_update.FrameSizeController(100).size == 96
+
+
+def test_controller_goes_back_to_the_faster_size():
+    controller = fw_update.FrameSizeController(128, window=2)
+    for _ in range(2):
+        controller.observe(128, 0.01) # 12800 B/s
+    assert controller.size == 256
+    for _ in range(2):
+        controller.observe(256, 0.04) # 6400 B/s
+    assert controller.size == 128
+    assert controller.decisions[-1]['reason'] == 'smaller frames were faster'
+
+
+@pytest.mark.parametrize('frame_size', [0, 8, 17, 1040, 2048])
+def test_frame_sizes_the_bootloader_cannot_take_are_refused(blob, aes_key, rsa_key, frame_size):
+    with pytest.raises(ValueError):
+        fw_update.update(SimulatedSerial(device(aes_key, rsa_key)), blob, frame_size=frame_size, timeout=5)
+
+
+@pytest.mark.parametrize('link_args', [STALL, NOISE], ids=['stall', 'noise'])
+def test_sequenced_update_survives_seeded_loss(blob, aes_key, rsa_key, link_args):
+    failed = [(seed, trial['error']) for seed, trial in
+              ((seed, run_trial(blob, link_args, seed, keys=(aes_key, rsa_key), sequenced=True)) for seed in range(30))
+              if not trial['ok']]
+    assert failed == []
+
+
+def test_damaged_replies_are_never_taken_as_a_rejection(blob, aes_key, rsa_key):
+    # Heavy noise can still use up a frame's retries, but a damaged response must not end the update
+    for seed in range(30):
+        trial = run_trial(blob, HEAVY_NOISE, seed, keys=(aes_key, rsa_key), sequenced=True)
+        assert trial['ok'] or 'not acknowledged' in trial['error'], (seed, trial['error'])
+    assert run_trial(blob, HEAVY_NOISE, 2, keys=(aes_key, rsa_key), sequenced=True)['ok']
+
+
+def test_lost_final_ok_is_answered_again(blob, firmware, aes_key, rsa_key):
+    dev = device(aes_key, rsa_key)
+    link = LostEndReply(dev, seed=1)
+    result = fw_update.update(link, blob, sequenced=True, timeout=5)
+    assert link.lost
+    assert result['retransmissions'] == 1
+    assert dev.status == 'installed'
+    assert dev.firmware[:len(firmware)] == firmware
+
+
+def test_damaged_reply_is_retransmitted(blob, firmware, aes_key, rsa_key):
+    dev = device(aes_key, rsa_key)
+    link = DamagedReply(dev, seed=1, sequence=1)
+    result = fw_update.update(link, blob, sequenced=True, timeout=5)
+    assert link.damaged
+    assert result['retransmissions'] == 1
+    assert dev.status == 'installed'
+    assert dev.firmware[:len(firmware)] == firmware
+
+
+def test_decode_reply_checks_the_complements():
+    assert fw_update.decode_reply(b'\x00\x07\xff\xf8') == (fw_update.RESP_OK, b'\x07')
+    assert fw_update.decode_reply(b'\x01\x07\xff\xf8') is None
+    assert fw_update.decode_reply(b'\x00\x07\xff') is None
+
+
+class Interrupted(Exception):
+    pass
+
+
+class KilledJournal(Journal):
+    """A journal whose tool is killed once {frames} frames have been acknowledged."""
+
+    def __init__(self, path, frames):
+        super().__init__(path)
+        self.frames = frames
+
+    def record(self, device, blob, sequence, offset):
+        super().record(device, blob, sequence, offset)
+        if sequence >= self.frames:
+            raise Interrupted()
+
+
+def test_interrupted_update_resumes_from_the_journal(tmp_path, blob, firmware, aes_key, rsa_key):
+    dev = device(aes_key, rsa_key)
+    link = SimulatedSerial(dev, seed=1)
+    with pytest.raises(Interrupted):
+        fw_update.update(link, blob, sequenced=True, timeout=5, journal=KilledJournal(tmp_path, 100), device='dev')
+    assert dev.status == 'receiving'
+
+    journal = Journal(tmp_path)
+    result = fw_update.update(link, blob, sequenced=True, timeout=5, journal=journal, device='dev')
+    assert result['resumed_from'] == 100 * fw_update.FRAME_SIZE
+    assert result['resumed_from'] + result['bytes'] == len(parse_blob(blob).firmware)
+    assert dev.status == 'installed'
+    assert dev.firmware[:len(firmware)] == firmware
+    assert journal.load('dev') is None
+
+
+def test_journal_of_another_blob_is_ignored(tmp_path, blob, firmware, aes_key, rsa_key):
+    journal = Journal(tmp_path)
+    journal.record('dev', 'ab' * 32, 50, 50 * fw_update.FRAME_SIZE)
+    dev = device(aes_key, rsa_key)
+    result = fw_update.update(SimulatedSerial(dev, seed=1), blob, sequenced=True, timeout=5, journal=journal,
+                              device='dev')
+    assert result['resumed_from'] == 0
+    assert dev.status == 'installed'
+    assert journal.entries() == []
+
+
+def test_changed_pages_update_sends_only_the_changed_page(firmware, aes_key, rsa_key):
+    dev = device(aes_key, rsa_key)
+    link = SimulatedSerial(dev, seed=1)
+    first, _ = protect_image(firmware, 3, 'one', aes_key, rsa_key)
+    fw_update.update(link, first, sequenced=True, timeout=5)
+
+    changed = bytearray(firmware)
+    changed[3000] ^= 0xFF
+    second, manifest = protect_image(bytes(changed), 4, 'one', aes_key, rsa_key) # same message: same last page
+    result = fw_update.update(link, second, manifest=manifest, timeout=5)
+    assert result['pages_skipped'] == len(manifest['pages']) - 1
+    assert dev.status == 'installed'
+    assert dev.firmware[:len(changed)] == bytes(changed)
+
+
+def test_manifest_of_another_blob_is_refused(firmware, aes_key, rsa_key):
+    _, manifest = protect_image(firmware, 3, 'one', aes_key, rsa_key)
+    second, _ = protect_image(firmware, 4, 'one', aes_key, rsa_key)
+    with pytest.raises(ValueError):
+        fw_update.update(SimulatedSerial(device(aes_key, rsa_key)), second, manifest=manifest, timeout=5)
+
+
+def test_page_digests_are_keyed(firmware, aes_key, rsa_key):
+    _, manifest = protect_image(firmware, 3, 'one', aes_key, rsa_key)
+    _, other = protect_image(firmware, 3, 'one', bytes(16), rsa_key)
+    assert not set(manifest['pages']) & set(other['pages'])
@@ -0,0 +1,35 @@
+"""
+The Montgomery constants: the word-serial verifier agrees with PyCryptodome's PKCS#1 v1.5, and the
+generated header reads back as written.
+"""
+import hashlib
+
+from Crypto.Hash import SHA256
+from Crypto.Signature import pkcs1_15
+
+import rsa_montgomery
+
+
+def test_mont_pow_matches_pow(rsa_key):
+    consts = rsa_montgomery.constants(rsa_key.n, rsa_key.e)
+    for base in (2, 12345, rsa_key.n - 2):
+        assert rsa_montgomery.mont_pow(base, consts) == pow(base, rsa_key.e, rsa_key.n)
+
+
+def test_verify_agrees_with_pkcs1_15(rsa_key):
+    consts = rsa_montgomery.constants(rsa_key.n, rsa_key.e)
+    signature = pkcs1_15.new(rsa_key).sign(SHA256.new(b'firmware'))
+    assert rsa_montgomery.verify(signature, hashlib.sha256(b'firmware').digest(), consts)
+    assert not rsa_montgomery.verify(signature, hashlib.sha256(b'firmwarf').digest(), consts)
+    bad = bytes([signature[0] ^ 1]) + signature[1:]
+    assert not rsa_montgomery.verify(bad, hashlib.sha256(b'firmware').digest(), consts)
+    assert not rsa_montgomery.verify(signature[1:], hashlib.sha256(b'firmware').digest(), consts)
+
+
+def test_header_round_trip(tmp_path, rsa_key):
+    path = tmp_path / 'rsa_constants.h'
+    rsa_montgomery.write_header(path, rsa_key.public_key())
+    consts = rsa_montgomery.read_header(path)
+    assert consts == rsa_montgomery.constants(rsa_key.n, rsa_key.e)
+    assert rsa_montgomery.check_constants(consts) == []
+    assert rsa_montgomery.check_constants(dict(consts, r2=consts['r2'] + 1)) == ['r2']
@@ -0,0 +1,98 @@
+"""
+The simulated serial link: pacing and latency on its clock, and seeded drops, bit flips and stalls.
+"""
+import pytest
+
+from serial_sim import SimulatedSerial
+
+BYTE_TIME = 10 / 115200
+
+
+class Echo:
+    """A device that sends back whatever it receives, keeping time on the link's clock."""
+
+    def __init__(self):
+        self.clock = None
+        self.received = bytearray()
+        self._out = bytearray()
+
+    @property
+    def in_waiting(self):
+        return len(self._out)
+
+    def write(self, data):
+        self.received += data
+        self._out += data
+
+    def read(self, size):
+        out = bytes(self._out[:size])
+        del self._out[:size]
+        return out
+
+
+def test_bytes_take_their_time_on_the_line():
+    device = Echo()
+    link = SimulatedSerial(device, latency=0.01)
+    assert device.clock == link.monotonic
+    link.write(bytes(100))
+    assert link.monotonic() == pytest.approx(100 * BYTE_TIME)
+    assert link.read(100) == bytes(100)
+    # out, latency, back, latency again
+    assert link.monotonic() == pytest.approx(200 * BYTE_TIME + 0.02)
+    assert link.stats['tx_bytes'] == link.stats['rx_bytes'] == 100
+
+
+def test_read_times_out_on_the_simulated_clock():
+    link = SimulatedSerial(Echo(), timeout=2)
+    assert link.read(1) == b''
+    assert link.monotonic() == pytest.approx(2)
+    link.sleep(0.5)
+    assert link.monotonic() == pytest.approx(2.5)
+
+
+def test_drops_and_bit_flips_are_counted():
+    device = Echo()
+    link = SimulatedSerial(device, drop=0.01, corrupt=0.01, seed=0)
+    data = bytes(20000)
+    link.write(data)
+    echoed = link.read(len(data))
+    stats = link.stats
+    assert 100 < stats['tx_dropped'] < 300 and 100 < stats['tx_corrupted'] < 300
+    assert len(device.received) == len(data) - stats['tx_dropped']
+    assert sum(1 for byte in device.received if byte) == stats['tx_corrupted']
+    assert len(echoed) == len(device.received) - stats['rx_dropped']
+    # A byte flipped on the way out may be flipped back on the way in
+    assert sum(1 for byte in echoed if byte) <= stats['tx_corrupted'] + stats['rx_corrupted']
+
+
+def test_a_stall_holds_up_the_response():
+    link = SimulatedSerial(Echo(), stall=1.0, stall_time=1.5, timeout=5)
+    link.write(b'x')
+    assert link.read(1) == b'x'
+    assert link.stats['stalls'] == 2 # one each way
+    assert link.monotonic() == pytest.approx(2 * BYTE_TIME + 3.0)
+
+
+def test_faults_replay_from_the_seed():
+    def run(seed):
+        device = Echo()
+        link = SimulatedSerial(device, drop=0.01, corrupt=0.01, jitter=0.01, seed=seed)
+        link.write(bytes(5000))
+        return bytes(device.received), link.read(5000), link.monotonic(), dict(link.stats)
+
+    assert run(7) == run(7)
+    assert run(7) != run(8)
+
+
+def test_a_device_without_a_clock_is_refused():
+    class Port:
+        in_waiting = 0
+
+        def write(self, data):
+            pass
+
+        def read(self, size):
+            return b''
+
+    with pytest.raises(TypeError):
+        SimulatedSerial(Port())
@@ -0,0 +1,41 @@
+"""
+Console capture: timestamped lines, the log, and the per-phase breakdown of an update.
+"""
+from uart_capture import ConsoleCapture, Record, format_breakdown, phase_breakdown, read_log
+
+
+def console(*lines):
+    """Returns: UART2 rx Records of (time, text) {lines}"""
+    return [Record(at, 2, 'rx', text) for at, text in lines]
+
+
+def test_phase_breakdown():
+    records = console((1.0, 'entering loop'), (1.5, '0x40'), (2.0, '40'), (2.5, '0x10'),
+                      (2.75, 'passed verification'), (3.0, 'passed decryption'), (3.5, 'update complete'))
+    records.append(Record(2.2, 0, 'rx', 'entering loop')) # another UART
+    records.append(Record(2.3, 2, 'tx', '0x40')) # the other direction
+    assert phase_breakdown(records) == [{'start': 1.0, 'frames': 3, 'receive': 1.5, 'verify': 0.25,
+                                         'decrypt': 0.25, 'flash': 0.5}]
+
+
+def test_phase_breakdown_of_an_unfinished_update():
+    records = console((0.5, 'booting'), (1.0, 'entering loop'), (1.5, '0x40'), (2.0, 'entering loop'),
+                      (2.5, '0x40'), (3.0, 'passed verification'))
+    first, second = phase_breakdown(records)
+    assert first == {'start': 1.0, 'frames': 1, 'receive': 0.5}
+    assert second == {'start': 2.0, 'frames': 1, 'receive': 0.5, 'verify': 0.5}
+    assert format_breakdown(first) == 'Update at 1.000 s (1 frames): receive 0.500 s'
+
+
+def test_lines_are_stamped_with_their_first_byte(tmp_path):
+    path = tmp_path / 'console.log'
+    capture = ConsoleCapture(path)
+    start = capture.started
+    capture.feed(2, 'rx', b'entering ', at=start + 1.0)
+    capture.feed(2, 'rx', b'loop\r\n0x', at=start + 1.25)
+    capture.feed(0, 'tx', b'\x20', at=start + 1.5)
+    capture.feed(2, 'rx', b'40\n', at=start + 2.0)
+    capture.close()
+    expected = [Record(1.0, 2, 'rx', 'entering loop'), Record(1.25, 2, 'rx', '0x40'), Record(1.5, 0, 'tx', ' ')]
+    assert sorted(capture.records) == expected
+    assert sorted(read_log(path)) == expected
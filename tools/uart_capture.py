@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+UART Console Capture
+
+Records the console UARTs of the emulated board (UART0, which resets the device, and UART2, where
+the bootloader and firmware print) a line at a time, each line stamped with the monotonic time its
+first byte arrived. Lines go to a rotating log through a memory buffer, so writing the log never
+holds up the ports:
+
+<seconds since capture started> UART<n> <rx|tx> <line>
+
+rx is what the board sent and tx is what was sent to it. Bytes that are not printable ASCII are
+written as backslash escapes.
+
+phase_breakdown() turns the markers the bootloader prints during an update into a time per phase:
+
+    receive   "entering loop" to the last per-frame line (the whole transfer from the host)
+    verify    the last per-frame line to "passed verification" (RSA signature check)
+    decrypt   "passed verification" to "passed decryption" (AES-CBC)
+    flash     "passed decryption" to "update complete" (erasing and programming pages)
+"""
+import argparse
+import collections
+import logging
+import logging.handlers
+import re
+import threading
+import time
+
+CONSOLE_UARTS = (0, 2) # UART1 carries the binary update protocol, not text
+LOG_MAX_BYTES = 1024 * 1024 # size at which the log is rotated
+LOG_BACKUPS = 3 # rotated logs kept
+BUFFER_LINES = 256 # lines held in memory before they are written out
+
+# bootloader.c markers, the update ones in the order they are printed
+BOOTLOADER_READY = 'Writing 0x20 to UART0 will reset the device.' # last line before it waits for an instruction
+UPDATE_START = 'entering loop'
+VERIFIED = 'passed verification'
+DECRYPTED = 'passed decryption'
+UPDATE_DONE = 'update complete'
+FRAME_LINE = re.compile(r'^(0x)?[0-9a-fA-F]{1,2}$') # the length byte printed for each frame received
+
+Record = collections.namedtuple('Record', ['time', 'uart', 'direction', 'text'])
+
+
+class ConsoleCapture:
+    """
+    Timestamped capture of console traffic.
+
+    Arguments:
+    {path}: the log file, or None to only keep records in memory
+    {max_bytes}, {backups}: when to rotate the log and how many old logs to keep
+    {history}: how many records to keep in {records} for phase_breakdown()
+    """
+
+    def __init__(self, path=None, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS, history=10000):
+        self.started = time.monotonic()
+        self.records = collections.deque(maxlen=history)
+        self._partial = {} # (uart, direction) -> (time of first byte, bytes so far)
+        self._lock = threading.Lock()
+        self._log = None
+        if path is not None:
+            self._file = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+            self._file.setFormatter(logging.Formatter('%(message)s'))
+            self._handler = logging.handlers.MemoryHandler(BUFFER_LINES, flushLevel=logging.ERROR, target=self._file)
+            self._log = logging.getLogger('uart_capture.{}'.format(id(self)))
+            self._log.propagate = False
+            self._log.setLevel(logging.INFO)
+            self._log.addHandler(self._handler)
+
+    def feed(self, uart, direction, data, at=None):
+        """
+        Adds {data} that went {direction} ('rx' or 'tx') over UART {uart} at monotonic time {at}
+        (now if None). Complete lines are recorded; the rest is held until its line ends.
+        """
+        now = (time.monotonic() if at is None else at) - self.started
+        with self._lock:
+            started, pending = self._partial.pop((uart, direction), (now, b''))
+            pending += data
+            *lines, rest = pending.split(b'\n')
+            for line in lines:
+                self._record(started, uart, direction, line)
+                started = now
+            if rest:
+                self._partial[(uart, direction)] = (started, rest)
+
+    def _record(self, started, uart, direction, line):
+        text = line.rstrip(b'\r').decode('ascii', 'backslashreplace')
+        record = Record(started, uart, direction, text)
+        self.records.append(record)
+        if self._log is not None:
+            self._log.info('{:.6f} UART{} {} {}'.format(started, uart, direction, text))
+
+    def close(self):
+        """Records any unfinished lines and writes out the log."""
+        with self._lock:
+            for (uart, direction), (started, pending) in sorted(self._partial.items()):
+                self._record(started, uart, direction, pending)
+            self._partial.clear()
+        if self._log is not None:
+            self._handler.close() # flushes the buffered lines
+            self._file.close()
+            self._log.removeHandler(self._handler)
+
+
+def read_log(path):
+    """
+    Returns: the Records in a capture log
+    """
+    records = []
+    with open(path) as fp:
+        for line in fp:
+            started, uart, direction, text = (line.rstrip('\n').split(' ', 3) + [''])[:4]
+            records.append(Record(float(started), int(uart[len('UART'):]), direction, text))
+    return records
+
+
+def phase_breakdown(records, uart=2):
+    """
+    Returns: a list with one dictionary per update found in {records}, each mapping 'receive',
+    'verify', 'decrypt' and 'flash' to the seconds spent in that phase, for the phases whose
+    markers were both seen, plus 'frames' (frames received) and 'start' (time of "entering loop")
+    """
+    updates = []
+    current = None
+    for record in records:
+        if record.uart != uart or record.direction != 'rx':
+            continue
+        text = record.text
+        if UPDATE_START in text:
+            current = {'start': record.time, 'frames': 0, 'marks': {}}
+            updates.append(current)
+        elif current is None:
+            continue
+        elif FRAME_LINE.match(text):
+            current['frames'] += 1
+            current['marks']['received'] = record.time
+        for marker in (VERIFIED, DECRYPTED, UPDATE_DONE):
+            if marker in text:
+                current['marks'][marker] = record.time
+
+    breakdowns = []
+    for update in updates:
+        marks = dict(update.pop('marks'), start=update['start'])
+        for phase, begin, end in (('receive', 'start', 'received'), ('verify', 'received', VERIFIED),
+                                  ('decrypt', VERIFIED, DECRYPTED), ('flash', DECRYPTED, UPDATE_DONE)):
+            if begin in marks and end in marks:
+                update[phase] = marks[end] - marks[begin]
+        breakdowns.append(update)
+    return breakdowns
+
+
+def format_breakdown(update):
+    """
+    Returns: a one-line description of an update from phase_breakdown()
+    """
+    phases = ', '.join('{} {:.3f} s'.format(phase, update[phase])
+                       for phase in ('receive', 'verify', 'decrypt', 'flash') if phase in update)
+    return 'Update at {:.3f} s ({} frames): {}'.format(update['start'], update['frames'], phases or 'incomplete')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='UART Console Capture')
+    parser.add_argument("--log", help="Capture log written by bl_emulate --capture.", required=True)
+    args = parser.parse_args()
+
+    for update in phase_breakdown(read_log(args.log)):
+        print(format_breakdown(update))